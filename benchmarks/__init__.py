@@ -0,0 +1,15 @@
+"""
+Performance benchmarks for SynD, run with airspeed velocity (asv).
+
+Each benchmark class tracks wall time (:code:`time_*` methods) and peak memory (:code:`peakmem_*` methods) over a
+grid of parameters. From the repository root:
+
+.. code-block:: bash
+
+    pip install asv
+    asv run                   # Benchmark the latest commit
+    asv continuous main HEAD  # Compare HEAD against main, and flag regressions
+    asv publish && asv preview
+
+Benchmarks can also be run against the working tree with :code:`asv run --python=same --quick`.
+"""
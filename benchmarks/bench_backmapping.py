@@ -0,0 +1,51 @@
+"""Benchmarks for backmapping discrete trajectories to coordinates."""
+import numpy as np
+
+from synd.models.discrete.backmappers import TableBackmapper
+
+from benchmarks.common import make_coordinates, make_model
+
+
+class Backmap:
+    """
+    Backmapping a batch of trajectories, with the original callable backmapper and with a compiled lookup table.
+    """
+
+    params = (['callable', 'table'], [1000, 50000], [3, 300])
+    param_names = ['mapper', 'n_states', 'n_features']
+
+    n_walkers = 100
+    n_steps = 1000
+
+    def setup(self, mapper, n_states, n_features):
+
+        self.model = make_model(n_states, nnz_per_row=10, n_features=n_features)
+
+        if mapper == 'table':
+            self.model.compile_backmapper()
+
+        self.trajectories = np.random.default_rng(0).integers(0, n_states, size=(self.n_walkers, self.n_steps))
+
+    def time_backmap(self, mapper, n_states, n_features):
+        self.model.backmap(self.trajectories)
+
+    def peakmem_backmap(self, mapper, n_states, n_features):
+        self.model.backmap(self.trajectories)
+
+
+class CompileBackmapper:
+    """
+    One-time cost of compiling a callable backmapper into a lookup table.
+    """
+
+    params = ([1000, 50000], [3, 300])
+    param_names = ['n_states', 'n_features']
+
+    def setup(self, n_states, n_features):
+        self.backmapper = make_coordinates(n_states, n_features).__getitem__
+
+    def time_compile_backmapper(self, n_states, n_features):
+        TableBackmapper(self.backmapper, n_states)
+
+    def peakmem_compile_backmapper(self, n_states, n_features):
+        TableBackmapper(self.backmapper, n_states)
@@ -0,0 +1,82 @@
+"""Benchmarks for trajectory generation."""
+import numpy as np
+
+from benchmarks.common import make_model
+
+#: Largest model the dense argmin sampler is benchmarked on, since its memory scales with n_states**2
+MAX_DENSE_STATES = 5000
+
+
+class GenerateTrajectoryModelSize:
+    """
+    Generation across model sizes, sparsity and samplers, for a fixed batch of walkers and steps.
+    """
+
+    params = ([3, 1000, 50000], [10, 100], ['searchsorted', 'alias', 'argmin'])
+    param_names = ['n_states', 'nnz_per_row', 'sampler']
+
+    n_walkers = 1000
+    n_steps = 100
+
+    def setup(self, n_states, nnz_per_row, sampler):
+
+        if sampler == 'argmin' and n_states > MAX_DENSE_STATES:
+            raise NotImplementedError("Dense storage is too large for this model")
+
+        self.model = make_model(n_states, nnz_per_row, sampler)
+        self.initial_states = np.random.default_rng(0).integers(0, n_states, size=self.n_walkers)
+
+    def time_generate_trajectory(self, n_states, nnz_per_row, sampler):
+        self.model.generate_trajectory(self.initial_states, self.n_steps)
+
+    def peakmem_generate_trajectory(self, n_states, nnz_per_row, sampler):
+        self.model.generate_trajectory(self.initial_states, self.n_steps)
+
+
+class GenerateTrajectoryShape:
+    """
+    Generation across numbers of walkers and steps, for a fixed model.
+    """
+
+    params = ([10, 1000, 10000], [100, 1000, 10000])
+    param_names = ['n_walkers', 'n_steps']
+
+    n_states = 1000
+    nnz_per_row = 10
+
+    def setup(self, n_walkers, n_steps):
+
+        self.model = make_model(self.n_states, self.nnz_per_row)
+        self.initial_states = np.random.default_rng(0).integers(0, self.n_states, size=n_walkers)
+
+    def time_generate_trajectory(self, n_walkers, n_steps):
+        self.model.generate_trajectory(self.initial_states, n_steps)
+
+    def peakmem_generate_trajectory(self, n_walkers, n_steps):
+        self.model.generate_trajectory(self.initial_states, n_steps)
+
+    def time_iter_trajectory(self, n_walkers, n_steps):
+        for _ in self.model.iter_trajectory(self.initial_states, n_steps):
+            pass
+
+    def peakmem_iter_trajectory(self, n_walkers, n_steps):
+        for _ in self.model.iter_trajectory(self.initial_states, n_steps):
+            pass
+
+
+class BuildSampler:
+    """
+    One-time cost of building each sampler.
+    """
+
+    params = ([1000, 50000], [10, 100], ['searchsorted', 'alias'])
+    param_names = ['n_states', 'nnz_per_row', 'sampler']
+
+    def setup(self, n_states, nnz_per_row, sampler):
+        self.model = make_model(n_states, nnz_per_row, sampler)
+
+    def time_build_sampler(self, n_states, nnz_per_row, sampler):
+        self.model._build_sampler()
+
+    def peakmem_build_sampler(self, n_states, nnz_per_row, sampler):
+        self.model._build_sampler()
@@ -0,0 +1,49 @@
+"""Benchmarks for saving and loading models."""
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from synd.core import load_model
+
+from benchmarks.common import make_model
+
+
+class SaveLoad:
+    """
+    Round trips of a model through :code:`save` and :code:`load_model`, in each format.
+    """
+
+    params = (['binary', 'pickle'], [1000, 50000])
+    param_names = ['format', 'n_states']
+
+    def setup(self, format, n_states):
+
+        self.model = make_model(n_states, nnz_per_row=100)
+        self.model.compile_backmapper()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved_file = os.path.join(self.tmpdir, 'saved.synd')
+        self.model.save(self.saved_file, format=format)
+
+        self.outfile = os.path.join(self.tmpdir, 'model.synd')
+        self.initial_states = np.arange(100) % n_states
+
+    def teardown(self, format, n_states):
+        shutil.rmtree(self.tmpdir)
+
+    def time_save(self, format, n_states):
+        self.model.save(self.outfile, format=format)
+
+    def peakmem_save(self, format, n_states):
+        self.model.save(self.outfile, format=format)
+
+    def time_load(self, format, n_states):
+        load_model(self.saved_file)
+
+    def peakmem_load(self, format, n_states):
+        load_model(self.saved_file)
+
+    def time_load_and_generate(self, format, n_states):
+        # Memory-mapped models defer reading until the arrays are used, so include a first use
+        load_model(self.saved_file).generate_trajectory(self.initial_states, 10)
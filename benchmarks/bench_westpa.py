@@ -0,0 +1,86 @@
+"""Benchmarks for the WESTPA propagator, with WESTPA's run-time configuration mocked out."""
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+
+from benchmarks.common import make_coordinates, make_model
+
+try:
+    import mdtraj as md
+    import westpa
+    from westpa.core.segment import Segment
+    from synd.westpa.propagator import SynMDPropagator, SegmentStateIndex
+    from synd.westpa.instrumentation import Instrumentation
+except ImportError:
+    westpa = None
+
+
+def make_topology(n_atoms: int):
+    """
+    Build a reference structure of :code:`n_atoms` atoms, each in its own residue.
+    """
+
+    topology = md.Topology()
+    chain = topology.add_chain()
+    for _ in range(n_atoms):
+        residue = topology.add_residue('ALA', chain)
+        topology.add_atom('CA', md.element.carbon, residue)
+
+    return md.Trajectory(xyz=np.zeros((1, n_atoms, 3), dtype=np.float32), topology=topology)
+
+
+class Propagate:
+    """
+    A single iteration of :code:`SynMDPropagator.propagate`, with and without storing full-coordinate trajectories.
+    """
+
+    params = ([10, 100, 1000], [False, True])
+    param_names = ['n_segments', 'store_h5']
+
+    n_states = 1000
+    n_atoms = 300
+    pcoord_len = 50
+
+    def setup(self, n_segments, store_h5):
+
+        if westpa is None:
+            raise NotImplementedError("WESTPA isn't installed")
+
+        model = make_model(self.n_states, nnz_per_row=10)
+        model.add_backmapper(
+            make_coordinates(self.n_states, self.n_atoms * 3).reshape(self.n_states, self.n_atoms, 3).__getitem__,
+            'full_coordinates'
+        )
+
+        # Skip the constructor, which reads everything from the WESTPA configuration
+        self.propagator = SynMDPropagator.__new__(SynMDPropagator)
+        self.propagator.synd_model = model
+        self.propagator.topology = make_topology(self.n_atoms)
+        self.propagator.state_index = SegmentStateIndex()
+        self.propagator.auxref_indices = {}
+        self.propagator.instrumentation = Instrumentation()
+        self.propagator.coord_len = self.pcoord_len
+        self.propagator.save_stride = 1
+        self.propagator.coord_dtype = int
+
+        self.segments = [
+            Segment(n_iter=2, seg_id=seg_id, parent_id=seg_id, data={'parent_final_state_index': seg_id % self.n_states})
+            for seg_id in range(n_segments)
+        ]
+
+        self.patches = [
+            mock.patch.object(westpa.rc, 'get_data_manager', return_value=SimpleNamespace(store_h5=store_h5)),
+            mock.patch.object(westpa.rc, 'get_sim_manager', return_value=SimpleNamespace(n_iter=2)),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def teardown(self, n_segments, store_h5):
+        for patch in self.patches:
+            patch.stop()
+
+    def time_propagate(self, n_segments, store_h5):
+        self.propagator.propagate(self.segments)
+
+    def peakmem_propagate(self, n_segments, store_h5):
+        self.propagator.propagate(self.segments)
@@ -0,0 +1,60 @@
+"""Synthetic models shared by the benchmarks."""
+import numpy as np
+from scipy import sparse
+
+from synd.models.discrete.markov import MarkovGenerator
+
+#: Number of coordinates each state is backmapped to in the benchmark models
+N_FEATURES = 3
+
+
+def make_transition_matrix(n_states: int, nnz_per_row: int, seed: int = 0) -> sparse.csr_matrix:
+    """
+    Build a random, row-stochastic transition matrix with (up to) :code:`nnz_per_row` nonzero transitions per row.
+
+    Every state has a self-transition, so the chain is never stuck on an empty row.
+    """
+
+    rng = np.random.default_rng(seed)
+    nnz_per_row = min(nnz_per_row, n_states)
+
+    rows = np.repeat(np.arange(n_states), nnz_per_row)
+    columns = rng.integers(0, n_states, size=n_states * nnz_per_row)
+    columns[::nnz_per_row] = np.arange(n_states)
+
+    transition_matrix = sparse.csr_matrix(
+        (rng.random(n_states * nnz_per_row), (rows, columns)), shape=(n_states, n_states)
+    )
+
+    row_sums = np.asarray(transition_matrix.sum(axis=1)).ravel()
+    return sparse.csr_matrix(sparse.diags(1.0 / row_sums) @ transition_matrix)
+
+
+def make_coordinates(n_states: int, n_features: int = N_FEATURES, seed: int = 0) -> np.ndarray:
+    """
+    Build random coordinates for each state, of shape (n_states, n_features).
+    """
+
+    return np.random.default_rng(seed).random((n_states, n_features))
+
+
+def make_model(n_states: int,
+               nnz_per_row: int,
+               sampler: str = 'searchsorted',
+               n_features: int = N_FEATURES,
+               seed: int = 0) -> MarkovGenerator:
+    """
+    Build a Markov generator on a random transition matrix, with a callable backmapper to random coordinates.
+
+    The argmin sampler is built on dense storage, and all others on sparse storage.
+    """
+
+    coordinates = make_coordinates(n_states, n_features, seed)
+
+    return MarkovGenerator(
+        transition_matrix=make_transition_matrix(n_states, nnz_per_row, seed),
+        backmapper=coordinates.__getitem__,
+        seed=seed,
+        sparse_storage=sampler != 'argmin',
+        sampler=sampler,
+    )
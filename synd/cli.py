@@ -1,14 +1,251 @@
 """Console script for synd."""
 import sys
+import os
+import time
 import click
+import numpy as np
 
+from synd.core import load_model
+from synd.models.discrete.markov import DEFAULT_CHUNK_STEPS
 
-@click.command()
+#: Largest chunk of an HDF5 output dataset, well under HDF5's 4 GB limit
+MAX_HDF5_CHUNK_BYTES = 256 * 1024 ** 2
+
+
+def parse_initial_states(initial_states: str) -> np.ndarray:
+    """
+    Parse initial states given on the command line.
+
+    Parameters
+    ----------
+    initial_states :
+        Either a comma-separated list of discrete states, or the path to a .npy or text file of discrete states
+
+    Returns
+    -------
+    Array of initial discrete states
+    """
+
+    if os.path.exists(initial_states):
+        if initial_states.endswith('.npy'):
+            return np.load(initial_states).astype(int).ravel()
+        return np.loadtxt(initial_states, dtype=int, ndmin=1)
+
+    try:
+        return np.array([int(state) for state in initial_states.split(',')], dtype=int)
+    except ValueError:
+        raise click.BadParameter(
+            f"{initial_states} is neither a file nor a comma-separated list of states", param_hint='--initial-states'
+        )
+
+
+class NpyTrajectoryWriter:
+    """
+    Writes blocks of steps into preallocated .npy files, memory-mapped so they're never fully held in memory.
+
+    Discrete trajectories are written to the output file, and backmapped coordinates (if any) to a sibling file
+    with a :code:`_coordinates` suffix.
+    """
+
+    def __init__(self, outfile: str, n_walkers: int, n_steps: int, dtype=int, feature_shape: tuple = None,
+                 feature_dtype=None, chunk_steps: int = DEFAULT_CHUNK_STEPS):
+
+        # .npy files aren't chunked, so chunk_steps is only accepted for a common writer signature
+        self.trajectories = np.lib.format.open_memmap(outfile, mode='w+', dtype=dtype, shape=(n_walkers, n_steps))
+
+        self.coordinates = None
+        if feature_shape is not None:
+            coordinate_file = f"{os.path.splitext(outfile)[0]}_coordinates.npy"
+            self.coordinates = np.lib.format.open_memmap(
+                coordinate_file, mode='w+', dtype=feature_dtype, shape=(n_walkers, n_steps, *feature_shape)
+            )
+
+    def write(self, start: int, trajectories: np.ndarray, coordinates: np.ndarray = None):
+
+        stop = start + trajectories.shape[1]
+
+        self.trajectories[:, start:stop] = trajectories
+        self.trajectories.flush()
+
+        if coordinates is not None:
+            self.coordinates[:, start:stop] = coordinates
+            self.coordinates.flush()
+
+    def close(self):
+
+        del self.trajectories
+        del self.coordinates
+
+
+class HDF5TrajectoryWriter:
+    """
+    Writes blocks of steps into chunked datasets of an HDF5 file.
+
+    Discrete trajectories are written to the :code:`trajectories` dataset, and backmapped coordinates (if any) to
+    the :code:`coordinates` dataset.
+    """
+
+    def __init__(self, outfile: str, n_walkers: int, n_steps: int, dtype=int, feature_shape: tuple = None,
+                 feature_dtype=None, chunk_steps: int = DEFAULT_CHUNK_STEPS):
+
+        import h5py
+
+        self.h5file = h5py.File(outfile, 'w')
+
+        self.trajectories = self.h5file.create_dataset(
+            'trajectories', shape=(n_walkers, n_steps), dtype=dtype,
+            chunks=self.chunk_shape(n_walkers, n_steps, chunk_steps, (), dtype)
+        )
+
+        self.coordinates = None
+        if feature_shape is not None:
+            self.coordinates = self.h5file.create_dataset(
+                'coordinates', shape=(n_walkers, n_steps, *feature_shape), dtype=feature_dtype,
+                chunks=self.chunk_shape(n_walkers, n_steps, chunk_steps, feature_shape, feature_dtype)
+            )
+
+    @staticmethod
+    def chunk_shape(n_walkers: int, n_steps: int, chunk_steps: int, feature_shape: tuple, dtype) -> tuple:
+        """
+        Get the HDF5 chunk shape for a dataset of shape (n_walkers, n_steps, *feature_shape).
+
+        Chunks hold every walker over :code:`chunk_steps` steps, so each written block fills whole chunks. HDF5 limits
+        chunks to 4 GB, so chunks are shrunk to at most :code:`MAX_HDF5_CHUNK_BYTES`, first along steps, and then
+        along walkers.
+        """
+
+        frame_bytes = max(int(np.prod(feature_shape, dtype=np.int64)) * np.dtype(dtype).itemsize, 1)
+
+        chunk_steps = max(min(chunk_steps, n_steps, MAX_HDF5_CHUNK_BYTES // (n_walkers * frame_bytes)), 1)
+        chunk_walkers = max(min(n_walkers, MAX_HDF5_CHUNK_BYTES // (chunk_steps * frame_bytes)), 1)
+
+        return (chunk_walkers, chunk_steps, *feature_shape)
+
+    def write(self, start: int, trajectories: np.ndarray, coordinates: np.ndarray = None):
+
+        stop = start + trajectories.shape[1]
+
+        self.trajectories[:, start:stop] = trajectories
+
+        if coordinates is not None:
+            self.coordinates[:, start:stop] = coordinates
+
+        self.h5file.flush()
+
+    def close(self):
+
+        self.h5file.close()
+
+
+#: Trajectory writers, by output file extension
+TRAJECTORY_WRITERS = {
+    '.npy': NpyTrajectoryWriter,
+    '.h5': HDF5TrajectoryWriter,
+    '.hdf5': HDF5TrajectoryWriter,
+}
+
+
+@click.group()
 def main(args=None):
     """Console script for synd."""
-    click.echo("Replace this message by putting your code into "
-               "synd.cli.main")
-    click.echo("See click documentation at https://click.palletsprojects.com/")
+    return 0
+
+
+@main.command()
+@click.argument('model_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--initial-states', '-i', required=True,
+              help='Comma-separated initial discrete states, or a .npy or text file of them, one per walker.')
+@click.option('--n-steps', '-n', required=True, type=click.IntRange(min=1),
+              help='Number of steps in each trajectory, including the initial state.')
+@click.option('--out', '-o', 'outfile', required=True, type=click.Path(dir_okay=False),
+              help=f'Output file. The format is chosen by the extension, one of {", ".join(TRAJECTORY_WRITERS)}.')
+@click.option('--workers', '-w', 'n_workers', default=1, show_default=True, type=click.IntRange(min=1),
+              help='Number of worker processes to generate with.')
+@click.option('--chunk', '-c', 'chunk_steps', default=DEFAULT_CHUNK_STEPS, show_default=True,
+              type=click.IntRange(min=1), help='Number of steps generated and written at a time.')
+@click.option('--seed', type=int, default=None, help='Seed for the random number generator.')
+@click.option('--backmap', 'mapper', default=None,
+              help='Also write full coordinates, using the backmapper with this name (e.g. "default").')
+def generate(model_file, initial_states, n_steps, outfile, n_workers, chunk_steps, seed, mapper):
+    """
+    Generate trajectories from a saved SynD model, streaming them to disk.
+
+    Trajectories are generated and written a chunk of steps at a time, so memory use is bounded by the chunk size
+    rather than the total number of steps.
+    """
+
+    extension = os.path.splitext(outfile)[1]
+    if extension not in TRAJECTORY_WRITERS:
+        raise click.BadParameter(
+            f"Unknown output format {extension}, must be one of {', '.join(TRAJECTORY_WRITERS)}", param_hint='--out'
+        )
+
+    model = load_model(model_file)
+    initial_states = parse_initial_states(initial_states)
+    try:
+        model.validate_initial_states(initial_states)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint='--initial-states')
+    n_walkers = initial_states.shape[0]
+
+    feature_shape, feature_dtype = None, None
+    if mapper is not None:
+        if mapper not in model._backmappers:
+            raise click.BadParameter(
+                f"Unknown backmapper {mapper}, must be one of {', '.join(model._backmappers)}", param_hint='--backmap'
+            )
+
+        example_coordinates = np.asarray(model.backmap(initial_states[:1], mapper))
+        feature_shape, feature_dtype = example_coordinates.shape[1:], example_coordinates.dtype
+
+    writer = TRAJECTORY_WRITERS[extension](
+        outfile, n_walkers, n_steps, model.trajectory_dtype, feature_shape, feature_dtype, chunk_steps=chunk_steps
+    )
+
+    # Each chunk draws from its own stream, spawned from the root seed
+    seed_sequence = np.random.SeedSequence(seed)
+
+    start_time = time.perf_counter()
+
+    # Every chunk after the first also holds the last step of the previous chunk
+    max_chunk_steps = min(chunk_steps + 1, n_steps)
+
+    try:
+        # The pool, and the sampler in shared memory, are set up once and reused for every chunk
+        with model.parallel_pool(n_walkers, max_chunk_steps, n_workers=n_workers) as pool:
+
+            current_states = initial_states
+            first_step = 0
+
+            while first_step < n_steps:
+
+                chunk_length = min(chunk_steps, n_steps - first_step)
+
+                # Every chunk after the first starts from the last state of the previous chunk, which was already
+                #   written
+                n_chunk_steps = chunk_length if first_step == 0 else chunk_length + 1
+                trajectories = pool.generate(current_states, n_chunk_steps, seed=seed_sequence.spawn(1)[0])
+                if first_step > 0:
+                    trajectories = trajectories[:, 1:]
+
+                coordinates = model.backmap(trajectories, mapper) if mapper is not None else None
+
+                writer.write(first_step, trajectories, coordinates)
+
+                current_states = trajectories[:, -1]
+                first_step += chunk_length
+
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - start_time
+    n_total_steps = n_walkers * (n_steps - 1)
+
+    click.echo(
+        f"Generated {n_walkers} trajectories of {n_steps} steps in {elapsed:.2f} s "
+        f"({n_total_steps / max(elapsed, 1e-9):.4g} steps/s), written to {outfile}"
+    )
+
     return 0
 
 
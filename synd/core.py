@@ -1,21 +1,29 @@
 """Functions for interacting with SynD models."""
 import pickle
+from synd.serialization import is_binary_model, read_binary_model
 
 
-def load_model(filename: str):
+def load_model(filename: str, mmap_mode: str = 'r'):
     """
     Load a SynD model from a file.
 
+    Both binary model files (see :code:`synd.serialization`) and pickled models are supported.
+
     Parameters
     ----------
     filename
         Path to SynD model file
+    mmap_mode
+        For binary model files, the mode to memory-map arrays with. If None, arrays are read into memory.
 
     Returns
     -------
         SynD model
     """
 
+    if is_binary_model(filename):
+        return read_binary_model(filename, mmap_mode=mmap_mode)
+
     with open(filename, 'rb') as infile:
         model = pickle.load(infile)
 
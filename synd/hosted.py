@@ -1,27 +1,477 @@
 """Store/retrieve SynD models from an S3 host."""
 import minio
 from synd.models.base import BaseSynDModel
-from io import BytesIO
+from synd.core import load_model
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import deque
+import functools
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
 
 MODEL_HOST = "minios.jdrusso.dev"
 MODEL_BUCKET = "models"
 
+#: Default directory for caching downloaded models. Can be overridden with the SYND_CACHE_DIR environment variable.
+DEFAULT_CACHE_DIR = os.environ.get(
+    'SYND_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'synd', 'models')
+)
+
+#: Default maximum total size of cached models, in bytes
+DEFAULT_MAX_CACHE_SIZE = 10 * 1024 ** 3
+
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 ** 2
+
+#: Default size of each part in multipart uploads and ranged downloads, in bytes
+DEFAULT_PART_SIZE = 64 * 1024 ** 2
+
+#: Default number of threads for multipart uploads and ranged downloads
+DEFAULT_TRANSFER_THREADS = 4
+
+#: Magic bytes identifying each supported compression format at the start of an object
+COMPRESSION_MAGIC = {
+    'zstd': b'\x28\xb5\x2f\xfd',
+    'lz4': b'\x04\x22\x4d\x18',
+    'gzip': b'\x1f\x8b',
+}
+
+#: Compression used for uploads by default -- zstd if it's installed, otherwise gzip
+DEFAULT_COMPRESSION = 'zstd' if zstandard is not None else 'gzip'
+
+CACHE_SUFFIX = '.synd'
+
+#: Suffix of models partially downloaded into the cache
+PARTIAL_SUFFIX = '.part'
+
+#: Seconds since a partial download was last written to, after which it's assumed to be left by an interrupted
+#: download, and is removed from the cache
+STALE_PART_AGE = 60 * 60
+
 
 def make_minio_client(access_key: str, secret_key: str, model_host: str = MODEL_HOST, **client_kwargs) -> minio.Minio:
     client = minio.Minio(model_host, access_key=access_key, secret_key=secret_key, **client_kwargs)
     return client
 
 
-def download_model(identifier: str, client: minio.Minio, bucket: str = MODEL_BUCKET) -> BaseSynDModel:
+@contextmanager
+def _file_lock(lock_path: str, blocking: bool = True):
+    """
+    Hold an exclusive lock on a lock file, so concurrent local processes take turns.
+
+    The lock file is removed before the lock is released, so lock files don't accumulate. A process that was waiting
+    on a lock file that's since been removed retries with a new one.
+
+    Yields whether the lock was acquired, which is always True when :code:`blocking`. Otherwise, it's False if another
+    process holds the lock.
+    """
+
+    if fcntl is None:
+        yield True
+        return
+
+    while True:
+        lock_file = open(lock_path, 'a')
+
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            yield False
+            return
+
+        # If the lock file was removed while we waited, another process may already hold a lock on a new one
+        try:
+            if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(lock_path)):
+                break
+        except FileNotFoundError:
+            pass
+
+        lock_file.close()
+
+    try:
+        yield True
+    finally:
+        _remove_if_exists(lock_path)
+
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def _check_compression(compression: str):
+    """
+    Check that a compression is known, and that the package it needs is installed.
+    """
+
+    if compression is None:
+        return
+
+    if compression not in COMPRESSION_MAGIC:
+        raise ValueError(f"Unknown compression {compression}, must be one of {list(COMPRESSION_MAGIC.keys())} or None")
+
+    if compression == 'zstd' and zstandard is None:
+        raise ImportError("zstd compression requires the zstandard package")
+
+    if compression == 'lz4' and lz4 is None:
+        raise ImportError("lz4 compression requires the lz4 package")
+
+
+@contextmanager
+def _compressing_writer(outfile, compression: str, compression_level: int = None):
+    """
+    Wrap a writable binary file object in a streaming compressor. The underlying file object is left open.
+    """
+
+    _check_compression(compression)
+
+    if compression is None:
+        yield outfile
+
+    elif compression == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=compression_level or 3)
+        with compressor.stream_writer(outfile, closefd=False) as writer:
+            yield writer
+
+    elif compression == 'lz4':
+        with lz4.frame.LZ4FrameFile(outfile, mode='wb', compression_level=compression_level or 0) as writer:
+            yield writer
+
+    elif compression == 'gzip':
+        with gzip.GzipFile(fileobj=outfile, mode='wb', compresslevel=compression_level or 6) as writer:
+            yield writer
+
+
+@contextmanager
+def _decompressing_reader(infile: io.BufferedReader):
+    """
+    Wrap a buffered, readable binary file object in a streaming decompressor, detecting the compression from its first
+    bytes. Uncompressed files are read as-is.
+
+    The first bytes are peeked at rather than read, so the file object doesn't need to be seekable.
+    """
+
+    start = infile.peek(4)[:4]
+
+    compression = None
+    for _compression, magic in COMPRESSION_MAGIC.items():
+        if start.startswith(magic):
+            compression = _compression
+
+    _check_compression(compression)
+
+    if compression is None:
+        yield infile
+
+    elif compression == 'zstd':
+        with zstandard.ZstdDecompressor().stream_reader(infile, closefd=False) as reader:
+            yield reader
+
+    elif compression == 'lz4':
+        with lz4.frame.LZ4FrameFile(infile, mode='rb') as reader:
+            yield reader
+
+    elif compression == 'gzip':
+        with gzip.GzipFile(fileobj=infile, mode='rb') as reader:
+            yield reader
+
+
+def _download_part(client: minio.Minio, bucket: str, identifier: str, offset: int, length: int) -> bytes:
+    """
+    Download a byte range of an object.
+    """
+
+    response = client.get_object(bucket, identifier, offset=offset, length=length)
+    try:
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
+
+
+class _ObjectReader(io.RawIOBase):
+    """
+    Readable stream over an object on the host, fetching byte ranges of it in parallel, ahead of the reader.
+
+    At most :code:`n_threads` parts are fetched ahead of the one being read, so memory use is bounded by
+    :code:`(n_threads + 1) * part_size`, whatever the size of the object.
+    """
+
+    def __init__(self,
+                 client: minio.Minio,
+                 bucket: str,
+                 identifier: str,
+                 size: int,
+                 part_size: int = DEFAULT_PART_SIZE,
+                 n_threads: int = DEFAULT_TRANSFER_THREADS):
+
+        super().__init__()
+
+        self._fetch_part = functools.partial(_download_part, client, bucket, identifier)
+        self._parts = ((offset, min(part_size, size - offset)) for offset in range(0, size, part_size))
+
+        self._executor = ThreadPoolExecutor(max_workers=n_threads)
+        self._pending = deque()
+        self._current = memoryview(b'')
 
-    model = client.get_object(bucket, identifier)
+        for _ in range(n_threads):
+            self._fetch_next_part()
+
+    def _fetch_next_part(self):
+
+        part = next(self._parts, None)
+        if part is not None:
+            self._pending.append(self._executor.submit(self._fetch_part, *part))
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+
+        while len(self._current) == 0:
+            if not self._pending:
+                return 0
+
+            self._current = memoryview(self._pending.popleft().result())
+            self._fetch_next_part()
+
+        n_bytes = min(len(buffer), len(self._current))
+        buffer[:n_bytes] = self._current[:n_bytes]
+        self._current = self._current[n_bytes:]
+
+        return n_bytes
+
+    def close(self):
+
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+
+        super().close()
+
+
+def get_cache_path(identifier: str, etag: str, bucket: str = MODEL_BUCKET, cache_dir: str = DEFAULT_CACHE_DIR) -> str:
+    """
+    Get the path a model is cached at.
+
+    Cached models are keyed by bucket, identifier, and ETag, so a model that changes on the host is downloaded again.
+    """
+
+    key = hashlib.sha256(f"{bucket}/{identifier}/{etag}".encode('utf-8')).hexdigest()
+
+    return os.path.join(cache_dir, key + CACHE_SUFFIX)
+
+
+def evict_cache(cache_dir: str = DEFAULT_CACHE_DIR, max_cache_size: int = DEFAULT_MAX_CACHE_SIZE, keep: str = None):
+    """
+    Remove least recently used models from the cache, until its total size is at most :code:`max_cache_size`.
+
+    Models that another process is downloading or loading (i.e. holds the lock for) are skipped. Partial downloads
+    count towards the size of the cache, and any left behind by interrupted downloads, i.e. that haven't been
+    written to in :code:`STALE_PART_AGE` seconds, are removed.
+
+    Parameters
+    ----------
+    cache_dir :
+        The model cache directory
+    max_cache_size :
+        Maximum total size of cached models, in bytes
+    keep :
+        Path of a cached model to never evict. The caller must hold its lock.
+    """
+
+    now = time.time()
+
+    cached = []
+    total_size = 0
+
+    for filename in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, filename)
+
+        if not filename.endswith((CACHE_SUFFIX, PARTIAL_SUFFIX)):
+            continue
+
+        # Other processes may remove files as we go
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+
+        if filename.endswith(PARTIAL_SUFFIX):
+            if now - stat.st_mtime > STALE_PART_AGE:
+                _remove_if_exists(path)
+            else:
+                total_size += stat.st_size
+
+        else:
+            cached.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+
+    for _, size, path in sorted(cached):
+        if total_size <= max_cache_size:
+            break
+
+        if path == keep:
+            continue
+
+        # A model that another process is downloading or loading stays, and its lock file is removed with it otherwise
+        with _file_lock(path + '.lock', blocking=False) as acquired:
+            if not acquired:
+                continue
+
+            # Already-loaded, memory-mapped models stay valid after their file is removed
+            _remove_if_exists(path)
+            total_size -= size
+
+
+def _remove_if_exists(path: str):
+    """
+    Remove a file, if it hasn't been already.
+    """
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def download_model(identifier: str,
+                   client: minio.Minio,
+                   bucket: str = MODEL_BUCKET,
+                   cache_dir: str = DEFAULT_CACHE_DIR,
+                   max_cache_size: int = DEFAULT_MAX_CACHE_SIZE,
+                   part_size: int = DEFAULT_PART_SIZE,
+                   n_threads: int = DEFAULT_TRANSFER_THREADS) -> BaseSynDModel:
+    """
+    Download a model from the host, and load it.
+
+    The model is fetched as byte ranges in parallel, and decompressed as a stream straight into the cache, so it's
+    never fully held in memory, and the compressed model is never written to disk.
+
+    Models are cached locally, keyed by bucket, identifier, and ETag, and only downloaded if the host's copy isn't
+    already cached. Concurrent local processes downloading the same model wait for one download. Once the cache
+    grows beyond :code:`max_cache_size`, the least recently used models are evicted.
+
+    Parameters
+    ----------
+    identifier :
+        Name of the model on the host
+    client :
+        Client connected to the host
+    bucket :
+        Bucket the model is stored in
+    cache_dir :
+        Directory to cache downloaded models in
+    max_cache_size :
+        Maximum total size of cached models, in bytes
+    part_size :
+        Size of each byte range downloaded, in bytes
+    n_threads :
+        Number of byte ranges to download in parallel
+
+    Returns
+    -------
+    The loaded model, memory-mapped if it's stored in the binary model format
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    stat = client.stat_object(bucket, identifier)
+    cache_path = get_cache_path(identifier, stat.etag, bucket=bucket, cache_dir=cache_dir)
+
+    with _file_lock(cache_path + '.lock'):
+
+        if os.path.exists(cache_path):
+            # Mark this as recently used
+            os.utime(cache_path)
+
+        else:
+            # Byte ranges are decompressed as they arrive, straight into a temporary file, which is moved into place
+            #   once it's complete. Only the decompressed model is ever on disk, and a partial download is never cached.
+            decompressed = tempfile.NamedTemporaryFile(dir=cache_dir, suffix=PARTIAL_SUFFIX, delete=False)
+
+            try:
+                with decompressed, \
+                        io.BufferedReader(
+                            _ObjectReader(client, bucket, identifier, stat.size, part_size, n_threads),
+                            buffer_size=DOWNLOAD_CHUNK_SIZE
+                        ) as infile, \
+                        _decompressing_reader(infile) as reader:
+                    shutil.copyfileobj(reader, decompressed, DOWNLOAD_CHUNK_SIZE)
+
+                os.replace(decompressed.name, cache_path)
+
+            finally:
+                _remove_if_exists(decompressed.name)
+
+            evict_cache(cache_dir, max_cache_size, keep=cache_path)
+
+        model = load_model(cache_path)
 
     return model
 
 
-def upload_model(model, identifier: str, client: minio.Minio, bucket: str = MODEL_BUCKET):
+def upload_model(model,
+                 identifier: str,
+                 client: minio.Minio,
+                 bucket: str = MODEL_BUCKET,
+                 compression: str = DEFAULT_COMPRESSION,
+                 compression_level: int = None,
+                 part_size: int = DEFAULT_PART_SIZE,
+                 n_threads: int = DEFAULT_TRANSFER_THREADS):
+    """
+    Compress a model and upload it to the host.
+
+    The model is streamed through the compressor into a temporary file, so it's never fully held in memory, and then
+    uploaded in parts in parallel.
+
+    Parameters
+    ----------
+    model :
+        The SynD model to upload
+    identifier :
+        Name to store the model under on the host
+    client :
+        Client connected to the host
+    bucket :
+        Bucket to store the model in
+    compression :
+        Compression to use, one of :code:`'zstd'`, :code:`'lz4'`, :code:`'gzip'`, or None
+    compression_level :
+        Compression level, or None for the compressor's default
+    part_size :
+        Size of each uploaded part, in bytes
+    n_threads :
+        Number of parts to upload in parallel
+    """
+
+    with tempfile.TemporaryFile() as staged:
+
+        with _compressing_writer(staged, compression, compression_level) as writer:
+            model.save(writer)
 
-    serialized = model.serialize()
+        length = staged.tell()
+        staged.seek(0)
 
-    with BytesIO(serialized) as serialized_bytes:
-        client.put_object(bucket, identifier, data=serialized_bytes, length=len(serialized))
+        client.put_object(
+            bucket, identifier, data=staged, length=length, part_size=part_size, num_parallel_uploads=n_threads
+        )
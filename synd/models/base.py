@@ -3,6 +3,9 @@ from abc import ABC
 import logging
 from rich.logging import RichHandler
 import pickle
+import os
+from typing import BinaryIO, Union
+from synd.serialization import atomic_write, write_binary_model
 
 logger = logging.getLogger(__name__)
 
@@ -33,15 +36,33 @@ class BaseSynDModel(ABC):
 
         return pickle.dumps(self)
 
-    def save(self, outfile: str):
+    def save(self, outfile: Union[str, BinaryIO], format: str = None):
         """
         Saves a SynD model to a file on disk.
 
         Parameters
         ----------
         outfile :
-            Name of the file to save the model to.
+            Name of the file to save the model to, or a writable binary file object to stream it to.
+        format :
+            Either :code:`'binary'`, for the memory-mappable format described in :code:`synd.serialization`, or
+            :code:`'pickle'`. By default, models that support the binary format are saved in it, and others are
+            pickled.
         """
 
-        with open(outfile, 'wb') as of:
-            pickle.dump(self, of)
+        if format is None:
+            format = 'binary' if hasattr(self, '_get_binary_state') else 'pickle'
+
+        if format == 'binary':
+            write_binary_model(self, outfile)
+
+        elif format == 'pickle':
+            if not isinstance(outfile, (str, os.PathLike)):
+                pickle.dump(self, outfile)
+                return
+
+            with atomic_write(outfile) as of:
+                pickle.dump(self, of)
+
+        else:
+            raise ValueError(f"Unknown model format {format}, must be one of 'binary' or 'pickle'")
@@ -0,0 +1,304 @@
+"""Accumulators that reduce trajectories to statistics as they're generated, without storing them."""
+from abc import ABC, abstractmethod
+import numpy as np
+from numpy.typing import ArrayLike
+from scipy import sparse
+from typing import Callable
+
+#: Largest number of (from, to) state pairs that :code:`TransitionCounts` counts into a dense array
+MAX_DENSE_TRANSITION_PAIRS = 2 ** 24
+
+#: Smallest number of transitions in a block, as a fraction of the number of state pairs, for which
+#: :code:`TransitionCounts` counts with a full :code:`np.bincount`, rather than only over the pairs seen
+MIN_BINCOUNT_FRACTION = 1 / 16
+
+
+class BaseAccumulator(ABC):
+    """
+    Abstract base class for streaming accumulators.
+
+    An accumulator is updated with each block of steps of a set of trajectories as they're generated, in order, and
+    keeps only the aggregate it's computing.
+    """
+
+    @abstractmethod
+    def update(self, model, block: np.ndarray, start_step: int, previous_states: np.ndarray = None):
+        """
+        Update the aggregate with the next block of steps.
+
+        Parameters
+        ----------
+        model :
+            The model generating the trajectories
+        block :
+            Array of discrete states of shape (n_walkers, n_block_steps). This may be a reused buffer, so it must not
+            be kept.
+        start_step :
+            The step of the trajectories the first column of the block corresponds to
+        previous_states :
+            The state of each walker at the step before the block, or None for the first block
+        """
+        pass
+
+    @abstractmethod
+    def result(self):
+        """
+        Get the aggregate accumulated so far.
+        """
+        pass
+
+
+class StateCounts(BaseAccumulator):
+    """
+    Counts the number of times each state is visited, over all walkers and steps.
+    """
+
+    def __init__(self, n_states: int):
+
+        self.counts = np.zeros(n_states, dtype=np.int64)
+
+    def update(self, model, block, start_step, previous_states=None):
+
+        self.counts += np.bincount(block.ravel(), minlength=self.counts.shape[0])
+
+    def result(self) -> np.ndarray:
+        """
+        Returns
+        -------
+        Array of the number of visits to each state
+        """
+
+        return self.counts
+
+
+class TransitionCounts(BaseAccumulator):
+    """
+    Counts transitions between each pair of states, including those between blocks.
+
+    Each transition (i, j) is encoded as :code:`i * n_states + j`. Blocks with at least :code:`MIN_BINCOUNT_FRACTION`
+    as many transitions as there are pairs of states are counted with a single :code:`np.bincount`. Smaller blocks
+    only count the pairs they contain, so the cost of a block doesn't scale with :code:`n_states ** 2`. For models
+    with more than :code:`MAX_DENSE_TRANSITION_PAIRS` pairs of states, counts are kept in a sparse matrix.
+    """
+
+    def __init__(self, n_states: int, dense: bool = None):
+        """
+        Parameters
+        ----------
+        n_states :
+            Number of states in the model
+        dense :
+            Whether to count into a dense array. Defaults to True if there are at most
+            :code:`MAX_DENSE_TRANSITION_PAIRS` pairs of states.
+        """
+
+        self.n_states = n_states
+        self.dense = n_states ** 2 <= MAX_DENSE_TRANSITION_PAIRS if dense is None else dense
+
+        if self.dense:
+            self.counts = np.zeros(n_states ** 2, dtype=np.int64)
+        else:
+            self.counts = sparse.csr_matrix((n_states, n_states), dtype=np.int64)
+
+    def update(self, model, block, start_step, previous_states=None):
+
+        if previous_states is not None:
+            from_states = np.concatenate([previous_states[:, np.newaxis], block[:, :-1]], axis=1)
+            to_states = block
+        else:
+            from_states = block[:, :-1]
+            to_states = block[:, 1:]
+
+        # Trajectories may be stored in small unsigned types, so widen before encoding pairs
+        pairs = (from_states.astype(np.int64) * self.n_states + to_states).ravel()
+
+        if self.dense and pairs.shape[0] >= MIN_BINCOUNT_FRACTION * self.counts.shape[0]:
+            self.counts += np.bincount(pairs, minlength=self.counts.shape[0])
+            return
+
+        pairs, pair_counts = np.unique(pairs, return_counts=True)
+
+        if self.dense:
+            self.counts[pairs] += pair_counts
+
+        else:
+            self.counts = self.counts + sparse.csr_matrix(
+                (pair_counts, np.divmod(pairs, self.n_states)), shape=(self.n_states, self.n_states)
+            )
+
+    def result(self) -> sparse.csr_matrix:
+        """
+        Returns
+        -------
+        Sparse matrix of the number of transitions from each state (row) to each state (column)
+        """
+
+        if self.dense:
+            return sparse.csr_matrix(self.counts.reshape(self.n_states, self.n_states))
+
+        return self.counts
+
+
+class FirstHittingTimes(BaseAccumulator):
+    """
+    Records the first step at which each walker reaches a set of target states.
+    """
+
+    def __init__(self, target_states: ArrayLike, n_states: int):
+
+        self.is_target = np.zeros(n_states, dtype=bool)
+        self.is_target[target_states] = True
+
+        self.first_hitting_times = None
+
+    def update(self, model, block, start_step, previous_states=None):
+
+        if self.first_hitting_times is None:
+            self.first_hitting_times = np.full(block.shape[0], fill_value=-1, dtype=np.int64)
+
+        # Only walkers that haven't hit yet need to be checked
+        waiting = np.flatnonzero(self.first_hitting_times < 0)
+        in_target = self.is_target[block[waiting]]
+
+        hit = in_target.any(axis=1)
+        self.first_hitting_times[waiting[hit]] = start_step + np.argmax(in_target[hit], axis=1)
+
+    def result(self) -> np.ndarray:
+        """
+        Returns
+        -------
+        Histogram of first hitting times, where element t is the number of walkers that first hit the target at step t.
+        Walkers that never hit the target aren't counted.
+        """
+
+        if self.first_hitting_times is None:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.bincount(self.first_hitting_times[self.first_hitting_times >= 0])
+
+
+class _StateWeightedAccumulator(BaseAccumulator):
+    """
+    Base class for accumulators of backmapped observables.
+
+    Rather than backmapping every step, each block is reduced to the number of visits to each distinct state, and only
+    those states are backmapped.
+    """
+
+    def __init__(self, mapper: str = 'default', observable: Callable[[np.ndarray], np.ndarray] = None):
+
+        self.mapper = mapper
+        self.observable = observable
+
+    def _get_weighted_values(self, model, block):
+        """
+        Get the observable for each distinct state in a block, and the number of times it was visited.
+        """
+
+        states, counts = np.unique(block, return_counts=True)
+        values = np.asarray(model.backmap(states, self.mapper))
+
+        if self.observable is not None:
+            values = np.asarray(self.observable(values))
+
+        return values, counts
+
+
+class ObservableHistogram(_StateWeightedAccumulator):
+    """
+    Accumulates a histogram of a backmapped observable, over all walkers and steps.
+    """
+
+    def __init__(self,
+                 bins: ArrayLike,
+                 mapper: str = 'default',
+                 observable: Callable[[np.ndarray], np.ndarray] = None):
+        """
+        Parameters
+        ----------
+        bins :
+            Bin edges
+        mapper :
+            Name of the backmapper to use
+        observable :
+            Optional function of an array of backmapped coordinates, returning a scalar for each. If not given, the
+            backmapped coordinates must be scalars.
+        """
+
+        super().__init__(mapper, observable)
+
+        self.bins = np.asarray(bins)
+        self.counts = np.zeros(len(self.bins) - 1, dtype=np.int64)
+
+    def update(self, model, block, start_step, previous_states=None):
+
+        values, counts = self._get_weighted_values(model, block)
+        self.counts += np.histogram(values.reshape(counts.shape[0]), bins=self.bins, weights=counts)[0].astype(np.int64)
+
+    def result(self) -> np.ndarray:
+        """
+        Returns
+        -------
+        Array of the number of steps in each bin
+        """
+
+        return self.counts
+
+
+class ObservableMean(_StateWeightedAccumulator):
+    """
+    Accumulates the running mean and variance of a backmapped observable, over all walkers and steps.
+
+    Blocks are combined with Chan et al.'s parallel update, so the variance stays accurate over very many steps.
+    """
+
+    def __init__(self, mapper: str = 'default', observable: Callable[[np.ndarray], np.ndarray] = None):
+        """
+        Parameters
+        ----------
+        mapper :
+            Name of the backmapper to use
+        observable :
+            Optional function of an array of backmapped coordinates, returning an observable for each
+        """
+
+        super().__init__(mapper, observable)
+
+        self.n_samples = 0
+        self.mean = 0.0
+        self.sum_squared_deviations = 0.0
+
+    def update(self, model, block, start_step, previous_states=None):
+
+        values, counts = self._get_weighted_values(model, block)
+        weights = counts.reshape(-1, *([1] * (values.ndim - 1)))
+
+        n_block = counts.sum()
+        block_mean = (weights * values).sum(axis=0) / n_block
+        block_sum_squared_deviations = (weights * (values - block_mean) ** 2).sum(axis=0)
+
+        n_total = self.n_samples + n_block
+        delta = block_mean - self.mean
+
+        self.mean = self.mean + delta * n_block / n_total
+        self.sum_squared_deviations = (
+            self.sum_squared_deviations + block_sum_squared_deviations + delta ** 2 * self.n_samples * n_block / n_total
+        )
+        self.n_samples = n_total
+
+    @property
+    def variance(self):
+        """
+        The population variance of the observable.
+        """
+
+        return self.sum_squared_deviations / self.n_samples
+
+    def result(self):
+        """
+        Returns
+        -------
+        Mean of the observable
+        """
+
+        return self.mean
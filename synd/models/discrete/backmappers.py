@@ -0,0 +1,117 @@
+"""Precompiled backmappers for discrete SynD models."""
+import numpy as np
+from numpy.typing import ArrayLike
+from typing import Callable, Union
+
+
+class TableBackmapper:
+    """
+    A backmapper compiled into a dense lookup table of shape (n_states, \\*feature_shape).
+
+    Backmapping any number of states is a single fancy-indexed gather from the table.
+    The table's shape and dtype are taken from the coordinates of state 0.
+
+    If built lazily, each state's coordinates are only computed by the original backmapper the first time that state
+    is backmapped, which is useful for expensive backmappers or models where only a few states are ever visited.
+    """
+
+    def __init__(self, backmapper: Callable[[int], ArrayLike], n_states: int, lazy: bool = False):
+        """
+        Parameters
+        ----------
+        backmapper :
+            Callable mapping a discrete state index to a coordinate array
+        n_states :
+            Number of discrete states to build the table for
+        lazy :
+            If True, fill in each state's coordinates on first access, instead of all at once now.
+        """
+
+        self.backmapper = backmapper
+
+        first_coordinates = np.asarray(backmapper(0))
+        self.table = np.empty((n_states, *first_coordinates.shape), dtype=first_coordinates.dtype)
+        self.table[0] = first_coordinates
+
+        self.filled = np.zeros(n_states, dtype=bool)
+        self.filled[0] = True
+
+        if not lazy:
+            self._fill(np.arange(1, n_states))
+
+    @classmethod
+    def from_table(cls, table: np.ndarray, backmapper: Callable[[int], ArrayLike] = None, filled: np.ndarray = None):
+        """
+        Construct a table backmapper from an existing table, without copying it.
+
+        Parameters
+        ----------
+        table :
+            Array of shape (n_states, \\*feature_shape)
+        backmapper :
+            For partially filled tables, the callable used to fill in the remaining states
+        filled :
+            For partially filled tables, a boolean array marking which states are filled
+
+        Returns
+        -------
+        Table backmapper
+        """
+
+        table_backmapper = cls.__new__(cls)
+        table_backmapper.table = table
+        table_backmapper.backmapper = backmapper
+        table_backmapper.filled = filled
+
+        return table_backmapper
+
+    @property
+    def complete(self) -> bool:
+        """
+        Whether every state in the table has been filled.
+        """
+
+        return self.backmapper is None
+
+    def _fill(self, states: np.ndarray):
+        """
+        Compute coordinates for the given states using the original backmapper, and store them in the table.
+        """
+
+        for state in states:
+            self.table[state] = self.backmapper(state)
+
+        self.filled[states] = True
+
+        # Once every state is filled, the original backmapper is no longer needed, and doesn't need to be kept around
+        #   or pickled.
+        if self.filled.all():
+            self.backmapper = None
+            self.filled = None
+
+    def __call__(self, discrete_index: Union[int, ArrayLike]) -> np.ndarray:
+        """
+        Backmap discrete states to their coordinates.
+
+        Parameters
+        ----------
+        discrete_index :
+            Discrete state index, or array of indices
+
+        Returns
+        -------
+        Array of coordinates, of shape (\\*discrete_index.shape, \\*feature_shape)
+        """
+
+        if not self.complete:
+            missing = np.unique(np.asarray(discrete_index)[~self.filled[discrete_index]])
+            if len(missing) > 0:
+                self._fill(missing)
+
+        coordinates = self.table[discrete_index]
+
+        # A single state indexes a view into the table, so copy it rather than let callers modify the table through it
+        if np.ndim(discrete_index) == 0:
+            coordinates = coordinates.copy()
+
+        return coordinates
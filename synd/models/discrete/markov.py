@@ -2,8 +2,37 @@ from __future__ import annotations  # Sets PEP563, necessary for autodoc type al
 from synd.models.discrete.discrete import DiscreteGenerator
 import numpy as np
 from numpy.typing import ArrayLike
-from typing import Callable, Union
+from typing import Callable, Iterator, Union
+from collections import OrderedDict
+import inspect
+import pickle
 from scipy import sparse
+import scipy.sparse.linalg
+from synd.models.discrete.samplers import SAMPLERS, propagate_trajectories
+from synd.models.discrete.backmappers import TableBackmapper
+from synd.models.discrete.parallel import generate_trajectories_parallel, ParallelTrajectoryPool, DEFAULT_SHARD_SIZE
+from synd.models.discrete.trajectories import RunLengthTrajectories, compact_dtype
+
+#: Default number of steps in each block yielded by :code:`MarkovGenerator.iter_trajectory`
+DEFAULT_CHUNK_STEPS = 1000
+
+#: Default maximum number of multi-step jump samplers cached on a :code:`MarkovGenerator`
+MAX_CACHED_JUMP_SAMPLERS = 4
+
+#: Default fraction of finished walkers at which :code:`MarkovGenerator.sample_first_passage` compacts its active set
+DEFAULT_COMPACTION_THRESHOLD = 0.1
+
+#: Default maximum number of linear solvers (i.e. factorizations) cached on a :code:`MarkovGenerator`
+MAX_CACHED_SOLVERS = 8
+
+# SciPy 1.12 renamed GMRES's relative tolerance from tol to rtol, and later removed tol
+_GMRES_RTOL = 'rtol' if 'rtol' in inspect.signature(scipy.sparse.linalg.gmres).parameters else 'tol'
+
+#: Largest dense model whose stationary distribution is found with a full eigendecomposition
+MAX_DENSE_EIG_STATES = 2000
+
+#: Largest total negative probability, relative to the total, tolerated as round-off in a stationary distribution
+STATIONARY_NEGATIVE_TOLERANCE = 1e-8
 
 
 class MarkovGenerator(DiscreteGenerator):
@@ -11,7 +40,14 @@ class MarkovGenerator(DiscreteGenerator):
     Generator using discrete Markov dynamics.
     """
 
-    def __init__(self, transition_matrix: ArrayLike, backmapper: Callable[[int], ArrayLike], seed: int = None):
+    def __init__(self,
+                 transition_matrix: ArrayLike,
+                 backmapper: Callable[[int], ArrayLike],
+                 seed: int = None,
+                 sparse_storage: bool = False,
+                 sampler: str = 'searchsorted',
+                 backmap_table: str = None,
+                 trajectory_dtype=None):
         """
         Parameters
         ----------
@@ -21,25 +57,164 @@ class MarkovGenerator(DiscreteGenerator):
             Callable mapping a discrete state index to a full-coordinate representation
         seed
             The seed for random number generator
+        sparse_storage
+            If True, keep the transition matrix in CSR format and sample only over the nonzero elements of each row,
+            so memory scales with the number of nonzero transitions instead of n_states**2.
+        sampler
+            The engine used to sample transitions. One of
+
+            - :code:`'searchsorted'`: Batched binary search over each row's cumulative probabilities, O(log nnz) per
+              walker per step.
+            - :code:`'alias'`: Per-row alias tables, O(1) per walker per step, at a higher one-time construction cost.
+            - :code:`'argmin'`: The original dense kernel, O(n_states) per walker per step. Requires dense storage.
+        backmap_table
+            Optionally compile the backmapper into a lookup table. See :code:`add_backmapper`.
+        trajectory_dtype
+            Dtype of generated trajectories. Defaults to the smallest unsigned integer type that holds every state,
+            i.e. uint16 for up to 65,536 states.
         """
 
         super().__init__()
 
-        if sparse.issparse(transition_matrix):
+        if sampler not in SAMPLERS:
+            raise ValueError(f"Unknown sampler {sampler}, must be one of {list(SAMPLERS.keys())}")
+
+        if sparse_storage and sampler == 'argmin':
+            raise ValueError("The argmin sampler requires a dense transition matrix, and can't be used with "
+                             "sparse_storage=True")
+
+        self.sparse_storage = sparse_storage
+        self.sampler_name = sampler
+
+        if sparse_storage:
+            transition_matrix = sparse.csr_matrix(transition_matrix)
+        elif sparse.issparse(transition_matrix):
             transition_matrix = transition_matrix.toarray()
 
         self.transition_matrix = transition_matrix
 
         self.n_states = self.transition_matrix.shape[0]
-        self._backmappers = {'default': backmapper}
+        self.trajectory_dtype = np.dtype(trajectory_dtype) if trajectory_dtype is not None else \
+            compact_dtype(self.n_states - 1)
+
+        self._backmappers = {}
+        self._vectorized_backmappers = {}
+        self.add_backmapper(backmapper, 'default', backmap_table=backmap_table)
 
         self.rng = np.random.default_rng(seed=seed)
 
-        self.cumulative_probabilities = np.cumsum(self.transition_matrix, axis=1)
+        self._sampler = self._build_sampler()
+
+        # Sampler for exits from the current state, built the first time dwell-time sampling is used
+        self._exit_sampler = None
+
+        # Samplers for multi-step jumps, keyed by number of steps, in least- to most-recently used order
+        self._jump_samplers = OrderedDict()
+        self.max_cached_jump_samplers = MAX_CACHED_JUMP_SAMPLERS
+
+        # Computed the first time it's requested, and then saved with the model
+        self._stationary_distribution = None
+
+        # Linear solvers for hitting problems, keyed by problem and state sets, in least- to most-recently used order
+        self._solvers = OrderedDict()
+        self.max_cached_solvers = MAX_CACHED_SOLVERS
+
+        # CSR form of the transition matrix that the solvers are built from, converted the first time it's needed
+        self._csr_transition_matrix = None
 
         self.logger.info(f"Discrete Markov model created with {self.n_states} states successfully created")
 
-    def add_backmapper(self, backmapper: Callable[[int], ArrayLike], name: str):
+    def _build_sampler(self):
+        """
+        Construct the sampler used to draw transitions from the transition matrix.
+        """
+
+        return SAMPLERS[self.sampler_name](self.transition_matrix)
+
+    def _matrix_power(self, n_steps: int, threshold: float = 0.0):
+        """
+        Compute the n_steps-step transition matrix.
+
+        For sparse storage, this is computed by repeated squaring, dropping elements smaller than :code:`threshold`
+        and renormalizing rows after each product to limit fill-in.
+        """
+
+        if not self.sparse_storage:
+            return np.linalg.matrix_power(self.transition_matrix, n_steps)
+
+        def _drop_small(matrix):
+            if threshold > 0:
+                matrix.data[matrix.data < threshold] = 0.0
+                matrix.eliminate_zeros()
+                matrix = sparse.diags(1.0 / np.asarray(matrix.sum(axis=1)).ravel()) @ matrix
+            return sparse.csr_matrix(matrix)
+
+        result = sparse.identity(self.n_states, format='csr')
+        power = self.transition_matrix
+
+        while n_steps > 0:
+            if n_steps & 1:
+                result = _drop_small(result @ power)
+            n_steps >>= 1
+            if n_steps > 0:
+                power = _drop_small(power @ power)
+
+        return result
+
+    def get_jump_sampler(self, n_steps: int, threshold: float = 0.0):
+        """
+        Get a sampler that jumps :code:`n_steps` steps at once, by sampling from the :code:`n_steps`-th power of the
+        transition matrix.
+
+        Samplers are cached by number of steps (and threshold), and the least recently used ones are evicted once
+        more than :code:`max_cached_jump_samplers` are cached.
+
+        Parameters
+        ----------
+        n_steps :
+            Number of steps to jump
+        threshold :
+            For sparse storage, transition probabilities below this are dropped from the matrix power, and rows are
+            renormalized. Trades accuracy for sparsity.
+
+        Returns
+        -------
+        A sampler for the :code:`n_steps`-step transition matrix, of the same type as the model's sampler
+        """
+
+        key = (n_steps, threshold)
+
+        if key in self._jump_samplers:
+            self._jump_samplers.move_to_end(key)
+            return self._jump_samplers[key]
+
+        self.logger.debug(f"Building sampler for {n_steps}-step jumps")
+        jump_sampler = SAMPLERS[self.sampler_name](self._matrix_power(n_steps, threshold))
+
+        self._jump_samplers[key] = jump_sampler
+        while len(self._jump_samplers) > self.max_cached_jump_samplers:
+            self._jump_samplers.popitem(last=False)
+
+        return jump_sampler
+
+    def clear_jump_samplers(self, n_steps: int = None):
+        """
+        Evict cached multi-step jump samplers.
+
+        Parameters
+        ----------
+        n_steps :
+            Only evict samplers for this number of steps. If None, evict all of them.
+        """
+
+        if n_steps is None:
+            self._jump_samplers.clear()
+            return
+
+        for key in [key for key in self._jump_samplers if key[0] == n_steps]:
+            del self._jump_samplers[key]
+
+    def add_backmapper(self, backmapper: Callable[[int], ArrayLike], name: str, backmap_table: str = None):
         """
         Define a new backmapper.
 
@@ -49,14 +224,48 @@ class MarkovGenerator(DiscreteGenerator):
             A callable defining a new backmapper.
         name :
             The name to associate with the new backmapper.
+        backmap_table :
+            If :code:`'eager'`, compile the backmapper into a dense :code:`(n_states, *feature_shape)` lookup table now.
+            If :code:`'lazy'`, build the table as states are backmapped, computing each state's coordinates on first
+            access.
+            If None, call the backmapper for every backmapped state.
         """
 
         if name in self._backmappers:
             raise KeyError(f'A backmapper named {name} is already defined for this model.')
 
+        if backmap_table is not None:
+            if backmap_table not in ('eager', 'lazy'):
+                raise ValueError(f"backmap_table must be one of None, 'eager', or 'lazy', not {backmap_table}")
+
+            backmapper = TableBackmapper(backmapper, self.n_states, lazy=backmap_table == 'lazy')
+
         self._backmappers[name] = backmapper
 
+    def compile_backmapper(self, mapper: str = 'default', lazy: bool = False):
+        """
+        Compile an already-defined backmapper into a lookup table.
+
+        Parameters
+        ----------
+        mapper :
+            Name of the backmapper to compile.
+        lazy :
+            If True, compute each state's coordinates on first access instead of all at once now.
+        """
+
+        backmapper = self._backmappers[mapper]
+
+        if not isinstance(backmapper, TableBackmapper):
+            self._backmappers[mapper] = TableBackmapper(backmapper, self.n_states, lazy=lazy)
+            self._vectorized_backmappers.pop(mapper, None)
+
     def _vectorized_backmapper(self, mapper='default'):
+
+        # Building the vectorized wrapper requires probing the backmapper, so reuse it across calls
+        if mapper in self._vectorized_backmappers:
+            return self._vectorized_backmappers[mapper]
+
         backmapper = self._backmappers.get(mapper)
 
         # TODO: This might be sketchy -- is 0 guaranteed to be mappable?
@@ -65,6 +274,7 @@ class MarkovGenerator(DiscreteGenerator):
             returned_shape = f"({returned_shape[0]})"
 
         vectorized = np.vectorize(backmapper, signature=f"()->{returned_shape}")
+        self._vectorized_backmappers[mapper] = vectorized
 
         return vectorized
 
@@ -87,10 +297,20 @@ class MarkovGenerator(DiscreteGenerator):
         Array of coordinates
         """
 
+        backmapper = self._backmappers.get(mapper)
+
+        # Compiled backmappers are already vectorized
+        if isinstance(backmapper, TableBackmapper):
+            return backmapper(discrete_index)
+
         backmap = self._vectorized_backmapper(mapper)
         return backmap(discrete_index)
 
-    def generate_trajectory(self, initial_states: ArrayLike, n_steps: int) -> ArrayLike:
+    def generate_trajectory(self,
+                            initial_states: ArrayLike,
+                            n_steps: int,
+                            save_stride: int = 1,
+                            jump: bool = False) -> ArrayLike:
         """
 
         Parameters
@@ -99,38 +319,951 @@ class MarkovGenerator(DiscreteGenerator):
             Array of initial discrete states to propagate trajectories from
         n_steps :
             Number of steps forward to propagate from each initial state. Total trajectory length will be n_steps
+        save_stride :
+            Number of transitions to take between each saved step. The chain is advanced (n_steps - 1) * save_stride
+            times, but only every save_stride-th state is stored.
+        jump :
+            If True, sample each saved step directly from the cached save_stride-th power of the transition matrix
+            (see :code:`get_jump_sampler`), instead of taking save_stride individual steps.
 
         Returns
         -------
 
         """
 
+        initial_states = self.validate_initial_states(initial_states)
+
         self.logger.debug(f"Propagating {initial_states} for {n_steps} steps...")
 
-        trajectories = np.full(
+        trajectories = np.empty(
             shape=(initial_states.shape[0], n_steps),
-            dtype=int,
-            fill_value=-1
+            dtype=self.trajectory_dtype,
         )
 
-        n_trajectories = initial_states.shape[0]
-
         trajectories[:, 0] = initial_states
 
-        probabilities = self.rng.random(size=(n_trajectories, n_steps - 1))
+        if jump and save_stride > 1:
+            propagate_trajectories(self.get_jump_sampler(save_stride), trajectories, self.rng)
+        else:
+            propagate_trajectories(self._sampler, trajectories, self.rng, save_stride=save_stride)
+
+        return trajectories
+
+    def iter_trajectory(self,
+                        initial_states: ArrayLike,
+                        n_steps: int,
+                        chunk_steps: int = DEFAULT_CHUNK_STEPS) -> Iterator[np.ndarray]:
+        """
+        Propagate trajectories, yielding them in blocks of at most :code:`chunk_steps` steps.
+
+        Concatenating the blocks along the second axis gives trajectories equivalent to :code:`generate_trajectory`.
+        Random numbers are drawn one block at a time, so peak memory is bounded by the block size rather than
+        :code:`n_steps`. Because of this, the exact trajectories for a given seed differ from those of
+        :code:`generate_trajectory`.
+
+        Each yielded block is a view of a buffer that's reused for the next block, so copy it if it needs to outlive
+        the next iteration.
+
+        Parameters
+        ----------
+        initial_states :
+            Array of initial discrete states to propagate trajectories from
+        n_steps :
+            Number of steps forward to propagate from each initial state. Total trajectory length will be n_steps
+        chunk_steps :
+            Maximum number of steps in each yielded block
+
+        Yields
+        ------
+        Array of shape (n_walkers, n_chunk_steps), holding the next block of steps of each trajectory
+        """
+
+        initial_states = self.validate_initial_states(initial_states)
+        n_walkers = initial_states.shape[0]
+
+        self.logger.debug(f"Propagating {n_walkers} walkers for {n_steps} steps, in blocks of {chunk_steps}...")
+
+        # Short runs never need more than n_steps columns
+        buffer_steps = min(chunk_steps, n_steps)
+        trajectory_buffer = np.empty(n_walkers * buffer_steps, dtype=self.trajectory_dtype)
+        uniform_buffer = np.empty(n_walkers * buffer_steps)
+
+        current_states = initial_states
+        first_step = 0
+
+        for chunk_start in range(0, n_steps, chunk_steps):
+            n_chunk_steps = min(chunk_steps, n_steps - chunk_start)
+
+            # Views of the flat buffers are contiguous, whatever the size of this block
+            block = trajectory_buffer[:n_walkers * n_chunk_steps].reshape(n_walkers, n_chunk_steps)
+            uniforms = uniform_buffer[:n_walkers * n_chunk_steps].reshape(n_walkers, n_chunk_steps)
+            self.rng.random(out=uniforms)
+
+            # The first block starts with the initial states
+            if chunk_start == 0:
+                block[:, 0] = current_states
+                first_step = 1
+
+            for istep in range(first_step, n_chunk_steps):
+                current_states = self._sampler.sample(current_states, uniforms[:, istep])
+                block[:, istep] = current_states
+
+            first_step = 0
+
+            yield block
+
+    def accumulate(self,
+                   initial_states: ArrayLike,
+                   n_steps: int,
+                   accumulators: dict,
+                   chunk_steps: int = DEFAULT_CHUNK_STEPS) -> dict:
+        """
+        Propagate trajectories, reducing them to statistics as they're generated instead of storing them.
+
+        Trajectories are generated in blocks of :code:`chunk_steps` steps, as in :code:`iter_trajectory`, and each
+        block is passed to every accumulator in turn. Memory is bounded by the block size and the accumulators,
+        rather than :code:`n_steps`.
+
+        Parameters
+        ----------
+        initial_states :
+            Array of initial discrete states to propagate trajectories from
+        n_steps :
+            Number of steps forward to propagate from each initial state. Total trajectory length will be n_steps
+        accumulators :
+            Dictionary mapping names to accumulators, from :code:`synd.models.discrete.accumulators`
+        chunk_steps :
+            Number of steps in each block
+
+        Returns
+        -------
+        Dictionary mapping the name of each accumulator to its result
+        """
+
+        start_step = 0
+        previous_states = None
+
+        for block in self.iter_trajectory(initial_states, n_steps, chunk_steps=chunk_steps):
+
+            for accumulator in accumulators.values():
+                accumulator.update(self, block, start_step, previous_states)
 
+            # The block is a view of a buffer that's about to be overwritten
+            previous_states = block[:, -1].copy()
+            start_step += block.shape[1]
+
+        return {name: accumulator.result() for name, accumulator in accumulators.items()}
+
+    def sample_first_passage(self,
+                             initial_states: ArrayLike,
+                             target_states: ArrayLike,
+                             max_steps: int,
+                             compaction_threshold: float = DEFAULT_COMPACTION_THRESHOLD):
+        """
+        Propagate walkers until each first reaches a set of target states, storing only when and where they stopped.
+
+        Only live walkers are propagated. Walkers that hit the target are dropped from the active set once at least a
+        :code:`compaction_threshold` fraction of it has finished, so the cost of each step follows the number of live
+        walkers, instead of every walker running for :code:`max_steps`.
+
+        Because the number of random numbers drawn depends on when the active set is compacted, the exact results for
+        a given seed depend on :code:`compaction_threshold`, but their distribution doesn't.
+
+        Parameters
+        ----------
+        initial_states :
+            Array of initial discrete states, one per walker
+        target_states :
+            Array of target states
+        max_steps :
+            Maximum number of transitions to propagate each walker for
+        compaction_threshold :
+            Fraction of the active set that must have finished before it's compacted. 0 compacts after every step
+            with a hit.
+
+        Returns
+        -------
+        Tuple of arrays of the first passage time (in steps) of each walker, or -1 if it didn't reach the target in
+        :code:`max_steps`, and the state each walker ended in
+        """
+
+        initial_states = self.validate_initial_states(initial_states).astype(int)
+        n_walkers = initial_states.shape[0]
+
+        in_target = np.zeros(self.n_states, dtype=bool)
+        in_target[np.asarray(target_states, dtype=int)] = True
+
+        first_passage_times = np.full(n_walkers, fill_value=-1, dtype=int)
+        end_states = initial_states.copy()
+
+        # Walkers that start in the target have already arrived
+        started_in_target = in_target[initial_states]
+        first_passage_times[started_in_target] = 0
+
+        walkers = np.flatnonzero(~started_in_target)
+        states = initial_states[walkers]
+        live = np.ones(walkers.shape[0], dtype=bool)
+        n_finished = 0
+
+        self.logger.debug(f"Propagating {walkers.shape[0]} walkers to first passage, for at most {max_steps} steps...")
+
+        for istep in range(1, max_steps + 1):
+
+            if walkers.shape[0] == 0:
+                break
+
+            states = self._sampler.sample(states, self.rng.random(states.shape[0]))
+
+            # Finished walkers that haven't been compacted away yet keep stepping, but are ignored
+            hit = in_target[states] & live
+            if hit.any():
+                first_passage_times[walkers[hit]] = istep
+                end_states[walkers[hit]] = states[hit]
+                live[hit] = False
+                n_finished += np.count_nonzero(hit)
+
+            if n_finished > 0 and n_finished >= compaction_threshold * walkers.shape[0]:
+                walkers, states = walkers[live], states[live]
+                live = np.ones(walkers.shape[0], dtype=bool)
+                n_finished = 0
+
+        end_states[walkers[live]] = states[live]
+
+        return first_passage_times, end_states
+
+    def generate_trajectory_recycled(self,
+                                     initial_states: ArrayLike,
+                                     n_steps: int,
+                                     target_states: ArrayLike,
+                                     source_states: ArrayLike,
+                                     source_distribution: ArrayLike = None,
+                                     store_trajectories: bool = True):
+        """
+        Generate trajectories with steady-state recycling, where walkers that enter the target states are immediately
+        restarted from the source states, as in steady-state weighted ensemble.
+
+        Recycling happens inside the vectorized step, and the number of walkers recycled at each step is counted, so
+        the steady-state flux into the target can be estimated from brute-force dynamics. In steady state, the
+        expected number of walkers recycled per step, per walker, is the flux into the target.
+
+        Parameters
+        ----------
+        initial_states :
+            Array of initial discrete states, one per walker
+        n_steps :
+            Number of steps forward to propagate from each initial state. Total trajectory length will be n_steps
+        target_states :
+            Array of target states
+        source_states :
+            Array of source states that recycled walkers are restarted from
+        source_distribution :
+            Optional probabilities of restarting from each source state. Defaults to uniform.
+        store_trajectories :
+            If False, don't store trajectories, and only return the final state of each walker
+
+        Returns
+        -------
+        Tuple of
+
+        - The trajectories, of shape (n_walkers, n_steps), or only the final states if :code:`store_trajectories` is
+          False. Recycled walkers are recorded in the source state they were restarted from.
+        - The number of walkers recycled at each step, of shape (n_steps,)
+        - The number of times each walker was recycled, of shape (n_walkers,)
+        """
+
+        initial_states = self.validate_initial_states(initial_states).astype(int)
+        n_walkers = initial_states.shape[0]
+
+        in_target = np.zeros(self.n_states, dtype=bool)
+        in_target[np.asarray(target_states, dtype=int)] = True
+
+        source_states = np.asarray(source_states, dtype=int)
+        if source_distribution is None:
+            source_distribution = np.full(source_states.shape[0], 1.0 / source_states.shape[0])
+        source_cumulative = np.cumsum(source_distribution)
+        source_cumulative /= source_cumulative[-1]
+
+        step_recycled = np.zeros(n_steps, dtype=int)
+        walker_recycled = np.zeros(n_walkers, dtype=int)
+
+        trajectories = None
+        if store_trajectories:
+            trajectories = np.empty((n_walkers, n_steps), dtype=self.trajectory_dtype)
+            trajectories[:, 0] = initial_states
+
+        self.logger.debug(f"Propagating {n_walkers} walkers for {n_steps} steps with recycling...")
+
+        current_states = initial_states
         for istep in range(1, n_steps):
-            current_states = trajectories[:, istep - 1]
+            current_states = self._sampler.sample(current_states, self.rng.random(n_walkers))
+
+            recycled = np.flatnonzero(in_target[current_states])
+            if recycled.size > 0:
+                current_states[recycled] = source_states[
+                    np.searchsorted(source_cumulative, self.rng.random(recycled.size), side='right')
+                ]
+                step_recycled[istep] = recycled.size
+                walker_recycled[recycled] += 1
+
+            if store_trajectories:
+                trajectories[:, istep] = current_states
+
+        if not store_trajectories:
+            return current_states.astype(self.trajectory_dtype), step_recycled, walker_recycled
+
+        return trajectories, step_recycled, walker_recycled
+
+    def _get_exit_sampler(self):
+        """
+        Get the sampler for the state a walker moves to when it leaves its current state, built from the
+        off-diagonal elements of each row, renormalized.
+        """
+
+        if self._exit_sampler is not None:
+            return self._exit_sampler
+
+        self_transition_probabilities = self.transition_matrix.diagonal()
+        exit_probabilities = 1.0 - self_transition_probabilities
+
+        # States that can't be left never need an exit sampled, so just give them a valid (self-transition) row
+        never_exits = exit_probabilities <= 0
+        scale = np.where(never_exits, 1.0, 1.0 / np.where(never_exits, 1.0, exit_probabilities))
+
+        if self.sparse_storage:
+            off_diagonal = self.transition_matrix - sparse.diags(self_transition_probabilities)
+            exit_matrix = sparse.diags(scale) @ off_diagonal + sparse.diags(never_exits.astype(float))
+        else:
+            off_diagonal = self.transition_matrix - np.diag(self_transition_probabilities)
+            exit_matrix = scale[:, np.newaxis] * off_diagonal + np.diag(never_exits.astype(float))
 
-            next_states = np.argmin(
-                self.cumulative_probabilities[current_states].T
-                < probabilities[:, istep - 1],
-                axis=0,
+        self._exit_sampler = SAMPLERS[self.sampler_name](exit_matrix)
+
+        return self._exit_sampler
+
+    def _sample_dwell_runs(self, initial_states: ArrayLike, n_steps: int):
+        """
+        Sample trajectories as runs of repeated states, by sampling how long each walker dwells in each state it
+        visits.
+
+        Returns
+        -------
+        Tuple of arrays of the walker, state, first step, and length of each run. Runs are ordered by walker, and then
+        by first step, and together cover every step of every trajectory.
+        """
+
+        initial_states = self.validate_initial_states(initial_states)
+        n_walkers = initial_states.shape[0]
+
+        self_transition_probabilities = self.transition_matrix.diagonal()
+        exit_sampler = self._get_exit_sampler()
+
+        current_states = initial_states.astype(int)
+        run_starts = np.zeros(n_walkers, dtype=int)
+        active_walkers = np.arange(n_walkers)
+
+        walkers, states, starts, lengths = [], [], [], []
+
+        while active_walkers.size > 0:
+            active_states = current_states[active_walkers]
+            exit_probabilities = 1.0 - self_transition_probabilities[active_states]
+
+            # The number of steps spent in a state, including the first, is geometrically distributed.
+            #   Walkers in states that can't be left just stay there for the rest of the trajectory.
+            never_exits = exit_probabilities <= 0
+            run_lengths = self.rng.geometric(np.where(never_exits, 1.0, exit_probabilities))
+            run_lengths[never_exits] = n_steps
+            run_lengths = np.minimum(run_lengths, n_steps - run_starts[active_walkers])
+
+            walkers.append(active_walkers)
+            states.append(active_states)
+            starts.append(run_starts[active_walkers])
+            lengths.append(run_lengths)
+
+            run_starts[active_walkers] += run_lengths
+
+            active_walkers = active_walkers[run_starts[active_walkers] < n_steps]
+            current_states[active_walkers] = exit_sampler.sample(
+                current_states[active_walkers], self.rng.random(active_walkers.size)
             )
 
-            trajectories[:, istep] = next_states
+        walkers, states, starts, lengths = (np.concatenate(x) for x in (walkers, states, starts, lengths))
 
-        return trajectories
+        order = np.lexsort((starts, walkers))
+
+        return walkers[order], states[order], starts[order], lengths[order]
+
+    def generate_trajectory_dwell(self, initial_states: ArrayLike, n_steps: int) -> ArrayLike:
+        """
+        Generate trajectories by sampling dwell times directly, rather than one step at a time.
+
+        The time spent in a state is drawn from the geometric distribution given by its self-transition probability,
+        and the next state from its renormalized off-diagonal transition probabilities, so each run of repeated
+        states costs one dwell time and one exit sample. For metastable models with self-transition probabilities
+        close to 1, this reduces the random number and sampling work by roughly the mean dwell time.
+
+        The resulting trajectories are statistically equivalent to those from :code:`generate_trajectory`.
+
+        Parameters
+        ----------
+        initial_states :
+            Array of initial discrete states to propagate trajectories from
+        n_steps :
+            Number of steps forward to propagate from each initial state. Total trajectory length will be n_steps
+
+        Returns
+        -------
+        Array of trajectories, of shape (n_walkers, n_steps)
+        """
+
+        initial_states = np.asarray(initial_states)
+
+        self.logger.debug(f"Propagating {initial_states.shape[0]} walkers for {n_steps} steps with dwell times...")
+
+        _, states, _, lengths = self._sample_dwell_runs(initial_states, n_steps)
+
+        # Runs are sorted by walker and then time, and cover every step, so they can be written in bulk
+        return np.repeat(states.astype(self.trajectory_dtype), lengths).reshape(initial_states.shape[0], n_steps)
+
+    def generate_trajectory_rle(self, initial_states: ArrayLike, n_steps: int) -> RunLengthTrajectories:
+        """
+        Generate run-length encoded trajectories, straight from sampled dwell times, without ever decoding them.
+
+        This samples the same dynamics as :code:`generate_trajectory_dwell`. For metastable models, the encoded
+        trajectories are smaller than the decoded ones by roughly the mean dwell time.
+
+        Parameters
+        ----------
+        initial_states :
+            Array of initial discrete states to propagate trajectories from
+        n_steps :
+            Number of steps forward to propagate from each initial state. Total trajectory length will be n_steps
+
+        Returns
+        -------
+        Run-length encoded trajectories, of shape (n_walkers, n_steps)
+        """
+
+        initial_states = np.asarray(initial_states)
+        n_walkers = initial_states.shape[0]
+
+        self.logger.debug(f"Propagating {n_walkers} walkers for {n_steps} steps, run-length encoded...")
+
+        walkers, states, _, lengths = self._sample_dwell_runs(initial_states, n_steps)
+
+        # Runs out of a state always go to a different state, so every sampled run is already a maximal run
+        return RunLengthTrajectories(
+            states=states.astype(self.trajectory_dtype),
+            run_lengths=lengths.astype(compact_dtype(n_steps)),
+            walker_offsets=np.concatenate([[0], np.cumsum(np.bincount(walkers, minlength=n_walkers))]),
+            n_steps=n_steps,
+        )
+
+    def generate_trajectory_parallel(self,
+                                     initial_states: ArrayLike,
+                                     n_steps: int,
+                                     n_workers: int = None,
+                                     seed: Union[int, np.random.SeedSequence] = None,
+                                     shard_size: int = DEFAULT_SHARD_SIZE,
+                                     save_stride: int = 1) -> ArrayLike:
+        """
+        Generate trajectories in parallel, sharding the initial states across a pool of worker processes.
+
+        The sampling tables are placed in shared memory, so workers don't each hold a copy.
+        Each shard of :code:`shard_size` walkers draws from an independent stream spawned from :code:`seed`, so the
+        output for a given seed is identical no matter how many workers are used.
+
+        Parameters
+        ----------
+        initial_states :
+            Array of initial discrete states to propagate trajectories from
+        n_steps :
+            Number of steps forward to propagate from each initial state. Total trajectory length will be n_steps
+        n_workers :
+            Number of worker processes. Defaults to the number of CPUs.
+        seed :
+            Seed for the per-shard random streams. If not provided, one is drawn from the model's random number
+            generator.
+        shard_size :
+            Number of walkers in each independently-seeded shard
+        save_stride :
+            Number of transitions to take between each saved step
+
+        Returns
+        -------
+        Array of trajectories, of shape (n_walkers, n_steps)
+        """
+
+        initial_states = self.validate_initial_states(initial_states)
+
+        if seed is None:
+            seed = int(self.rng.integers(2**63))
+
+        self.logger.debug(f"Propagating {len(initial_states)} walkers for {n_steps} steps on {n_workers} workers...")
+
+        return generate_trajectories_parallel(
+            sampler=self._sampler,
+            sampler_name=self.sampler_name,
+            initial_states=initial_states,
+            n_steps=n_steps,
+            seed=seed,
+            n_workers=n_workers,
+            shard_size=shard_size,
+            save_stride=save_stride,
+            dtype=self.trajectory_dtype
+        )
+
+    def parallel_pool(self,
+                      n_walkers: int,
+                      max_steps: int,
+                      n_workers: int = None,
+                      shard_size: int = DEFAULT_SHARD_SIZE) -> ParallelTrajectoryPool:
+        """
+        Start a pool of worker processes that can generate trajectories from this model many times over.
+
+        Unlike :code:`generate_trajectory_parallel`, which starts a pool and copies the sampling tables into shared
+        memory on every call, the pool is started and the tables copied once. Use this when generating repeatedly,
+        i.e. a long run in chunks.
+
+        Parameters
+        ----------
+        n_walkers :
+            Number of walkers generated by each call
+        max_steps :
+            Largest number of steps generated by any call
+        n_workers :
+            Number of worker processes. Defaults to the number of CPUs.
+        shard_size :
+            Number of walkers in each independently-seeded shard
+
+        Returns
+        -------
+        A :code:`ParallelTrajectoryPool`, to be used as a context manager
+        """
+
+        return ParallelTrajectoryPool(
+            sampler=self._sampler,
+            sampler_name=self.sampler_name,
+            n_walkers=n_walkers,
+            max_steps=max_steps,
+            n_workers=n_workers,
+            shard_size=shard_size,
+            dtype=self.trajectory_dtype
+        )
+
+    def propagate_distribution(self,
+                               initial_distributions: ArrayLike,
+                               n_steps: int,
+                               save_stride: int = 1) -> np.ndarray:
+        """
+        Propagate probability distributions over states exactly, as :math:`p_{t+1} = p_t T`.
+
+        All distributions are propagated together, so each step is a single (sparse) matrix-matrix product.
+
+        Parameters
+        ----------
+        initial_distributions :
+            Array of shape (n_distributions, n_states), or a single distribution of shape (n_states,)
+        n_steps :
+            Number of steps to save, including the initial distribution
+        save_stride :
+            Number of steps to take between each saved step
+
+        Returns
+        -------
+        Array of distributions of shape (n_distributions, n_steps, n_states), or (n_steps, n_states) for a single
+        initial distribution
+        """
+
+        initial_distributions = np.asarray(initial_distributions, dtype=float)
+        single_distribution = initial_distributions.ndim == 1
+        distributions = np.atleast_2d(initial_distributions)
+
+        # Propagate the transposed distributions, so the sparse matrix is on the left of the product
+        transposed_transition_matrix = self.transition_matrix.T
+        if self.sparse_storage:
+            transposed_transition_matrix = sparse.csr_matrix(transposed_transition_matrix)
+
+        current = np.ascontiguousarray(distributions.T)
+
+        propagated = np.empty((n_steps, *current.shape))
+        propagated[0] = current
+
+        for istep in range(1, n_steps):
+            for _ in range(save_stride):
+                current = transposed_transition_matrix @ current
+            propagated[istep] = current
+
+        propagated = propagated.transpose(2, 0, 1)
+
+        return propagated[0] if single_distribution else propagated
+
+    def get_stationary_distribution(self,
+                                    method: str = 'auto',
+                                    tol: float = 1e-12,
+                                    max_iter: int = 100000) -> np.ndarray:
+        """
+        Get the stationary distribution of the model, :math:`\\pi = \\pi T`.
+
+        It's computed the first time it's requested, and cached on the model, and saved with it.
+
+        Parameters
+        ----------
+        method :
+            One of
+
+            - :code:`'auto'`: :code:`'eig'` for dense models with up to :code:`MAX_DENSE_EIG_STATES` states, otherwise
+              :code:`'solve'`
+            - :code:`'eig'`: Full dense eigendecomposition
+            - :code:`'solve'`: Sparse linear solve of :math:`\\pi (I - T) = 0`, grounded at the state with the most
+              incoming probability. This is robust for metastable models, where the eigenvalues cluster near 1.
+              The factorization is cached with the other linear solvers.
+            - :code:`'eigs'`: Sparse (ARPACK) solve for the eigenvector with the largest real eigenvalue
+            - :code:`'power'`: Power iteration from the uniform distribution
+        tol :
+            Convergence tolerance, for the iterative methods
+        max_iter :
+            Maximum number of iterations, for the iterative methods
+
+        Returns
+        -------
+        Array of the stationary probability of each state
+        """
+
+        if self._stationary_distribution is not None:
+            return self._stationary_distribution
+
+        if method == 'auto':
+            method = 'eig' if not self.sparse_storage and self.n_states <= MAX_DENSE_EIG_STATES else 'solve'
+
+        if method == 'eig':
+            transition_matrix = self.transition_matrix
+            if sparse.issparse(transition_matrix):
+                transition_matrix = transition_matrix.toarray()
+
+            eigenvalues, eigenvectors = np.linalg.eig(transition_matrix.T)
+            stationary = eigenvectors[:, np.argmax(eigenvalues.real)].real
+
+        elif method == 'solve':
+            transition_matrix = self._get_csr_transition_matrix()
+
+            # A state with no incoming probability is transient, so can't be grounded at
+            ground = int(np.argmax(np.asarray(transition_matrix.sum(axis=0)).ravel()))
+            free = np.ones(self.n_states, dtype=bool)
+            free[ground] = False
+
+            solve = self._get_solver(
+                ('stationary', ground),
+                lambda: (sparse.identity(self.n_states, format='csr') - transition_matrix)[free][:, free],
+            )
+
+            # As in discrepancy, fixing the stationary probability to 1 at the ground state leaves the transposed
+            #   grounded system, with the ground state's transitions on the right-hand side
+            stationary = np.ones(self.n_states)
+            stationary[free] = solve(transition_matrix[ground].toarray().ravel()[free], trans='T')
+
+        elif method == 'eigs':
+            _, eigenvectors = scipy.sparse.linalg.eigs(
+                self._get_csr_transition_matrix().T, k=1, which='LR', tol=tol, maxiter=max_iter
+            )
+            stationary = eigenvectors[:, 0].real
+
+        elif method == 'power':
+            stationary = np.full(self.n_states, 1.0 / self.n_states)
+
+            for _ in range(max_iter):
+                updated = self.transition_matrix.T @ stationary
+                converged = np.abs(updated - stationary).sum() < tol
+                stationary = updated
+                if converged:
+                    break
+            else:
+                self.logger.warning(f"Power iteration didn't converge to {tol} in {max_iter} iterations")
+
+        else:
+            raise ValueError(
+                f"Unknown method {method}, must be one of 'auto', 'eig', 'solve', 'eigs', or 'power'"
+            )
+
+        # Eigenvectors are only defined up to a sign, so orient by the largest entry
+        stationary = stationary * np.sign(stationary[np.argmax(np.abs(stationary))])
+
+        # Anything more than round-off negatives means the solve didn't converge, or the chain has more than one
+        #   stationary distribution, so there's no meaningful answer to return
+        negative_mass = -stationary[stationary < 0].sum()
+        if negative_mass > STATIONARY_NEGATIVE_TOLERANCE * np.abs(stationary).sum():
+            raise ValueError(
+                f"Stationary distribution from method {method} has significant negative entries "
+                f"({negative_mass / np.abs(stationary).sum():.3g} of the total). The solve may not have converged, "
+                f"or the transition matrix may be reducible."
+            )
+
+        stationary = np.maximum(stationary, 0.0)
+        self._stationary_distribution = stationary / stationary.sum()
+
+        return self._stationary_distribution
+
+    def _get_csr_transition_matrix(self) -> sparse.csr_matrix:
+        """
+        Get the transition matrix in CSR format, converting it once and caching it alongside the solvers.
+        """
+
+        if self._csr_transition_matrix is None:
+            self._csr_transition_matrix = sparse.csr_matrix(self.transition_matrix)
+
+        return self._csr_transition_matrix
+
+    def _get_solver(self, key: tuple, build_matrix: Callable[[], sparse.spmatrix], solver: str = 'direct'):
+        """
+        Get a cached function :code:`solve(rhs, trans='N')` solving the linear system with the matrix returned by
+        :code:`build_matrix`, or with its transpose if :code:`trans='T'`.
+
+        Direct solvers cache the sparse LU factorization. Iterative solvers run GMRES, and cache an incomplete LU
+        factorization as its preconditioner.
+        """
+
+        key = (*key, solver)
+
+        if key in self._solvers:
+            self._solvers.move_to_end(key)
+            return self._solvers[key]
+
+        matrix = sparse.csc_matrix(build_matrix())
+
+        if solver == 'direct':
+            solve = scipy.sparse.linalg.splu(matrix).solve
+
+        elif solver == 'iterative':
+            incomplete_lu = scipy.sparse.linalg.spilu(matrix)
+
+            def solve(rhs, trans='N'):
+                system = matrix if trans == 'N' else matrix.T
+                preconditioner = scipy.sparse.linalg.LinearOperator(
+                    matrix.shape, lambda x: incomplete_lu.solve(x, trans=trans)
+                )
+
+                solution, info = scipy.sparse.linalg.gmres(
+                    system, rhs, M=preconditioner, atol=0.0, **{_GMRES_RTOL: 1e-12}
+                )
+                if info != 0:
+                    self.logger.warning(f"GMRES didn't converge (info={info})")
+
+                return solution
+
+        else:
+            raise ValueError(f"Unknown solver {solver}, must be one of 'direct' or 'iterative'")
+
+        self._solvers[key] = solve
+        while len(self._solvers) > self.max_cached_solvers:
+            self._solvers.popitem(last=False)
+
+        return solve
+
+    def clear_solvers(self):
+        """
+        Evict all cached linear solvers, and the CSR transition matrix they're built from.
+        """
+
+        self._solvers.clear()
+        self._csr_transition_matrix = None
+
+    def _state_mask(self, states: ArrayLike) -> np.ndarray:
+        """
+        Get a boolean mask over all states, marking the given states.
+        """
+
+        mask = np.zeros(self.n_states, dtype=bool)
+        mask[np.asarray(states, dtype=int)] = True
+
+        return mask
+
+    def mfpt(self,
+             target_states: ArrayLike,
+             source_states: ArrayLike = None,
+             solver: str = 'direct') -> Union[float, np.ndarray]:
+        """
+        Compute mean first passage times (in steps) to a set of target states, exactly.
+
+        The MFPTs :math:`m` solve :math:`(I - T_{AA}) m_A = 1` on the non-target states :math:`A`, and are zero on
+        the target. The solver for a target set is cached, so repeated calls with the same target are cheap.
+
+        Parameters
+        ----------
+        target_states :
+            Array of target states
+        source_states :
+            Optional array of source states. If given, return the MFPT from the source states, weighted by their
+            stationary probabilities.
+        solver :
+            :code:`'direct'` for a sparse LU factorization, or :code:`'iterative'` for preconditioned GMRES
+
+        Returns
+        -------
+        MFPT from the source states, or if no source states are given, an array of the MFPT from every state
+        """
+
+        in_target = self._state_mask(target_states)
+        in_target_key = np.flatnonzero(in_target).tobytes()
+        non_target = ~in_target
+
+        transition_matrix = self._get_csr_transition_matrix()
+
+        solve = self._get_solver(
+            ('mfpt', in_target_key),
+            lambda: sparse.identity(non_target.sum()) - transition_matrix[non_target][:, non_target],
+            solver
+        )
+
+        mfpts = np.zeros(self.n_states)
+        mfpts[non_target] = solve(np.ones(non_target.sum()))
+
+        if source_states is None:
+            return mfpts
+
+        source_states = np.asarray(source_states, dtype=int)
+        weights = self.get_stationary_distribution()[source_states]
+
+        return float(np.dot(weights, mfpts[source_states]) / weights.sum())
+
+    def committor(self, source_states: ArrayLike, target_states: ArrayLike, solver: str = 'direct') -> np.ndarray:
+        """
+        Compute the forward committor -- the probability of reaching the target states before the source states,
+        from every state -- exactly.
+
+        The committor :math:`q` is 0 on the source, 1 on the target, and solves
+        :math:`(I - T_{CC}) q_C = T_{CB} 1` on the remaining states :math:`C`. The solver for a source and target pair
+        is cached.
+
+        Parameters
+        ----------
+        source_states :
+            Array of source states
+        target_states :
+            Array of target states
+        solver :
+            :code:`'direct'` for a sparse LU factorization, or :code:`'iterative'` for preconditioned GMRES
+
+        Returns
+        -------
+        Array of the committor of each state
+        """
+
+        in_source = self._state_mask(source_states)
+        in_target = self._state_mask(target_states)
+        intermediate = ~(in_source | in_target)
+
+        transition_matrix = self._get_csr_transition_matrix()
+        intermediate_rows = transition_matrix[intermediate]
+
+        solve = self._get_solver(
+            ('committor', np.flatnonzero(in_source).tobytes(), np.flatnonzero(in_target).tobytes()),
+            lambda: sparse.identity(intermediate.sum()) - intermediate_rows[:, intermediate],
+            solver
+        )
+
+        committors = in_target.astype(float)
+        committors[intermediate] = solve(np.asarray(intermediate_rows[:, in_target].sum(axis=1)).ravel())
+
+        return committors
+
+    def recycled_transition_matrix(self, target_states: ArrayLike, source_distribution: ArrayLike) -> sparse.csr_matrix:
+        """
+        Build the transition matrix of the chain where walkers entering the target states are recycled to the source,
+        as in steady-state weighted ensemble.
+
+        Parameters
+        ----------
+        target_states :
+            Array of target states
+        source_distribution :
+            Distribution over all states that recycled walkers are restarted from
+
+        Returns
+        -------
+        Sparse transition matrix, with every target state's row replaced by the source distribution
+        """
+
+        in_target = self._state_mask(target_states)
+        source_distribution = sparse.csr_matrix(np.asarray(source_distribution, dtype=float).reshape(1, -1))
+
+        kept_rows = sparse.diags((~in_target).astype(float)) @ self._get_csr_transition_matrix()
+        recycled_rows = sparse.csr_matrix(in_target.astype(float).reshape(-1, 1)) @ source_distribution
+
+        return sparse.csr_matrix(kept_rows + recycled_rows)
+
+    def discrepancy(self,
+                    target_states: ArrayLike,
+                    source_states: ArrayLike,
+                    source_distribution: ArrayLike = None,
+                    solver: str = 'direct'):
+        """
+        Compute the discrepancy and variance functions of the steady-state flux into the target states, for the
+        chain recycled from the target to the source, as used to optimize weighted ensemble bins and allocations.
+
+        With :math:`K` the recycled transition matrix and :math:`\\pi` its stationary distribution, the discrepancy
+        :math:`h` solves the Poisson equation :math:`(I - K) h = 1_B - \\pi(B)` with :math:`\\pi \\cdot h = 0`,
+        and the variance is :math:`v = K h^2 - (K h)^2`.
+
+        The Poisson equation is singular, so it's grounded at a source state, and the solution is shifted to satisfy the
+        constraint afterwards. The same grounded factorization gives :math:`\\pi`, and is cached for each source and
+        target pair.
+
+        Parameters
+        ----------
+        target_states :
+            Array of target states
+        source_states :
+            Array of source states walkers are recycled to
+        source_distribution :
+            Optional distribution over the source states. Defaults to uniform.
+        solver :
+            :code:`'direct'` for a sparse LU factorization, or :code:`'iterative'` for preconditioned GMRES
+
+        Returns
+        -------
+        Tuple of the discrepancy, the variance, and the stationary distribution of the recycled chain
+        """
+
+        source_states = np.asarray(source_states, dtype=int)
+        if source_distribution is None:
+            source_distribution = np.full(source_states.shape[0], 1.0 / source_states.shape[0])
+
+        full_source_distribution = np.zeros(self.n_states)
+        full_source_distribution[source_states] = source_distribution
+
+        recycled = self.recycled_transition_matrix(target_states, full_source_distribution)
+        in_target = self._state_mask(target_states)
+
+        # Every walker eventually returns to the source, so a source state always has nonzero stationary probability,
+        #   and it's safe to ground the system there
+        ground = source_states[np.argmax(source_distribution)]
+        free = np.ones(self.n_states, dtype=bool)
+        free[ground] = False
+
+        key = (
+            'discrepancy', np.flatnonzero(in_target).tobytes(), source_states.tobytes(),
+            np.asarray(source_distribution, dtype=float).tobytes()
+        )
+        solve = self._get_solver(
+            key,
+            lambda: (sparse.identity(self.n_states, format='csr') - recycled)[free][:, free],
+            solver
+        )
+
+        # The stationary distribution is the null vector of (I - K)^T. Fixing it to 1 at the ground state leaves
+        #   the transposed grounded system, with the ground state's transitions on the right-hand side.
+        stationary = np.ones(self.n_states)
+        stationary[free] = solve(recycled[ground].toarray().ravel()[free], trans='T')
+        stationary /= stationary.sum()
+
+        rhs = in_target.astype(float) - stationary[in_target].sum()
+
+        discrepancy = np.zeros(self.n_states)
+        discrepancy[free] = solve(rhs[free])
+        discrepancy -= np.dot(stationary, discrepancy)
+
+        variance = recycled @ discrepancy ** 2 - (recycled @ discrepancy) ** 2
+
+        return discrepancy, np.maximum(variance, 0.0), stationary
 
     @staticmethod
     def validate_transition_matrix(transition_matrix: ArrayLike):
@@ -148,19 +1281,183 @@ class MarkovGenerator(DiscreteGenerator):
 
         assert np.isclose(transition_matrix.sum(axis=1), 1.0), "Transition matrix is not row-normalized"
 
+    def validate_initial_states(self, initial_states: ArrayLike) -> np.ndarray:
+        """
+        Validate that initial states are states of this model. Raises a :code:`ValueError` if they are not.
+
+        Trajectories are stored in compact unsigned dtypes, so out-of-range states would otherwise silently wrap
+        around when they're written.
+
+        Parameters
+        ----------
+        initial_states :
+            Array of initial discrete states
+
+        Returns
+        -------
+        The initial states, as an array
+        """
+
+        initial_states = np.asarray(initial_states)
+
+        out_of_range = (initial_states < 0) | (initial_states >= self.n_states)
+        if np.any(out_of_range):
+            raise ValueError(
+                f"Initial states must be between 0 and {self.n_states - 1}, but got "
+                f"{initial_states[out_of_range].ravel()[:10].tolist()}"
+            )
+
+        return initial_states
+
+    def _get_binary_state(self):
+        """
+        Get the metadata and arrays representing this model in the binary model format.
+
+        Backmappers compiled into tables are stored as arrays. Any other backmapper is stored pickled, so compile
+        backmappers with :code:`compile_backmapper` before saving to avoid that.
+        """
+
+        metadata = {
+            'n_states': self.n_states,
+            'sparse_storage': self.sparse_storage,
+            'sampler_name': self.sampler_name,
+            'max_cached_jump_samplers': self.max_cached_jump_samplers,
+            'max_cached_solvers': self.max_cached_solvers,
+            'trajectory_dtype': self.trajectory_dtype.str,
+            'has_stationary_distribution': self._stationary_distribution is not None,
+            'rng_state': self.rng.bit_generator.state,
+            'transition_matrix_shape': list(self.transition_matrix.shape),
+            'backmappers': {},
+        }
+
+        arrays = {}
+
+        if self.sparse_storage:
+            arrays['transition_matrix/data'] = self.transition_matrix.data
+            arrays['transition_matrix/indices'] = self.transition_matrix.indices
+            arrays['transition_matrix/indptr'] = self.transition_matrix.indptr
+        else:
+            arrays['transition_matrix'] = np.asarray(self.transition_matrix)
+
+        for name, array in self._sampler.get_arrays().items():
+            arrays[f'sampler/{name}'] = array
+
+        if self._stationary_distribution is not None:
+            arrays['stationary_distribution'] = self._stationary_distribution
+
+        for name, backmapper in self._backmappers.items():
+
+            if isinstance(backmapper, TableBackmapper):
+                arrays[f'backmappers/{name}/table'] = backmapper.table
+
+                if backmapper.complete:
+                    metadata['backmappers'][name] = 'table'
+                    continue
+
+                metadata['backmappers'][name] = 'partial_table'
+                arrays[f'backmappers/{name}/filled'] = backmapper.filled
+                backmapper = backmapper.backmapper
+
+            else:
+                metadata['backmappers'][name] = 'pickle'
+                self.logger.warning(f"Backmapper {name} isn't compiled to a table, so it will be pickled")
+
+            arrays[f'backmappers/{name}/pickle'] = np.frombuffer(pickle.dumps(backmapper), dtype=np.uint8)
+
+        return metadata, arrays
+
+    @classmethod
+    def _from_binary_state(cls, metadata: dict, arrays: dict):
+        """
+        Reconstruct a model from the metadata and arrays returned by :code:`_get_binary_state`, without copying the
+        arrays.
+        """
+
+        model = cls.__new__(cls)
+        DiscreteGenerator.__init__(model)
+
+        model.n_states = metadata['n_states']
+        model.sparse_storage = metadata['sparse_storage']
+        model.sampler_name = metadata['sampler_name']
+        model.max_cached_jump_samplers = metadata['max_cached_jump_samplers']
+        model.max_cached_solvers = metadata.get('max_cached_solvers', MAX_CACHED_SOLVERS)
+        model.trajectory_dtype = np.dtype(metadata.get('trajectory_dtype', compact_dtype(model.n_states - 1)))
+
+        if model.sparse_storage:
+            model.transition_matrix = sparse.csr_matrix(
+                (arrays['transition_matrix/data'],
+                 arrays['transition_matrix/indices'],
+                 arrays['transition_matrix/indptr']),
+                shape=tuple(metadata['transition_matrix_shape'])
+            )
+        else:
+            model.transition_matrix = arrays['transition_matrix']
+
+        rng_state = metadata['rng_state']
+        model.rng = np.random.Generator(getattr(np.random, rng_state['bit_generator'])())
+        model.rng.bit_generator.state = rng_state
+
+        sampler_arrays = {name.split('/', 1)[1]: array for name, array in arrays.items() if name.startswith('sampler/')}
+        model._sampler = SAMPLERS[model.sampler_name].from_arrays(sampler_arrays)
+
+        model._backmappers = {}
+        for name, backmapper_type in metadata['backmappers'].items():
+
+            if backmapper_type == 'table':
+                backmapper = TableBackmapper.from_table(arrays[f'backmappers/{name}/table'])
+
+            else:
+                backmapper = pickle.loads(arrays[f'backmappers/{name}/pickle'].tobytes())
+
+                if backmapper_type == 'partial_table':
+                    # This table will still be filled in, so it needs a writable copy
+                    backmapper = TableBackmapper.from_table(
+                        np.array(arrays[f'backmappers/{name}/table']),
+                        backmapper=backmapper,
+                        filled=np.array(arrays[f'backmappers/{name}/filled'])
+                    )
+
+            model._backmappers[name] = backmapper
+
+        model._stationary_distribution = None
+        if metadata.get('has_stationary_distribution', False):
+            model._stationary_distribution = arrays['stationary_distribution']
+
+        model._vectorized_backmappers = {}
+        model._jump_samplers = OrderedDict()
+        model._exit_sampler = None
+        model._solvers = OrderedDict()
+        model._csr_transition_matrix = None
+
+        return model
+
     def __setstate__(self, state):
         """
-        Makes the transition matrix dense when unpickling
+        Makes the transition matrix dense when unpickling, unless the model uses sparse storage
         """
 
-        if sparse.issparse(state['transition_matrix']):
-            state['transition_matrix'] = state['transition_matrix'].toarray()
+        # Models pickled before sparse storage and selectable samplers were introduced are always dense
+        state.setdefault('sparse_storage', False)
+        state.setdefault('sampler_name', 'searchsorted')
+        state.pop('cumulative_probabilities', None)
+        state['_vectorized_backmappers'] = {}
+        state['_jump_samplers'] = OrderedDict()
+        state['_exit_sampler'] = None
+        state.setdefault('max_cached_jump_samplers', MAX_CACHED_JUMP_SAMPLERS)
+        state.setdefault('_stationary_distribution', None)
+        state.setdefault('max_cached_solvers', MAX_CACHED_SOLVERS)
+        state['_solvers'] = OrderedDict()
+        state['_csr_transition_matrix'] = None
+        state.setdefault('trajectory_dtype', compact_dtype(state['transition_matrix'].shape[0] - 1))
 
-        # Recalculate the cumulative probabilities
-        state['cumulative_probabilities'] = np.cumsum(state['transition_matrix'], axis=1)
+        if sparse.issparse(state['transition_matrix']) and not state['sparse_storage']:
+            state['transition_matrix'] = state['transition_matrix'].toarray()
 
         self.__dict__ = state
 
+        # Rebuild the sampler
+        self._sampler = self._build_sampler()
+
     def __getstate__(self):
         """
         When pickling, makes the transition matrix sparse
@@ -171,7 +1468,12 @@ class MarkovGenerator(DiscreteGenerator):
         # Store a sparse representation of this
         sparse_dict['transition_matrix'] = sparse.csr_matrix(self.__dict__['transition_matrix'])
 
-        # Don't pickle this, because 1) it can be calculated and 2) it's large and not sparse
-        sparse_dict.pop('cumulative_probabilities')
+        # Don't pickle this, because 1) it can be calculated and 2) it may be large and not sparse
+        sparse_dict.pop('_sampler')
+        sparse_dict.pop('_vectorized_backmappers')
+        sparse_dict.pop('_jump_samplers')
+        sparse_dict.pop('_exit_sampler')
+        sparse_dict.pop('_solvers')
+        sparse_dict.pop('_csr_transition_matrix')
 
         return sparse_dict
@@ -0,0 +1,291 @@
+"""Walker-parallel trajectory generation over a process pool, with transition data in shared memory."""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import os
+import numpy as np
+from numpy.typing import ArrayLike
+from numpy.typing import DTypeLike
+from typing import Union
+
+from synd.models.discrete.samplers import BaseSampler, SAMPLERS, propagate_trajectories
+
+#: Default number of walkers in each independently-seeded shard
+DEFAULT_SHARD_SIZE = 1024
+
+# Per-worker state, populated by _initialize_worker
+_worker_sampler = None
+_worker_trajectories = None
+_worker_shared_memory = []
+
+
+def _to_shared_memory(array: np.ndarray):
+    """
+    Copy an array into a new shared memory block.
+
+    Returns
+    -------
+    Tuple of the shared memory block, and a (name, shape, dtype) descriptor that can be used to attach to it
+    """
+
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+
+    shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared_array[...] = array
+
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _from_shared_memory(descriptor: tuple):
+    """
+    Attach to a shared memory block created by :code:`_to_shared_memory`.
+
+    Returns
+    -------
+    Tuple of the shared memory block, and an array viewing it
+    """
+
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _initialize_worker(sampler_name: str, sampler_descriptors: dict, trajectories_descriptor: tuple):
+    """
+    Attach a pool worker to the shared sampler arrays and output trajectories.
+    """
+
+    global _worker_sampler, _worker_trajectories
+
+    arrays = {}
+    for name, descriptor in sampler_descriptors.items():
+        shm, arrays[name] = _from_shared_memory(descriptor)
+        _worker_shared_memory.append(shm)
+
+    shm, _worker_trajectories = _from_shared_memory(trajectories_descriptor)
+    _worker_shared_memory.append(shm)
+
+    _worker_sampler = SAMPLERS[sampler_name].from_arrays(arrays)
+
+
+def _propagate_shard(start: int, stop: int, n_steps: int, seed_sequence: np.random.SeedSequence, save_stride: int):
+    """
+    Propagate walkers [start, stop) of the shared output trajectories in place, over their first :code:`n_steps` steps.
+    """
+
+    rng = np.random.default_rng(seed_sequence)
+    propagate_trajectories(_worker_sampler, _worker_trajectories[start:stop, :n_steps], rng, save_stride)
+
+
+class ParallelTrajectoryPool:
+    """
+    A pool of worker processes attached to a sampler and an output buffer in shared memory, which can generate
+    trajectories many times over.
+
+    The sampler is copied into shared memory, and the pool is started, once, when the pool is created. Each call to
+    :code:`generate` then only writes the initial states and submits the shards, so generating a long run in many short
+    chunks doesn't pay for process startup or sampler copies per chunk.
+
+    Use as a context manager, or call :code:`close` when done, so the workers are stopped and the shared memory freed.
+    """
+
+    def __init__(self,
+                 sampler: BaseSampler,
+                 sampler_name: str,
+                 n_walkers: int,
+                 max_steps: int,
+                 n_workers: int = None,
+                 shard_size: int = DEFAULT_SHARD_SIZE,
+                 dtype: DTypeLike = int):
+        """
+        Parameters
+        ----------
+        sampler :
+            Built sampler used to draw transitions
+        sampler_name :
+            Name of the sampler in :code:`synd.models.discrete.samplers.SAMPLERS`
+        n_walkers :
+            Number of walkers generated by each call
+        max_steps :
+            Largest number of steps generated by any call
+        n_workers :
+            Number of worker processes. Defaults to the number of CPUs.
+        shard_size :
+            Number of walkers in each independently-seeded shard
+        dtype :
+            Dtype of the output trajectories
+        """
+
+        self.sampler = sampler
+        self.n_walkers = n_walkers
+        self.max_steps = max_steps
+
+        self.shard_bounds = [(start, min(start + shard_size, n_walkers)) for start in range(0, n_walkers, shard_size)]
+
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        self.n_workers = min(n_workers, len(self.shard_bounds))
+
+        self.trajectories = np.empty(shape=(n_walkers, max_steps), dtype=dtype)
+
+        self._shared_blocks = []
+        self._executor = None
+
+        # No need for a pool if there's only one worker -- this produces the same output, in process
+        if self.n_workers <= 1:
+            return
+
+        try:
+            sampler_descriptors = {}
+            for name, array in sampler.get_arrays().items():
+                shm, sampler_descriptors[name] = _to_shared_memory(array)
+                self._shared_blocks.append(shm)
+
+            trajectories_shm, trajectories_descriptor = _to_shared_memory(self.trajectories)
+            self._shared_blocks.append(trajectories_shm)
+
+            # Workers write straight into the shared output buffer
+            self.trajectories = np.ndarray(self.trajectories.shape, dtype=dtype, buffer=trajectories_shm.buf)
+
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.n_workers,
+                initializer=_initialize_worker,
+                initargs=(sampler_name, sampler_descriptors, trajectories_descriptor)
+            )
+
+        except BaseException:
+            self.close()
+            raise
+
+    def generate(self,
+                 initial_states: ArrayLike,
+                 n_steps: int,
+                 seed: Union[int, np.random.SeedSequence],
+                 save_stride: int = 1) -> np.ndarray:
+        """
+        Generate trajectories, sharding the initial states over the pool.
+
+        Parameters
+        ----------
+        initial_states :
+            Array of :code:`n_walkers` initial discrete states to propagate trajectories from
+        n_steps :
+            Number of steps forward to propagate from each initial state, at most :code:`max_steps`
+        seed :
+            Seed, or seed sequence, to spawn the per-shard random streams from
+        save_stride :
+            Number of transitions between each saved step
+
+        Returns
+        -------
+        Array of trajectories, of shape (n_walkers, n_steps)
+        """
+
+        initial_states = np.asarray(initial_states)
+
+        if initial_states.shape[0] != self.n_walkers:
+            raise ValueError(f"Pool was created for {self.n_walkers} walkers, but got {initial_states.shape[0]}")
+
+        if n_steps > self.max_steps:
+            raise ValueError(f"Pool was created for at most {self.max_steps} steps, but got {n_steps}")
+
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        shard_seeds = seed.spawn(len(self.shard_bounds))
+
+        trajectories = self.trajectories[:, :n_steps]
+        trajectories[:, 0] = initial_states
+
+        if self._executor is None:
+            for (start, stop), shard_seed in zip(self.shard_bounds, shard_seeds):
+                propagate_trajectories(
+                    self.sampler, trajectories[start:stop], np.random.default_rng(shard_seed), save_stride
+                )
+
+        else:
+            futures = [
+                self._executor.submit(_propagate_shard, start, stop, n_steps, shard_seed, save_stride)
+                for (start, stop), shard_seed in zip(self.shard_bounds, shard_seeds)
+            ]
+
+            # Surface any errors from the workers
+            for future in futures:
+                future.result()
+
+        return trajectories.copy()
+
+    def close(self):
+        """
+        Stop the workers, and free the shared memory.
+        """
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+        # Drop the view of the shared output before its block is closed
+        self.trajectories = None
+
+        for shm in self._shared_blocks:
+            shm.close()
+            shm.unlink()
+        self._shared_blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def generate_trajectories_parallel(sampler: BaseSampler,
+                                   sampler_name: str,
+                                   initial_states: ArrayLike,
+                                   n_steps: int,
+                                   seed: Union[int, np.random.SeedSequence],
+                                   n_workers: int = None,
+                                   shard_size: int = DEFAULT_SHARD_SIZE,
+                                   save_stride: int = 1,
+                                   dtype: DTypeLike = int) -> np.ndarray:
+    """
+    Generate trajectories by sharding the initial states over a pool of worker processes.
+
+    Walkers are split into shards of :code:`shard_size`, and each shard draws from its own stream spawned from
+    :code:`seed`. Because the shards don't depend on the number of workers, the output for a given seed is
+    identical no matter how many workers are used.
+
+    This starts and stops a :code:`ParallelTrajectoryPool` for a single call. To generate many times, i.e. in chunks,
+    create the pool once and reuse it.
+
+    Parameters
+    ----------
+    sampler :
+        Built sampler used to draw transitions
+    sampler_name :
+        Name of the sampler in :code:`synd.models.discrete.samplers.SAMPLERS`
+    initial_states :
+        Array of initial discrete states to propagate trajectories from
+    n_steps :
+        Number of steps forward to propagate from each initial state. Total trajectory length will be n_steps
+    seed :
+        Seed, or seed sequence, to spawn the per-shard random streams from
+    n_workers :
+        Number of worker processes. Defaults to the number of CPUs.
+    shard_size :
+        Number of walkers in each independently-seeded shard
+    save_stride :
+        Number of transitions between each saved step
+    dtype :
+        Dtype of the output trajectories
+
+    Returns
+    -------
+    Array of trajectories, of shape (n_walkers, n_steps)
+    """
+
+    initial_states = np.asarray(initial_states)
+
+    with ParallelTrajectoryPool(
+            sampler, sampler_name, initial_states.shape[0], n_steps, n_workers, shard_size, dtype
+    ) as pool:
+        return pool.generate(initial_states, n_steps, seed, save_stride)
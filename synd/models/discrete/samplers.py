@@ -0,0 +1,282 @@
+"""Samplers for drawing transitions of a discrete Markov chain."""
+from abc import ABC, abstractmethod
+import numpy as np
+from numpy.typing import ArrayLike
+from scipy import sparse
+
+
+class BaseSampler(ABC):
+    """
+    Abstract base class for transition samplers.
+
+    A sampler is built once from a transition matrix, and then maps an array of current states and an array of
+    uniform random numbers in [0, 1) to an array of next states.
+    """
+
+    #: Names of the array attributes that completely define a built sampler
+    array_attributes = ()
+
+    @abstractmethod
+    def sample(self, current_states: ArrayLike, uniforms: ArrayLike) -> np.ndarray:
+        """
+        Draw the next state for each walker.
+
+        Parameters
+        ----------
+        current_states :
+            Array of current discrete states, one per walker
+        uniforms :
+            Array of uniform random numbers in [0, 1), one per walker
+
+        Returns
+        -------
+        Array of next discrete states
+        """
+        pass
+
+    def get_arrays(self) -> dict:
+        """
+        Get the arrays defining this sampler.
+
+        Returns
+        -------
+        Dictionary mapping each of :code:`array_attributes` to its array
+        """
+
+        return {name: getattr(self, name) for name in self.array_attributes}
+
+    @classmethod
+    def from_arrays(cls, arrays: dict):
+        """
+        Reconstruct a sampler from the arrays returned by :code:`get_arrays`, without copying them.
+
+        Parameters
+        ----------
+        arrays :
+            Dictionary mapping each of :code:`array_attributes` to an array
+
+        Returns
+        -------
+        Sampler
+        """
+
+        sampler = cls.__new__(cls)
+        for name in cls.array_attributes:
+            setattr(sampler, name, arrays[name])
+
+        return sampler
+
+
+class CumulativeSampler(BaseSampler):
+    """
+    Samples from the dense row-wise cumulative transition probabilities.
+
+    Each step costs O(n_states) per walker, and the cumulative probabilities take as much memory as a dense transition
+    matrix.
+    """
+
+    array_attributes = ('cumulative_probabilities',)
+
+    def __init__(self, transition_matrix: ArrayLike):
+
+        if sparse.issparse(transition_matrix):
+            transition_matrix = transition_matrix.toarray()
+
+        self.cumulative_probabilities = np.cumsum(transition_matrix, axis=1)
+
+    def sample(self, current_states: ArrayLike, uniforms: ArrayLike) -> np.ndarray:
+
+        return np.argmin(
+            self.cumulative_probabilities[current_states].T
+            < uniforms,
+            axis=0,
+        )
+
+
+class SearchSortedSampler(BaseSampler):
+    """
+    Samples by searching cumulative probabilities built only over the nonzero elements of each row.
+
+    The cumulative probabilities of row :code:`i` are stored offset by :code:`i`, so that all rows form a single
+    sorted array, and a whole batch of walkers can be sampled with one :code:`np.searchsorted`.
+    Each step costs O(log nnz) per walker, and memory scales with the number of nonzero transitions.
+    """
+
+    array_attributes = ('indptr', 'indices', 'offset_cumulative_probabilities')
+
+    def __init__(self, transition_matrix: ArrayLike):
+
+        csr = sparse.csr_matrix(transition_matrix, dtype=float, copy=True)
+        csr.eliminate_zeros()
+        csr.sort_indices()
+
+        n_states = csr.shape[0]
+        row_lengths = np.diff(csr.indptr)
+        row_ids = np.repeat(np.arange(n_states), row_lengths)
+
+        cumulative = np.cumsum(csr.data)
+        row_starts = np.concatenate([[0.0], cumulative])[csr.indptr[:-1]]
+
+        self.indptr = csr.indptr
+        self.indices = csr.indices
+        self.offset_cumulative_probabilities = cumulative - row_starts[row_ids] + row_ids
+
+    def sample(self, current_states: ArrayLike, uniforms: ArrayLike) -> np.ndarray:
+
+        # Trajectories may be stored in small unsigned types, which would overflow in the offset arithmetic below
+        current_states = np.asarray(current_states, dtype=np.intp)
+
+        positions = np.searchsorted(
+            self.offset_cumulative_probabilities,
+            current_states + uniforms,
+            side='left'
+        )
+
+        # Guard against round-off in the offsets or row sums spilling the search into a neighboring row
+        positions = np.clip(positions, self.indptr[current_states], self.indptr[current_states + 1] - 1)
+
+        return self.indices[positions]
+
+
+class AliasSampler(BaseSampler):
+    """
+    Samples from per-row alias tables (Walker's alias method) built over the nonzero elements of each row.
+
+    Each step costs O(1) per walker, using a single uniform random number to select both a column and whether to take
+    its alias. Building the tables costs O(nnz), and memory scales with the number of nonzero transitions.
+    """
+
+    array_attributes = ('indptr', 'indices', 'alias_probabilities', 'aliases')
+
+    def __init__(self, transition_matrix: ArrayLike):
+
+        csr = sparse.csr_matrix(transition_matrix, dtype=float, copy=True)
+        csr.eliminate_zeros()
+        csr.sort_indices()
+
+        self.indptr = csr.indptr
+        self.indices = csr.indices
+        self.alias_probabilities = np.ones(csr.nnz)
+        self.aliases = csr.indices.copy()
+
+        for row in range(csr.shape[0]):
+            start, stop = csr.indptr[row], csr.indptr[row + 1]
+            row_probabilities, row_aliases = self._build_alias_table(csr.data[start:stop])
+
+            self.alias_probabilities[start:stop] = row_probabilities
+            self.aliases[start:stop] = csr.indices[start:stop][row_aliases]
+
+    @staticmethod
+    def _build_alias_table(probabilities: np.ndarray):
+        """
+        Build the alias table for a single discrete distribution, using Vose's algorithm.
+
+        Parameters
+        ----------
+        probabilities :
+            Array of (possibly unnormalized) probabilities
+
+        Returns
+        -------
+        Tuple of the probability of keeping each element, and the element it's aliased to otherwise
+        """
+
+        n_elements = len(probabilities)
+        scaled = probabilities * n_elements / probabilities.sum()
+
+        alias_probabilities = np.ones(n_elements)
+        aliases = np.arange(n_elements)
+
+        small = [i for i in range(n_elements) if scaled[i] < 1.0]
+        large = [i for i in range(n_elements) if scaled[i] >= 1.0]
+
+        while small and large:
+            _small = small.pop()
+            _large = large.pop()
+
+            alias_probabilities[_small] = scaled[_small]
+            aliases[_small] = _large
+
+            scaled[_large] = scaled[_large] + scaled[_small] - 1.0
+
+            if scaled[_large] < 1.0:
+                small.append(_large)
+            else:
+                large.append(_large)
+
+        # Anything left over is only off from 1 by round-off, so it's never aliased
+        return alias_probabilities, aliases
+
+    def sample(self, current_states: ArrayLike, uniforms: ArrayLike) -> np.ndarray:
+
+        current_states = np.asarray(current_states, dtype=np.intp)
+
+        row_starts = self.indptr[current_states]
+        row_lengths = self.indptr[current_states + 1] - row_starts
+
+        # Split a single uniform into the column to pick, and the uniform to test it against
+        scaled = uniforms * row_lengths
+        columns = np.minimum(scaled.astype(int), row_lengths - 1)
+        remainders = scaled - columns
+
+        positions = row_starts + columns
+
+        return np.where(
+            remainders < self.alias_probabilities[positions],
+            self.indices[positions],
+            self.aliases[positions]
+        )
+
+
+def propagate_trajectories(sampler: BaseSampler,
+                           trajectories: np.ndarray,
+                           rng: np.random.Generator,
+                           save_stride: int = 1):
+    """
+    Propagate trajectories in place, starting from the states in their first column.
+
+    Parameters
+    ----------
+    sampler :
+        Sampler used to draw each transition
+    trajectories :
+        Array of shape (n_walkers, n_steps), with initial states in the first column. Remaining columns are overwritten.
+    rng :
+        Random number generator to draw transitions with
+    save_stride :
+        Number of transitions between each saved column. Intermediate states are never stored.
+    """
+
+    n_trajectories, n_steps = trajectories.shape
+
+    if save_stride == 1:
+        probabilities = rng.random(size=(n_trajectories, n_steps - 1))
+
+        for istep in range(1, n_steps):
+            current_states = trajectories[:, istep - 1]
+
+            next_states = sampler.sample(current_states, probabilities[:, istep - 1])
+
+            trajectories[:, istep] = next_states
+
+        return
+
+    # With a stride, draw random numbers one saved step at a time, so memory doesn't scale with the stride
+    current_states = trajectories[:, 0]
+    probabilities = np.empty((save_stride, n_trajectories))
+
+    for istep in range(1, n_steps):
+        rng.random(out=probabilities)
+
+        for isubstep in range(save_stride):
+            current_states = sampler.sample(current_states, probabilities[isubstep])
+
+        trajectories[:, istep] = current_states
+
+
+#: Samplers available to :code:`MarkovGenerator`, by name
+SAMPLERS = {
+    'argmin': CumulativeSampler,
+    'searchsorted': SearchSortedSampler,
+    'alias': AliasSampler,
+}
@@ -0,0 +1,259 @@
+"""Compact storage for discrete trajectories."""
+from __future__ import annotations
+import numpy as np
+from numpy.typing import ArrayLike, DTypeLike
+from typing import Union
+
+
+def compact_dtype(max_value: int) -> np.dtype:
+    """
+    Get the smallest unsigned integer dtype that can hold every value up to :code:`max_value`.
+
+    Parameters
+    ----------
+    max_value :
+        The largest value that needs to be stored
+
+    Returns
+    -------
+    One of uint8, uint16, uint32 or uint64
+    """
+
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+
+    return np.dtype(np.uint64)
+
+
+class RunLengthTrajectories:
+    """
+    A set of discrete trajectories of equal length, stored run-length encoded, as the state and length of each run of
+    repeated states.
+
+    Runs are stored walker by walker, in order. The runs of walker :code:`i` are
+    :code:`walker_offsets[i]:walker_offsets[i+1]`. For metastable models, where trajectories spend long stretches in
+    the same state, this is far smaller than the decoded trajectories.
+
+    Trajectories can be indexed by walker, and by a contiguous range of steps, as
+    :code:`trajectories[walkers, start:stop]`, which returns another :code:`RunLengthTrajectories` without decoding.
+    """
+
+    def __init__(self, states: np.ndarray, run_lengths: np.ndarray, walker_offsets: np.ndarray, n_steps: int):
+        """
+        Parameters
+        ----------
+        states :
+            Array of the state of each run
+        run_lengths :
+            Array of the number of steps in each run
+        walker_offsets :
+            Array of shape (n_walkers + 1,), of the index of the first run of each walker, followed by the total
+            number of runs
+        n_steps :
+            Number of steps in each trajectory
+        """
+
+        self.states = states
+        self.run_lengths = run_lengths
+        self.walker_offsets = walker_offsets
+        self.n_steps = n_steps
+
+    @classmethod
+    def from_dense(cls, trajectories: np.ndarray, dtype: DTypeLike = None) -> RunLengthTrajectories:
+        """
+        Encode dense trajectories.
+
+        Parameters
+        ----------
+        trajectories :
+            Array of discrete trajectories, of shape (n_walkers, n_steps)
+        dtype :
+            Dtype to store states in. Defaults to that of the trajectories.
+
+        Returns
+        -------
+        Run-length encoded trajectories
+        """
+
+        trajectories = np.asarray(trajectories)
+        n_walkers, n_steps = trajectories.shape
+
+        # A run starts at the first step of every walker, and wherever the state changes
+        run_starts = np.ones((n_walkers, n_steps), dtype=bool)
+        run_starts[:, 1:] = trajectories[:, 1:] != trajectories[:, :-1]
+
+        walkers, steps = np.nonzero(run_starts)
+        run_counts = np.bincount(walkers, minlength=n_walkers)
+
+        # Runs end where the next one starts, or at the end of the trajectory
+        next_steps = np.append(steps[1:], n_steps)
+        next_steps[np.cumsum(run_counts) - 1] = n_steps
+
+        return cls(
+            states=trajectories[walkers, steps].astype(dtype or trajectories.dtype),
+            run_lengths=(next_steps - steps).astype(compact_dtype(n_steps)),
+            walker_offsets=np.concatenate([[0], np.cumsum(run_counts)]),
+            n_steps=n_steps,
+        )
+
+    @property
+    def n_walkers(self) -> int:
+        return self.walker_offsets.shape[0] - 1
+
+    @property
+    def shape(self) -> tuple:
+        """
+        Shape of the decoded trajectories.
+        """
+
+        return self.n_walkers, self.n_steps
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Total bytes used by the encoded trajectories.
+        """
+
+        return self.states.nbytes + self.run_lengths.nbytes + self.walker_offsets.nbytes
+
+    def _run_walkers(self) -> np.ndarray:
+        """
+        Get the walker each run belongs to.
+        """
+
+        return np.repeat(np.arange(self.n_walkers), np.diff(self.walker_offsets))
+
+    def _run_starts(self) -> np.ndarray:
+        """
+        Get the step each run starts at, within its trajectory.
+        """
+
+        ends = np.cumsum(self.run_lengths, dtype=np.int64)
+        starts = ends - self.run_lengths
+
+        first_runs = np.repeat(self.walker_offsets[:-1], np.diff(self.walker_offsets))
+
+        return starts - starts[first_runs]
+
+    def _select_walkers(self, walkers: Union[int, slice, ArrayLike]) -> RunLengthTrajectories:
+
+        walkers = np.arange(self.n_walkers)[walkers].reshape(-1)
+
+        run_counts = np.diff(self.walker_offsets)[walkers]
+        walker_offsets = np.concatenate([[0], np.cumsum(run_counts)])
+
+        # Gather each selected walker's runs, in order
+        runs = np.repeat(self.walker_offsets[walkers] - walker_offsets[:-1], run_counts) + np.arange(walker_offsets[-1])
+
+        return RunLengthTrajectories(self.states[runs], self.run_lengths[runs], walker_offsets, self.n_steps)
+
+    def _select_steps(self, steps: slice) -> RunLengthTrajectories:
+
+        start, stop, stride = steps.indices(self.n_steps)
+        if stride != 1:
+            raise IndexError("Run-length encoded trajectories can only be sliced over contiguous steps")
+        stop = max(start, stop)
+
+        run_starts = self._run_starts()
+        run_ends = run_starts + self.run_lengths
+
+        keep = (run_starts < stop) & (run_ends > start)
+        run_lengths = np.minimum(run_ends[keep], stop) - np.maximum(run_starts[keep], start)
+
+        run_counts = np.bincount(self._run_walkers()[keep], minlength=self.n_walkers)
+
+        return RunLengthTrajectories(
+            self.states[keep],
+            run_lengths.astype(self.run_lengths.dtype),
+            np.concatenate([[0], np.cumsum(run_counts)]),
+            stop - start
+        )
+
+    def __getitem__(self, key) -> RunLengthTrajectories:
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if len(key) > 2:
+            raise IndexError("Trajectories can only be indexed by walker and step")
+
+        selected = self._select_walkers(key[0])
+
+        if len(key) == 2:
+            if not isinstance(key[1], slice):
+                raise IndexError("Steps can only be indexed by a slice")
+            selected = selected._select_steps(key[1])
+
+        return selected
+
+    def __len__(self) -> int:
+        return self.n_walkers
+
+    def decode(self) -> np.ndarray:
+        """
+        Decode to dense trajectories.
+
+        Returns
+        -------
+        Array of discrete states, of shape (n_walkers, n_steps)
+        """
+
+        return np.repeat(self.states, self.run_lengths).reshape(self.n_walkers, self.n_steps)
+
+    def __array__(self, dtype=None, copy=None):
+
+        decoded = self.decode()
+        return decoded if dtype is None else decoded.astype(dtype)
+
+    def backmap(self, model, mapper: str = 'default') -> np.ndarray:
+        """
+        Backmap to full coordinates. Each distinct state is only backmapped once.
+
+        Parameters
+        ----------
+        model :
+            The model to backmap with
+        mapper :
+            Name of the backmapper to use
+
+        Returns
+        -------
+        Array of coordinates, of shape (n_walkers, n_steps, *feature_shape)
+        """
+
+        unique_states, inverse = np.unique(self.states, return_inverse=True)
+        unique_coordinates = np.asarray(model.backmap(unique_states, mapper))
+
+        run_coordinates = unique_coordinates[inverse.reshape(-1)]
+
+        return np.repeat(run_coordinates, self.run_lengths, axis=0).reshape(
+            self.n_walkers, self.n_steps, *unique_coordinates.shape[1:]
+        )
+
+    def save(self, filename: str):
+        """
+        Save the encoded trajectories to a .npz file.
+        """
+
+        np.savez(
+            filename,
+            states=self.states,
+            run_lengths=self.run_lengths,
+            walker_offsets=self.walker_offsets,
+            n_steps=self.n_steps
+        )
+
+    @classmethod
+    def load(cls, filename: str) -> RunLengthTrajectories:
+        """
+        Load encoded trajectories saved by :code:`save`.
+        """
+
+        with np.load(filename) as npzfile:
+            return cls(
+                states=npzfile['states'],
+                run_lengths=npzfile['run_lengths'],
+                walker_offsets=npzfile['walker_offsets'],
+                n_steps=int(npzfile['n_steps'])
+            )
@@ -0,0 +1,214 @@
+"""
+Versioned binary file format for SynD models, which can be loaded with memory-mapping.
+
+A model file is laid out as:
+
+=============  ==========  =======================================================================================
+Offset         Size        Contents
+=============  ==========  =======================================================================================
+0              8 bytes     Magic bytes, :code:`b"SYNDBIN\\x00"`
+8              4 bytes     Format version, as a little-endian uint32
+12             4 bytes     Reserved, zero
+16             8 bytes     Length of the header in bytes, as a little-endian uint64
+24             (header)    UTF-8 encoded JSON header
+(aligned)      (arrays)    Raw array data, each array starting at a multiple of 64 bytes from the start of the file
+=============  ==========  =======================================================================================
+
+The JSON header has the keys
+
+- :code:`format_version`: The format version
+- :code:`model_class`: The fully qualified name of the model class
+- :code:`metadata`: Model-specific, JSON-serializable metadata
+- :code:`arrays`: Maps each array name to its :code:`dtype` (as a NumPy type string, including byte order),
+  :code:`shape`, and byte :code:`offset` from the start of the file
+
+Arrays are stored C-contiguous, so on load each one is an :code:`np.memmap` of its region of the file.
+Opening a model is therefore near-instant regardless of its size, and multiple processes loading the same model share
+its pages through the OS page cache.
+
+Models that support this format implement :code:`_get_binary_state`, returning a tuple of metadata and a dictionary
+of arrays, and a :code:`_from_binary_state(metadata, arrays)` classmethod that reconstructs the model from them.
+Anything that can't be represented as arrays, like arbitrary callable backmappers, is stored as a pickled byte array.
+"""
+import importlib
+import json
+import os
+import struct
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+from typing import BinaryIO, Union
+
+MAGIC = b"SYNDBIN\x00"
+
+#: Current version of the binary model format
+FORMAT_VERSION = 1
+
+ALIGNMENT = 64
+
+_PREAMBLE = struct.Struct("<8sIIQ")
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def is_binary_model(filename: str) -> bool:
+    """
+    Check whether a file is a SynD binary model file.
+
+    Parameters
+    ----------
+    filename
+        Path to a SynD model file
+
+    Returns
+    -------
+    True if the file starts with the binary format's magic bytes
+    """
+
+    with open(filename, 'rb') as infile:
+        return infile.read(len(MAGIC)) == MAGIC
+
+
+@contextmanager
+def atomic_write(filename: Union[str, os.PathLike]):
+    """
+    Open a temporary file next to :code:`filename` for writing, and move it into place once it's fully written.
+
+    Loaded binary models memory-map the file they came from, so writing to that path in place would truncate the file
+    under them, and write out a corrupt model. Replacing the file instead leaves the old one intact for as long as
+    it's mapped. If writing fails, the original file is left untouched.
+
+    Parameters
+    ----------
+    filename
+        Path to write to
+
+    Yields
+    ------
+    A writable binary file object
+    """
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temporary_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(filename) + '.', suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            yield outfile
+
+        # Keep the permissions of the file being replaced, or the default permissions for a new file
+        if os.path.exists(filename):
+            os.chmod(temporary_path, os.stat(filename).st_mode & 0o7777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temporary_path, 0o666 & ~umask)
+
+        os.replace(temporary_path, filename)
+
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def write_binary_model(model, outfile: Union[str, BinaryIO]):
+    """
+    Write a SynD model to a file in the binary model format.
+
+    Arrays are written one at a time, directly from the model, so the whole serialized model is never held in memory.
+
+    Parameters
+    ----------
+    model
+        SynD model implementing :code:`_get_binary_state`
+    outfile
+        Name of the file to save the model to, or a writable binary file object. File objects are written
+        sequentially, so they may be streams, such as compressors.
+    """
+
+    if isinstance(outfile, (str, os.PathLike)):
+        with atomic_write(outfile) as of:
+            write_binary_model(model, of)
+        return
+
+    metadata, arrays = model._get_binary_state()
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+    model_class = type(model)
+
+    array_entries = {}
+    header = {
+        'format_version': FORMAT_VERSION,
+        'model_class': f"{model_class.__module__}.{model_class.__qualname__}",
+        'metadata': metadata,
+        'arrays': array_entries,
+    }
+
+    # Array offsets depend on the header length, which depends on the offsets, so first lay the arrays out assuming
+    #   a generous header size, and then check it fits.
+    header_space = ALIGNMENT
+    while True:
+        offset = _align(_PREAMBLE.size + header_space)
+        for name, array in arrays.items():
+            array_entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            offset = _align(offset + array.nbytes)
+
+        encoded_header = json.dumps(header).encode('utf-8')
+        if len(encoded_header) <= header_space:
+            break
+        header_space = _align(len(encoded_header))
+
+    outfile.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, 0, header_space))
+    outfile.write(encoded_header.ljust(header_space))
+    position = _PREAMBLE.size + header_space
+
+    for name, array in arrays.items():
+        outfile.write(b"\x00" * (array_entries[name]['offset'] - position))
+        outfile.write(memoryview(array).cast('B'))
+        position = array_entries[name]['offset'] + array.nbytes
+
+
+def read_binary_model(filename: str, mmap_mode: str = 'r'):
+    """
+    Load a SynD model from a file in the binary model format.
+
+    Parameters
+    ----------
+    filename
+        Path to a SynD binary model file
+    mmap_mode
+        Mode to memory-map arrays with, as for :code:`np.memmap`. If None, arrays are read into memory instead.
+
+    Returns
+    -------
+        SynD model
+    """
+
+    with open(filename, 'rb') as infile:
+        magic, version, _, header_length = _PREAMBLE.unpack(infile.read(_PREAMBLE.size))
+
+        if magic != MAGIC:
+            raise ValueError(f"{filename} is not a SynD binary model file")
+
+        if version > FORMAT_VERSION:
+            raise ValueError(f"{filename} uses binary model format version {version}, but this version of SynD only "
+                             f"supports up to version {FORMAT_VERSION}")
+
+        header = json.loads(infile.read(header_length).decode('utf-8'))
+
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        dtype, shape, offset = np.dtype(entry['dtype']), tuple(entry['shape']), entry['offset']
+
+        # Empty arrays can't be memory-mapped
+        if mmap_mode is None or np.prod(shape) == 0:
+            arrays[name] = np.fromfile(filename, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        else:
+            arrays[name] = np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=offset, shape=shape)
+
+    module_name, class_name = header['model_class'].rsplit('.', 1)
+    model_class = getattr(importlib.import_module(module_name), class_name)
+
+    return model_class._from_binary_state(header['metadata'], arrays)
@@ -1,6 +1,7 @@
 import westpa
 import pickle
-from .propagator import get_segment_parent_index, get_segment_index
+import numpy as np
+from .propagator import get_segments_ibstate_discrete_indices, get_state_index, get_instrumentation
 
 
 class SynDAugmentationDriver:
@@ -15,6 +16,8 @@ class SynDAugmentationDriver:
             plugins:
             - plugin: synd.westpa.augmentation_driver.SynDAugmentationDriver
                   coord_map: Pickled dictionary mapping discrete state indices to an array of coordinates
+                  compression: (Optional) HDF5 compression filter for auxdata/coord, i.e. gzip or lzf
+                  compression_opts: (Optional) Options for the compression filter, i.e. the gzip level
     """
 
     def __init__(self, sim_manager, plugin_config):
@@ -33,39 +36,114 @@ class SynDAugmentationDriver:
         with open(coord_map_path, 'rb') as infile:
             self.coord_map = pickle.load(infile)
 
+        self.coord_table = self.build_coord_table(self.coord_map)
+
+        self.compression = plugin_config.get('compression', None)
+        self.compression_opts = plugin_config.get('compression_opts', None)
+
         # Big number is low priority -- this should run before anything else
         self.priority = plugin_config.get('priority', 1)
 
         sim_manager.register_callback(sim_manager.post_propagation, self.augment_coordinates, self.priority)
 
-    def augment_coordinates(self):
+    @staticmethod
+    def build_coord_table(coord_map) -> np.ndarray:
         """
-        After propagation completes in a WE iteration, this populates auxdata/coord with the coordinates.
+        Build a dense lookup table from a coordinate map, so a whole iteration's coordinates can be gathered at once.
+
+        Parameters
+        ----------
+        coord_map :
+            Dictionary (or array) mapping discrete state indices to an array of coordinates
+
+        Returns
+        -------
+        Array of shape (n_states, *feature_shape)
         """
 
-        iter_group = self.data_manager.get_iter_group(self.sim_manager.n_iter)
-        segments = self.data_manager.get_segments(
-            n_iter=self.sim_manager.n_iter, load_pcoords=True
-        )
+        if isinstance(coord_map, dict):
+            n_states = max(coord_map.keys()) + 1
 
-        feature_shape = self.coord_map[0].squeeze().shape
-        n_walkers = len(segments)
+            # Every state up to the largest one must be mapped, rather than silently given zero coordinates
+            missing_states = sorted(set(range(n_states)) - set(coord_map.keys()))
+            if missing_states:
+                raise KeyError(f"Coordinate map is missing discrete states {missing_states}")
 
-        # Create auxdata/coord for the current iteration
-        self.data_manager.we_h5file.require_dataset(
-            f"{iter_group.name}/auxdata/coord",
-            shape=(n_walkers, 2, *feature_shape),
-            dtype=self.coord_map[0].dtype
-        )
+            example_coords = np.asarray(next(iter(coord_map.values())))
+            feature_shape = example_coords.squeeze().shape
 
-        self.data_manager.flush_backing()
+            coord_table = np.empty((n_states, *feature_shape), dtype=example_coords.dtype)
+            for state_index, coords in coord_map.items():
+                coord_table[state_index] = np.asarray(coords).reshape(feature_shape)
 
-        auxcoord_dataset = self.data_manager.we_h5file[f"{iter_group.name}/auxdata/coord"]
+        else:
+            feature_shape = np.asarray(coord_map[0]).squeeze().shape
+            coord_table = np.asarray(coord_map).reshape(-1, *feature_shape)
 
-        for i, segment in enumerate(segments):
+        return coord_table
 
-            segment_state_index = get_segment_index(segment)
-            parent_state_index = get_segment_parent_index(segment)
+    def augment_coordinates(self):
+        """
+        After propagation completes in a WE iteration, this populates auxdata/coord with the coordinates.
+        """
+
+        n_iter = self.sim_manager.n_iter
+
+        instrumentation = get_instrumentation()
+
+        iter_group = self.data_manager.get_iter_group(n_iter)
+
+        # The master already holds every propagated segment, along with its discrete trajectory
+        segments = list(self.sim_manager.segments.values())
+
+        feature_shape = self.coord_table.shape[1:]
+        n_walkers = len(segments)
 
-            auxcoord_dataset[segment.seg_id, 0] = self.coord_map[parent_state_index]
-            auxcoord_dataset[segment.seg_id, 1] = self.coord_map[segment_state_index]
+        with instrumentation.phase('augment/state_lookup'):
+            state_index = get_state_index()
+            state_index.update(n_iter, segments)
+
+            seg_ids = np.array([segment.seg_id for segment in segments], dtype=int)
+            parent_ids = np.array([segment.parent_id for segment in segments], dtype=int)
+
+            segment_state_indices = state_index.get(n_iter, seg_ids)
+
+            # Parents that were segments in the last iteration can be looked up all at once.
+            #   Parents that were initial/basis states are identified from their state definitions.
+            parent_state_indices = np.empty(n_walkers, dtype=int)
+            parent_was_segment = parent_ids >= 0
+
+            if parent_was_segment.any():
+                parent_state_indices[parent_was_segment] = state_index.get(
+                    n_iter - 1, parent_ids[parent_was_segment]
+                )
+
+            if not parent_was_segment.all():
+                parent_state_indices[~parent_was_segment] = get_segments_ibstate_discrete_indices(
+                    [segments[i] for i in np.flatnonzero(~parent_was_segment)]
+                )
+
+        # Gather every walker's coordinates, and write them in one block
+        with instrumentation.phase('augment/gather_coords'):
+            coords = np.empty((n_walkers, 2, *feature_shape), dtype=self.coord_table.dtype)
+            coords[seg_ids, 0] = self.coord_table[parent_state_indices]
+            coords[seg_ids, 1] = self.coord_table[segment_state_indices]
+
+        with instrumentation.phase('augment/write_coords'):
+            # Create auxdata/coord for the current iteration
+            # Compressed datasets must be chunked, so let h5py pick a chunk shape in that case
+            chunks = True if self.compression is not None else None
+            auxcoord_dataset = self.data_manager.we_h5file.require_dataset(
+                f"{iter_group.name}/auxdata/coord",
+                shape=(n_walkers, 2, *feature_shape),
+                dtype=self.coord_table.dtype,
+                chunks=chunks,
+                compression=self.compression,
+                compression_opts=self.compression_opts,
+            )
+
+            auxcoord_dataset[...] = coords
+
+            self.data_manager.flush_backing()
+
+        instrumentation.add_bytes('augment/write_coords', coords.nbytes)
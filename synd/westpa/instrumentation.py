@@ -0,0 +1,168 @@
+"""Optional per-phase timing and counters for the SynD WESTPA propagator and plugins."""
+import csv
+import os
+import time
+from contextlib import nullcontext
+import numpy as np
+
+#: Columns recorded for each phase, in order
+RECORD_FIELDS = ('wall_time', 'n_calls', 'n_bytes')
+
+# Shared no-op context manager returned for every phase while instrumentation is disabled
+_DISABLED_PHASE = nullcontext()
+
+
+class _Phase:
+    """
+    Context manager timing a single pass through a phase.
+    """
+
+    __slots__ = ('instrumentation', 'name', 'start')
+
+    def __init__(self, instrumentation, name: str):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.record(self.name, wall_time=time.perf_counter() - self.start)
+
+
+class Instrumentation:
+    """
+    Accumulates wall time, call counts and bytes written for named phases, over one iteration.
+
+    When disabled, :code:`phase` returns a shared no-op context manager and :code:`record` returns immediately, so
+    instrumented code costs an attribute lookup and a branch per phase.
+
+    Records are kept as a dictionary mapping each phase name to a [wall_time, n_calls, n_bytes] list, which is
+    cheap to pickle, so records from worker processes can be shipped back and merged on the master.
+    """
+
+    def __init__(self, enabled: bool = False):
+        """
+        Parameters
+        ----------
+        enabled :
+            Whether to record anything
+        """
+
+        self.enabled = enabled
+        self.records = {}
+
+    def phase(self, name: str):
+        """
+        Time a phase, as a context manager. Each use counts as one call.
+
+        Parameters
+        ----------
+        name :
+            Name of the phase
+        """
+
+        if not self.enabled:
+            return _DISABLED_PHASE
+
+        return _Phase(self, name)
+
+    def record(self, name: str, wall_time: float = 0.0, n_calls: int = 1, n_bytes: int = 0):
+        """
+        Add wall time, calls and bytes written to a phase.
+
+        Parameters
+        ----------
+        name :
+            Name of the phase
+        wall_time :
+            Wall time spent in the phase, in seconds
+        n_calls :
+            Number of calls to add
+        n_bytes :
+            Number of bytes written to add
+        """
+
+        if not self.enabled:
+            return
+
+        record = self.records.setdefault(name, [0.0, 0, 0])
+        record[0] += wall_time
+        record[1] += n_calls
+        record[2] += n_bytes
+
+    def add_bytes(self, name: str, n_bytes: int):
+        """
+        Add bytes written to a phase, without counting a call.
+        """
+
+        self.record(name, n_calls=0, n_bytes=n_bytes)
+
+    def merge(self, records: dict):
+        """
+        Add records from another :code:`Instrumentation`, i.e. one from a worker process.
+        """
+
+        for name, (wall_time, n_calls, n_bytes) in records.items():
+            self.record(name, wall_time, n_calls, n_bytes)
+
+    def pop_records(self) -> dict:
+        """
+        Get the accumulated records, and start accumulating from zero.
+        """
+
+        records = self.records
+        self.records = {}
+
+        return records
+
+    @staticmethod
+    def to_table(records: dict) -> np.ndarray:
+        """
+        Convert records to a structured array with a row per phase, sorted by phase name.
+
+        Returns
+        -------
+        Structured array with fields :code:`phase`, :code:`wall_time`, :code:`n_calls` and :code:`n_bytes`
+        """
+
+        names = sorted(records)
+        max_name_length = max([len(name) for name in names], default=1)
+
+        table = np.zeros(
+            len(names),
+            dtype=[('phase', f'S{max_name_length}'), ('wall_time', float), ('n_calls', int), ('n_bytes', int)]
+        )
+
+        for row, name in zip(table, names):
+            row['phase'] = name.encode()
+            row['wall_time'], row['n_calls'], row['n_bytes'] = records[name]
+
+        return table
+
+    @staticmethod
+    def append_csv(path: str, n_iter: int, records: dict):
+        """
+        Append an iteration's records to a CSV file, with a row per phase. The header is written if the file is new.
+
+        Parameters
+        ----------
+        path :
+            Path to the CSV file
+        n_iter :
+            Iteration the records belong to
+        records :
+            Records to write
+        """
+
+        write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+
+        with open(path, 'a', newline='') as outfile:
+            writer = csv.writer(outfile)
+
+            if write_header:
+                writer.writerow(('n_iter', 'phase', *RECORD_FIELDS))
+
+            for name in sorted(records):
+                writer.writerow((n_iter, name, *records[name]))
@@ -5,27 +5,181 @@ import westpa
 import pickle
 from westpa.core.states import InitialState, BasisState
 import mdtraj as md
-from copy import deepcopy
 
 import synd.core
 from synd.models.discrete.markov import MarkovGenerator
+from synd.westpa.instrumentation import Instrumentation
 
+# Segment data key that carries instrumentation records from the workers back to the master.
+#   WESTPA doesn't write data under iterh5/ to auxdata, so this never reaches the H5 file.
+INSTRUMENTATION_KEY = 'iterh5/synd_instrumentation'
 
-def get_segment_index(segment):
 
-    data_manager = westpa.rc.data_manager
+def backmap_trajectories(synd_model, trajectories: np.ndarray, mapper: str = 'default') -> np.ndarray:
+    """
+    Backmap a batch of discrete trajectories in a single vectorized call.
+
+    Each distinct state is only backmapped once, and the results are scattered back to every point it appears at.
+
+    Parameters
+    ----------
+    synd_model :
+        The SynD model to backmap with
+    trajectories :
+        Array of discrete states, of shape (n_segments, n_points)
+    mapper :
+        Name of the backmapper to use
+
+    Returns
+    -------
+    Array of coordinates, of shape (n_segments, n_points, *feature_shape)
+    """
 
-    # If this segment was just created, it doesn't have a state index, so get it from its bstate
-    if segment.parent_id < 0:
+    unique_states, inverse = np.unique(trajectories.ravel(), return_inverse=True)
+    unique_coordinates = np.asarray(synd_model.backmap(unique_states, mapper))
 
-        segment_state_index = get_segment_ibstate_discrete_index(segment)
+    return unique_coordinates[inverse].reshape(*trajectories.shape, *unique_coordinates.shape[1:])
 
-    else:
 
-        # TODO: Would be nice to avoid explicitly reading the H5 file
-        iter_group = data_manager.get_iter_group(segment.n_iter)
-        auxdata = iter_group['auxdata/state_indices']
-        segment_state_index = auxdata[segment.seg_id][-1]
+class SegmentStateIndex:
+    """
+    In-memory index of the final discrete state index of each segment, for the current and previous iterations.
+
+    The master already holds every propagated segment, including its discrete trajectory, so keeping this up to date
+    doesn't touch the H5 file. The H5 file is only read to rebuild an iteration that isn't in memory, i.e. after a
+    restart.
+    """
+
+    def __init__(self):
+
+        # Maps an iteration number to an array of final state indices, indexed by seg_id
+        self.final_state_indices = {}
+
+    def update(self, n_iter: int, segments):
+        """
+        Record the final state indices of an iteration's segments, and forget anything older than the iteration
+        before it.
+
+        Parameters
+        ----------
+        n_iter :
+            The iteration the segments belong to
+        segments :
+            Iterable of the iteration's propagated segments
+        """
+
+        segments = list(segments)
+
+        # If we don't have trajectories for every segment, then fall back to the H5 file
+        if not all('state_indices' in segment.data for segment in segments):
+            self.rebuild(n_iter)
+
+        else:
+            seg_ids = np.array([segment.seg_id for segment in segments], dtype=int)
+            final_state_indices = np.full(seg_ids.max(initial=-1) + 1, fill_value=-1, dtype=int)
+            final_state_indices[seg_ids] = [segment.data['state_indices'][-1] for segment in segments]
+
+            self.final_state_indices[n_iter] = final_state_indices
+
+        for stale_iter in [_iter for _iter in self.final_state_indices if _iter < n_iter - 1]:
+            del self.final_state_indices[stale_iter]
+
+    def rebuild(self, n_iter: int):
+        """
+        Rebuild an iteration's final state indices from auxdata/state_indices in the H5 file.
+        """
+
+        iter_group = westpa.rc.get_data_manager().get_iter_group(n_iter)
+        self.final_state_indices[n_iter] = iter_group['auxdata/state_indices'][:, -1].astype(int)
+
+    def get(self, n_iter: int, seg_ids):
+        """
+        Get the final state indices of segments in an iteration.
+
+        Parameters
+        ----------
+        n_iter :
+            The iteration the segments belong to
+        seg_ids :
+            A segment ID, or array of segment IDs
+
+        Returns
+        -------
+        Final discrete state index, or array of them
+        """
+
+        if n_iter not in self.final_state_indices:
+            self.rebuild(n_iter)
+
+        return self.final_state_indices[n_iter][seg_ids]
+
+
+def get_state_index() -> SegmentStateIndex:
+    """
+    Get the segment state index owned by the SynD propagator.
+    """
+
+    return westpa.rc.get_propagator().state_index
+
+
+def get_auxref_indices() -> dict:
+    """
+    Get the cache of discrete indices of basis/initial state auxrefs, owned by the SynD propagator.
+
+    The mapping from auxref to discrete index doesn't change over a run, so caching it avoids repeatedly reading the
+    H5 file for H5-defined states. Because it's owned by the propagator, it doesn't outlive the run, so a process
+    running several simulations, or against a different H5 file, never sees stale lookups.
+    """
+
+    return westpa.rc.get_propagator().auxref_indices
+
+
+def get_instrumentation() -> Instrumentation:
+    """
+    Get the instrumentation owned by the SynD propagator.
+    """
+
+    return westpa.rc.get_propagator().instrumentation
+
+
+def export_instrumentation():
+    """
+    Collect the current iteration's instrumentation records from the master and from every propagated segment, and
+    write them as a table to the propagator's CSV file, and to iter_XXX/synd_instrumentation in the H5 file.
+
+    This runs during finalize_iteration, after everything else.
+    """
+
+    sim_manager = westpa.rc.get_sim_manager()
+    propagator = westpa.rc.get_propagator()
+    instrumentation = propagator.instrumentation
+
+    for segment in sim_manager.segments.values():
+        worker_records = segment.data.pop(INSTRUMENTATION_KEY, None)
+        if worker_records is not None:
+            instrumentation.merge(worker_records)
+
+    records = instrumentation.pop_records()
+
+    Instrumentation.append_csv(propagator.instrumentation_file, sim_manager.n_iter, records)
+
+    data_manager = westpa.rc.get_data_manager()
+    iter_group = data_manager.get_iter_group(sim_manager.n_iter)
+    if 'synd_instrumentation' in iter_group:
+        del iter_group['synd_instrumentation']
+    iter_group.create_dataset('synd_instrumentation', data=Instrumentation.to_table(records))
+
+
+def get_segment_index(segment):
+    """
+    For a given propagated segment, identify its final discrete index.
+    """
+
+    if 'state_indices' in segment.data:
+        segment_state_index = segment.data['state_indices'][-1]
+
+    else:
+        segment_state_index = get_state_index().get(segment.n_iter, segment.seg_id)
 
     return int(segment_state_index)
 
@@ -34,7 +188,7 @@ def get_segment_parent_index(segment):
     """
     For a given segment, identify the discrete index of its parent.
 
-    For parents that are plain segments, get it from the auxdata.
+    For parents that are plain segments, get it from the propagator's segment state index.
 
     For parents that are initial/basis states, get it from the state definition's auxref.
     """
@@ -44,9 +198,7 @@ def get_segment_parent_index(segment):
     # At the beginning of propagation, nothing's been written to the H5 file yet, so we can't use westpa.analysis
     #   to obtain the parent.
     # In augmentation, it's fine in theory to just look in the H5 file (i.e. with westpa.analysis), but it comes
-    #   at a massive performance hit.
-
-    data_manager = westpa.rc.get_data_manager()
+    #   at a massive performance hit, so we look in the in-memory SegmentStateIndex instead.
 
     # If the parent id is >= 0, then the parent was a segment, and we can get its index directly.
     #   Otherwise, we have to get it from the ibstate auxdata
@@ -59,10 +211,7 @@ def get_segment_parent_index(segment):
             return parent_state_index
 
         else:
-            prev_segments = data_manager.get_segments(
-                n_iter=segment.n_iter - 1, seg_ids=[segment.parent_id], load_pcoords=False
-            )
-            parent_state_index = get_segment_index(prev_segments[0])
+            parent_state_index = get_state_index().get(segment.n_iter - 1, segment.parent_id)
 
     # Otherwise, that means the segment was a bstate/istate
     else:
@@ -71,14 +220,47 @@ def get_segment_parent_index(segment):
     return int(parent_state_index)
 
 
-def get_segment_ibstate_discrete_index(segment):
+def get_segment_parent_indices(segments) -> np.ndarray:
     """
-    Given an ibstate, returns the discrete index of the SynD state that generated it
+    Identify the discrete index of the parent of each of a batch of segments from the same iteration.
+
+    This is equivalent to calling :code:`get_segment_parent_index` on each segment, but looks up all segment parents
+    in the segment state index at once, and resolves all initial/basis state parents with a single data manager call.
     """
-    sim_manager = westpa.rc.get_sim_manager()
-    data_manager = westpa.rc.get_data_manager()
 
-    istate = data_manager.get_segment_initial_states([segment])[0]
+    parent_indices = np.empty(len(segments), dtype=int)
+
+    from_segments = []
+    from_ibstates = []
+
+    for i, segment in enumerate(segments):
+
+        if segment.parent_id < 0:
+            from_ibstates.append(i)
+
+        elif 'parent_final_state_index' in segment.data:
+            parent_indices[i] = segment.data['parent_final_state_index']
+
+        else:
+            from_segments.append(i)
+
+    if len(from_segments) > 0:
+        n_iter = segments[from_segments[0]].n_iter
+        parent_ids = [segments[i].parent_id for i in from_segments]
+        parent_indices[from_segments] = get_state_index().get(n_iter - 1, parent_ids)
+
+    if len(from_ibstates) > 0:
+        parent_indices[from_ibstates] = get_segments_ibstate_discrete_indices(
+            [segments[i] for i in from_ibstates]
+        )
+
+    return parent_indices
+
+
+def get_istate_auxref(istate: InitialState, bstates):
+    """
+    Given an istate, returns the auxref of the SynD state that generated it.
+    """
 
     if istate.istate_type is InitialState.ISTATE_TYPE_BASIS:
 
@@ -87,30 +269,74 @@ def get_segment_ibstate_discrete_index(segment):
         #   states are mapped directly to basis states)
         # bstate_id = -(segment.parent_id + 1)
         bstate_id = istate.basis_state_id
-        parent_state_index = sim_manager.current_iter_bstates[bstate_id].auxref
+        auxref = bstates[bstate_id].auxref
 
     elif istate.istate_type is InitialState.ISTATE_TYPE_GENERATED:
         bstate_id = istate.basis_state_id
-        parent_state_index = sim_manager.current_iter_bstates[bstate_id].auxref
+        auxref = bstates[bstate_id].auxref
 
     elif istate.istate_type is InitialState.ISTATE_TYPE_START:
-        parent_state_index = istate.basis_auxref
+        auxref = istate.basis_auxref
 
     else:
         raise Exception(f"Couldn't get parent state for istate {istate}")
 
+    return auxref
+
+
+def get_auxref_discrete_index(auxref) -> int:
+    """
+    Given a basis/initial state auxref, returns the discrete index of the SynD state it refers to.
+
+    H5-defined states are read from the H5 file, so use :code:`get_auxref_indices` to look up cached results instead.
+    """
+
     # It's possible the parent ib state of this segment is an H5-defined state.
     # If that's the case, then we need to look up the discrete index for that state.
-    if type(parent_state_index) is not int and 'hdf:' in parent_state_index:
+    if type(auxref) is not int and 'hdf:' in auxref:
         # Make a dummy bstate, so we can get cached values
-        dummy_bstate = BasisState(label='_', probability=0, auxref=parent_state_index)
+        dummy_bstate = BasisState(label='_', probability=0, auxref=auxref)
         cached_state, (_, _, seg_id) = dummy_bstate.get_h5_cached_segment_value(
             key='auxdata/state_indices'
         )
 
-        parent_state_index = cached_state
+        return int(cached_state)
+
+    return int(auxref)
+
+
+def get_segments_ibstate_discrete_indices(segments) -> np.ndarray:
+    """
+    Given a batch of segments whose parents are ibstates, returns the discrete index of the SynD state that generated
+    each of them.
+
+    All initial states are fetched from the data manager in a single call.
+    """
+    sim_manager = westpa.rc.get_sim_manager()
+    data_manager = westpa.rc.get_data_manager()
+
+    istates = {istate.state_id: istate for istate in data_manager.get_segment_initial_states(segments)}
+
+    auxref_indices = get_auxref_indices()
+    discrete_indices = np.empty(len(segments), dtype=int)
+
+    for i, segment in enumerate(segments):
+        auxref = get_istate_auxref(istates[-(segment.parent_id + 1)], sim_manager.current_iter_bstates)
+
+        if auxref not in auxref_indices:
+            auxref_indices[auxref] = get_auxref_discrete_index(auxref)
+
+        discrete_indices[i] = auxref_indices[auxref]
 
-    return parent_state_index
+    return discrete_indices
+
+
+def get_segment_ibstate_discrete_index(segment):
+    """
+    Given an ibstate, returns the discrete index of the SynD state that generated it
+    """
+
+    return get_segments_ibstate_discrete_indices([segment])[0]
 
 
 def copy_segment_data():
@@ -124,16 +350,22 @@ def copy_segment_data():
      with cur_iter_* properties.
     In other words, this means that cur_iter_istates are NOT the istates for `next_iter_segments`!
 
-    This runs during finalize_iteration.
+    This runs during finalize_iteration, and also records the current iteration in the propagator's segment state
+    index.
     """
 
     sim_manager = westpa.rc.get_sim_manager()
 
-    for segment in sim_manager.we_driver.next_iter_segments:
+    with get_instrumentation().phase('copy_segment_data'):
+        state_index = get_state_index()
+        state_index.update(sim_manager.n_iter, sim_manager.segments.values())
 
-        segment.data["parent_final_state_index"] = get_segment_parent_index(
-            segment
-        )
+        next_iter_segments = list(sim_manager.we_driver.next_iter_segments)
+        parent_indices = get_segment_parent_indices(next_iter_segments)
+
+        for segment, parent_index in zip(next_iter_segments, parent_indices):
+
+            segment.data["parent_final_state_index"] = int(parent_index)
 
 
 class SynMDPropagator(WESTPropagator):
@@ -144,7 +376,13 @@ class SynMDPropagator(WESTPropagator):
         """
         The keys loaded from WESTPA configuration are:
 
-        - :code:`west.system.system_options.pcoord_len`: The number of steps to propagate
+        - :code:`west.system.system_options.pcoord_len`: The number of steps to save
+
+        - :code:`west.propagation.parameters.save_stride`: (Optional) The number of dynamics steps to take between each saved step. Defaults to 1.
+
+        - :code:`west.propagation.parameters.instrumentation`: (Optional) If true, record wall time, call counts and bytes written for each phase of each iteration. Defaults to false.
+
+        - :code:`west.propagation.parameters.instrumentation_file`: (Optional) CSV file the per-iteration instrumentation table is appended to. Defaults to :code:`synd_instrumentation.csv`. The table is also written to :code:`iter_XXX/synd_instrumentation` in the H5 file.
 
         EITHER
 
@@ -152,6 +390,10 @@ class SynMDPropagator(WESTPropagator):
 
         - :code:`west.propagation.parameters.transition_matrix`: The path to a transition matrix to construct the SynD propagator from.
 
+        - :code:`west.propagation.parameters.sparse_storage`: (Optional) If true, keep the transition matrix sparse instead of densifying it.
+
+        - :code:`west.propagation.parameters.sampler`: (Optional) The transition sampler to use, one of :code:`searchsorted` (default), :code:`alias`, or :code:`argmin`.
+
         OR
 
         - :code:`west.propagation.parameters.synd_model`: The path to a saved SynD model.
@@ -196,25 +438,52 @@ class SynMDPropagator(WESTPropagator):
             self.synd_model = MarkovGenerator(
                 transition_matrix=self.transition_matrix,
                 backmapper=backmapper,
-                seed=None
+                seed=None,
+                sparse_storage=rc_parameters.get('sparse_storage', False),
+                sampler=rc_parameters.get('sampler', 'searchsorted')
             )
 
         # Our dynamics are propagated in the discrete space, which is recorded only in auxdata. After completing an
         #   iteration, we write the final discrete indices to the initial point auxdata of the next segments.
         # All discrete information is stored exclusively in auxdata, so that as far as the WE is concerned, it's all
         #   continuous.
+        self.state_index = SegmentStateIndex()
+
+        # Discrete indices of basis/initial state auxrefs, filled in as they're first seen
+        self.auxref_indices = {}
+
+        # Phase timings are only recorded if requested, otherwise instrumented sections are no-ops
+        self.instrumentation = Instrumentation(enabled=rc_parameters.get('instrumentation', False))
+        self.instrumentation_file = rc_parameters.get('instrumentation_file', 'synd_instrumentation.csv')
+
         sim_manager = rc.get_sim_manager()
         sim_manager.register_callback(
             sim_manager.finalize_iteration, copy_segment_data, 1
         )
 
-        # TODO: Would be nice to decouple this from pcoord len, so you can run dynamics at a higher resolution
-        #  but only save every N
+        # Export instrumentation last, so it includes everything else that ran this iteration
+        if self.instrumentation.enabled:
+            sim_manager.register_callback(
+                sim_manager.finalize_iteration, export_instrumentation, 100
+            )
+
         n_steps = rc.config.get(['west', 'system', 'system_options', 'pcoord_len'])
         print(f"SynD propagator inferring {n_steps} steps per iteration from west.system.system_options.pcoord_len")
 
-        # AKA the number of steps to take
+        # AKA the number of steps to save
         self.coord_len = n_steps
+
+        # Dynamics are run at a higher resolution than they're saved at, and only every save_stride-th step is kept
+        self.save_stride = rc_parameters.get('save_stride', 1)
+        if isinstance(self.save_stride, bool) or not isinstance(self.save_stride, (int, np.integer)) \
+                or self.save_stride < 1:
+            raise ValueError(
+                f"west.propagation.parameters.save_stride must be an integer >= 1, but got {self.save_stride!r}"
+            )
+        self.save_stride = int(self.save_stride)
+
+        if self.save_stride > 1:
+            print(f"SynD propagator saving every {self.save_stride} steps")
         self.coord_dtype = int
 
     def get_pcoord(self, state):
@@ -224,52 +493,91 @@ class SynMDPropagator(WESTPropagator):
         state.pcoord = self.synd_model.backmap(state_index)
 
 
-    def propagate(self, segments):
-
-        # Populate the segment initial positions
-        n_segs = len(segments)
-
-        initial_points = np.empty(n_segs, dtype=self.coord_dtype)
-
-        for iseg, segment in enumerate(segments):
+    def get_unitcell(self, n_frames: int):
+        """
+        Get the reference structure's unit cell, repeated over a number of frames.
 
-            initial_points[iseg] = get_segment_parent_index(segment)
+        Returns
+        -------
+        Tuple of unit cell lengths and angles, each of shape (n_frames, 3), or None if there's no unit cell.
+        """
 
-        new_trajectories = self.synd_model.generate_trajectory(
-            initial_states=initial_points,
-            n_steps=self.coord_len
-        )
+        if self.topology.unitcell_lengths is None:
+            return None, None
 
-        for iseg, segment in enumerate(segments):
-            segment.data["state_indices"] = new_trajectories[iseg, :]
+        unitcell_lengths = np.repeat(self.topology.unitcell_lengths[:1], n_frames, axis=0)
+        unitcell_angles = np.repeat(self.topology.unitcell_angles[:1], n_frames, axis=0)
 
-            segment.pcoord = np.array([
-                self.synd_model.backmap(x) for x in segment.data["state_indices"]
-            ]).reshape(self.coord_len, -1)
+        return unitcell_lengths, unitcell_angles
 
-            # For H5 plugin
-            if westpa.rc.get_data_manager().store_h5:
+    def propagate(self, segments):
 
-                # TODO: how to handle restart data?
-                #       I think we just don't for SynD, but let's silence that warning.
-                segment.data['iterh5/restart'] = None
+        # This may run in a worker process, so record into a fresh instrumentation, and ship the records back to the
+        #   master with the segments
+        instrumentation = Instrumentation(enabled=self.instrumentation.enabled)
 
-                full_coordinate_trajectory = np.array([
-                    self.synd_model.backmap(x, 'full_coordinates')
-                    for x in segment.data["state_indices"]
-                ])
+        # Populate the segment initial positions
+        n_segs = len(segments)
 
-                # To mimic the behavior of a saved MD trajectory, we omit the first point.
-                # I don't love this, but it's consistent with the OpenMM propagator.
-                # TODO: Change this -- it's inconsistent with how pcoords are saved, and isn't quite right
-                #   for the haMSM plugin.
-                self.topology.xyz = full_coordinate_trajectory[1:]
-                self.topology.time = np.arange(self.coord_len-1) + \
-                                     (self.coord_len-1) * westpa.rc.get_sim_manager().n_iter
+        with instrumentation.phase('propagate/parent_lookup'):
+            initial_points = get_segment_parent_indices(segments).astype(self.coord_dtype)
 
-                # TODO: Avoid this copy! Probably super slow
-                segment.data['iterh5/trajectory'] = deepcopy(self.topology)
+        with instrumentation.phase('propagate/generate_trajectory'):
+            new_trajectories = self.synd_model.generate_trajectory(
+                initial_states=initial_points,
+                n_steps=self.coord_len,
+                save_stride=self.save_stride
+            )
 
-            segment.status = segment.SEG_STATUS_COMPLETE
+        # Backmap every segment's states at once, rather than one state at a time
+        with instrumentation.phase('propagate/backmap_pcoord'):
+            pcoords = backmap_trajectories(self.synd_model, new_trajectories).reshape(n_segs, self.coord_len, -1)
+
+        store_h5 = westpa.rc.get_data_manager().store_h5
+        if store_h5:
+            # Cast once to mdtraj's coordinate dtype, so each segment's trajectory can view a slice of this
+            #   instead of copying it
+            with instrumentation.phase('propagate/backmap_full_coordinates'):
+                full_coordinate_trajectories = backmap_trajectories(
+                    self.synd_model, new_trajectories, 'full_coordinates'
+                ).astype(np.float32, copy=False)
+
+            # To mimic the behavior of a saved MD trajectory, we omit the first point.
+            # I don't love this, but it's consistent with the OpenMM propagator.
+            # TODO: Change this -- it's inconsistent with how pcoords are saved, and isn't quite right
+            #   for the haMSM plugin.
+            n_frames = self.coord_len - 1
+            frame_times = (np.arange(n_frames) + n_frames * westpa.rc.get_sim_manager().n_iter) * self.save_stride
+            unitcell_lengths, unitcell_angles = self.get_unitcell(n_frames)
+
+            instrumentation.add_bytes('propagate/build_trajectories', full_coordinate_trajectories[:, 1:].nbytes)
+
+        with instrumentation.phase('propagate/build_trajectories'):
+            for iseg, segment in enumerate(segments):
+                segment.data["state_indices"] = new_trajectories[iseg, :]
+
+                segment.pcoord = pcoords[iseg]
+
+                # For H5 plugin
+                if store_h5:
+
+                    # TODO: how to handle restart data?
+                    #       I think we just don't for SynD, but let's silence that warning.
+                    segment.data['iterh5/restart'] = None
+
+                    # All segments share the same (immutable) Topology, and the per-frame arrays
+                    segment.data['iterh5/trajectory'] = md.Trajectory(
+                        xyz=full_coordinate_trajectories[iseg, 1:],
+                        topology=self.topology.topology,
+                        time=frame_times,
+                        unitcell_lengths=unitcell_lengths,
+                        unitcell_angles=unitcell_angles
+                    )
+
+                segment.status = segment.SEG_STATUS_COMPLETE
+
+        if instrumentation.enabled and n_segs > 0:
+            instrumentation.record('propagate/segments', n_calls=n_segs)
+            segments[0].data[INSTRUMENTATION_KEY] = instrumentation.records
 
         return segments
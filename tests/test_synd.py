@@ -5,14 +5,52 @@
 
 import unittest
 import os
+import hashlib
+import pickle
+import tempfile
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import mock
 from click.testing import CliRunner
 
 from synd.core import load_model
 from synd import cli
 import synd.hosted
 from synd.models.discrete.markov import MarkovGenerator
+from synd.models.discrete import samplers, accumulators
+from synd.models.discrete.trajectories import RunLengthTrajectories, compact_dtype
 from examples.data import simple_model
 import numpy as np
+from scipy import sparse
+import scipy.sparse.linalg
+
+
+class FakeMinioClient:
+    """In-process stand-in for a minio.Minio client, storing objects in memory."""
+
+    def __init__(self):
+        self.objects = {}
+        self.n_downloads = 0
+
+    def put_object(self, bucket_name, object_name, data, length, **kwargs):
+        self.objects[(bucket_name, object_name)] = data.read(length)
+
+    def stat_object(self, bucket_name, object_name):
+        content = self.objects[(bucket_name, object_name)]
+        return SimpleNamespace(etag=hashlib.md5(content).hexdigest(), size=len(content))
+
+    def get_object(self, bucket_name, object_name, offset=0, length=0):
+        self.n_downloads += 1
+        content = self.objects[(bucket_name, object_name)]
+        content = content[offset:offset + length] if length else content[offset:]
+
+        stream = BytesIO(content)
+        return SimpleNamespace(
+            stream=lambda amt: iter(lambda: stream.read(amt), b''),
+            read=stream.read,
+            close=stream.close,
+            release_conn=lambda: None
+        )
 
 
 class TestSynd(unittest.TestCase):
@@ -64,6 +102,80 @@ class TestSynd(unittest.TestCase):
 
         assert model is not None, "Model download failed"
 
+    def test_cached_model_download(self):
+        """Test that hosted models are downloaded once into the local cache, and then loaded from it."""
+
+        client = FakeMinioClient()
+        synd.hosted.upload_model(model=self.synmd_model, identifier='cached_model', client=client)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+
+            for _ in range(2):
+                model = synd.hosted.download_model('cached_model', client, cache_dir=cache_dir)
+                assert isinstance(model, MarkovGenerator)
+
+            assert client.n_downloads == 1
+
+            # Lock files and partial downloads don't outlive a download
+            (old_cache_file,) = os.listdir(cache_dir)
+            assert old_cache_file.endswith(synd.hosted.CACHE_SUFFIX)
+
+            # Partial downloads left by interrupted downloads are removed, and those in progress are kept
+            stale_part, active_part = [os.path.join(cache_dir, f'{name}.part') for name in ['stale', 'active']]
+            for part in [stale_part, active_part]:
+                with open(part, 'wb') as outfile:
+                    outfile.write(b'\x00' * 16)
+            os.utime(stale_part, (0, 0))
+
+            # A changed model on the host has a new ETag, so it's downloaded again. The old one is in use by another
+            #   process, so it can't be evicted yet.
+            synd.hosted.upload_model(model=self.synmd_model, identifier='cached_model', client=client, compression=None)
+            old_lock = os.path.join(cache_dir, old_cache_file + '.lock')
+
+            with synd.hosted._file_lock(old_lock):
+                synd.hosted.download_model('cached_model', client, cache_dir=cache_dir, max_cache_size=0)
+                assert client.n_downloads == 2
+
+                assert not os.path.exists(stale_part)
+                assert os.path.exists(active_part)
+                assert old_cache_file in os.listdir(cache_dir)
+
+            # Once it's released, the old model is evicted, along with its lock file
+            os.remove(active_part)
+            (cache_file,) = [f for f in os.listdir(cache_dir) if f != old_cache_file]
+
+            synd.hosted.evict_cache(cache_dir, max_cache_size=0, keep=os.path.join(cache_dir, cache_file))
+            assert os.listdir(cache_dir) == [cache_file]
+
+    def test_compressed_multipart_transfer(self):
+        """Test that hosted models round-trip through each compression, downloaded as parallel byte ranges."""
+
+        client = FakeMinioClient()
+        initial_states = np.array([0, 1, 2, 0])
+
+        for compression in [None] + list(synd.hosted.COMPRESSION_MAGIC.keys()):
+            synd.hosted.upload_model(model=self.synmd_model, identifier='model', client=client, compression=compression)
+
+            size = client.stat_object(synd.hosted.MODEL_BUCKET, 'model').size
+            part_size = size // 5 + 1
+            n_downloads = client.n_downloads
+
+            # Byte ranges are decompressed straight into a single temporary file, so the compressed model is never
+            #   written to disk
+            with tempfile.TemporaryDirectory() as cache_dir, \
+                    mock.patch('tempfile.NamedTemporaryFile', wraps=tempfile.NamedTemporaryFile) as temporary_file:
+                model = synd.hosted.download_model('model', client, cache_dir=cache_dir, part_size=part_size, n_threads=3)
+                assert temporary_file.call_count == 1
+
+            assert client.n_downloads - n_downloads == 5
+
+            self.synmd_model.rng = np.random.default_rng(0)
+            model.rng = np.random.default_rng(0)
+            assert np.array_equal(
+                model.generate_trajectory(initial_states, 10),
+                self.synmd_model.generate_trajectory(initial_states, 10)
+            )
+
     def test_saving_loading_markov_generator(self):
         """Test saving and loading a Markov generator."""
 
@@ -89,13 +201,1034 @@ class TestSynd(unittest.TestCase):
         assert trajectory.shape[0] == simple_model.initial_distribution.shape[0]
         assert trajectory.shape[1] == n_steps
 
-    @unittest.skip
+    def test_binary_model_format(self):
+        """Test that a model saved in the binary format is memory-mapped on load, and behaves identically."""
+
+        for sparse_storage in [False, True]:
+            model = MarkovGenerator(
+                transition_matrix=simple_model.transition_matrix,
+                backmapper=simple_model.backmapper,
+                seed=0,
+                sparse_storage=sparse_storage,
+                backmap_table='eager'
+            )
+            model.add_backmapper(simple_model.backmapper, 'callable')
+
+            model.save("binary_synmd_model.dat", format='binary')
+            loaded_model = load_model("binary_synmd_model.dat")
+
+            assert isinstance(loaded_model, MarkovGenerator)
+            assert isinstance(loaded_model._backmappers['default'].table, np.memmap)
+
+            assert np.array_equal(
+                loaded_model.generate_trajectory(simple_model.initial_distribution, n_steps=10),
+                model.generate_trajectory(simple_model.initial_distribution, n_steps=10)
+            )
+            assert np.array_equal(loaded_model.backmap([0, 2]), model.backmap([0, 2]))
+            assert np.array_equal(loaded_model.backmap([0, 2], 'callable'), model.backmap([0, 2], 'callable'))
+
+            del loaded_model
+            os.remove("binary_synmd_model.dat")
+
+            # Pickle remains available as a fallback
+            model.save("pickled_synmd_model.dat", format='pickle')
+            assert isinstance(load_model("pickled_synmd_model.dat"), MarkovGenerator)
+            os.remove("pickled_synmd_model.dat")
+
+    def test_save_over_loaded_model(self):
+        """Test that a memory-mapped model can be saved back over the file it was loaded from."""
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for sparse_storage in [False, True]:
+                model = MarkovGenerator(
+                    transition_matrix=simple_model.transition_matrix,
+                    backmapper=simple_model.backmapper,
+                    sparse_storage=sparse_storage,
+                    backmap_table='eager'
+                )
+
+                for format in ['binary', 'pickle']:
+                    model_file = os.path.join(tmpdir, f'model.{format}')
+                    model.save(model_file, format='binary')
+
+                    loaded_model = load_model(model_file)
+                    loaded_model.save(model_file, format=format)
+                    reloaded_model = load_model(model_file)
+
+                    assert np.array_equal(
+                        sparse.csr_matrix(reloaded_model.transition_matrix).toarray(), simple_model.transition_matrix
+                    )
+                    assert np.array_equal(reloaded_model.backmap(np.arange(3)), simple_model.state_definitions)
+
+                    # The file is replaced, rather than written in place, and no temporary files are left behind
+                    assert set(os.listdir(tmpdir)) <= {'model.binary', 'model.pickle'}
+
+    def test_sparse_markov_generator(self):
+        """Test that a sparse-storage Markov generator never densifies, and survives a save/load."""
+
+        sparse_model = MarkovGenerator(
+            transition_matrix=simple_model.transition_matrix,
+            backmapper=simple_model.backmapper,
+            seed=0,
+            sparse_storage=True
+        )
+
+        assert sparse.issparse(sparse_model.transition_matrix)
+
+        trajectory = sparse_model.generate_trajectory(
+            initial_states=simple_model.initial_distribution,
+            n_steps=10
+        )
+
+        assert trajectory.shape == (simple_model.initial_distribution.shape[0], 10)
+        assert np.all(trajectory[:, 0] == simple_model.initial_distribution)
+        assert np.all((trajectory >= 0) & (trajectory < sparse_model.n_states))
+
+        sparse_model.save("sparse_synmd_model.dat")
+        loaded_model = load_model("sparse_synmd_model.dat")
+        os.remove("sparse_synmd_model.dat")
+
+        assert sparse.issparse(loaded_model.transition_matrix)
+
+    def test_samplers_match_transition_probabilities(self):
+        """Test that each sampler reproduces the transition probabilities, and that they agree on identical draws."""
+
+        n_samples = 200000
+        rng = np.random.default_rng(seed=0)
+        uniforms = rng.random(n_samples * simple_model.transition_matrix.shape[0])
+        current_states = np.repeat(np.arange(simple_model.transition_matrix.shape[0]), n_samples)
+
+        sampled = {}
+        for name, sampler_class in samplers.SAMPLERS.items():
+            sampler = sampler_class(simple_model.transition_matrix)
+            sampled[name] = sampler.sample(current_states, uniforms)
+
+            for state in range(simple_model.transition_matrix.shape[0]):
+                frequencies = np.bincount(sampled[name][current_states == state], minlength=3) / n_samples
+                assert np.allclose(frequencies, simple_model.transition_matrix[state], atol=0.01), \
+                    f"{name} sampler doesn't reproduce the transition probabilities of state {state}"
+
+        # The cumulative samplers invert the same CDF, so they should pick exactly the same states
+        assert np.array_equal(sampled['argmin'], sampled['searchsorted'])
+
+        with self.assertRaises(ValueError):
+            MarkovGenerator(
+                transition_matrix=simple_model.transition_matrix,
+                backmapper=simple_model.backmapper,
+                sparse_storage=True,
+                sampler='argmin'
+            )
+
+    def test_strided_trajectory_generation(self):
+        """Test that a strided trajectory only saves every Nth step."""
+
+        identity_model = MarkovGenerator(
+            transition_matrix=np.roll(np.eye(3), 1, axis=1),
+            backmapper=simple_model.backmapper
+        )
+
+        # This model deterministically cycles 0 -> 1 -> 2 -> 0, so a stride of 2 goes 0 -> 2 -> 1
+        trajectory = identity_model.generate_trajectory(initial_states=np.array([0]), n_steps=4, save_stride=2)
+
+        assert np.array_equal(trajectory, [[0, 2, 1, 0]])
+
+    def test_jump_sampler(self):
+        """Test that multi-step jump samplers sample from the matrix power, and are cached."""
+
+        for sparse_storage in [False, True]:
+            model = MarkovGenerator(
+                transition_matrix=simple_model.transition_matrix,
+                backmapper=simple_model.backmapper,
+                sparse_storage=sparse_storage
+            )
+
+            jump_sampler = model.get_jump_sampler(3)
+            assert model.get_jump_sampler(3) is jump_sampler
+
+            n_samples = 200000
+            uniforms = np.random.default_rng(seed=0).random(n_samples)
+            frequencies = np.bincount(jump_sampler.sample(np.zeros(n_samples, dtype=int), uniforms)) / n_samples
+
+            expected = np.linalg.matrix_power(simple_model.transition_matrix, 3)[0]
+            assert np.allclose(frequencies, expected, atol=0.01)
+
+            trajectory = model.generate_trajectory(
+                initial_states=simple_model.initial_distribution, n_steps=5, save_stride=3, jump=True
+            )
+            assert trajectory.shape == (simple_model.initial_distribution.shape[0], 5)
+
+            model.clear_jump_samplers()
+            assert model.get_jump_sampler(3) is not jump_sampler
+
+    def test_dwell_trajectory_generation(self):
+        """Test that dwell-time trajectory generation reproduces the transition probabilities."""
+
+        for sparse_storage in [False, True]:
+            model = MarkovGenerator(
+                transition_matrix=simple_model.transition_matrix,
+                backmapper=simple_model.backmapper,
+                seed=0,
+                sparse_storage=sparse_storage
+            )
+
+            trajectory = model.generate_trajectory_dwell(
+                initial_states=np.zeros(100, dtype=int), n_steps=2000
+            )
+
+            assert trajectory.shape == (100, 2000)
+            assert np.all(trajectory[:, 0] == 0)
+
+            transition_counts = np.zeros((3, 3))
+            np.add.at(transition_counts, (trajectory[:, :-1].ravel(), trajectory[:, 1:].ravel()), 1)
+            transition_probabilities = transition_counts / transition_counts.sum(axis=1, keepdims=True)
+
+            assert np.allclose(transition_probabilities, simple_model.transition_matrix, atol=0.01)
+
+    def test_chunked_trajectory_generation(self):
+        """Test that iterating over a trajectory in chunks produces the full trajectory."""
+
+        blocks = [
+            block.copy() for block in self.synmd_model.iter_trajectory(
+                initial_states=simple_model.initial_distribution,
+                n_steps=25,
+                chunk_steps=10
+            )
+        ]
+
+        assert [block.shape[1] for block in blocks] == [10, 10, 5]
+
+        trajectory = np.concatenate(blocks, axis=1)
+        assert np.all(trajectory[:, 0] == simple_model.initial_distribution)
+
+        # Runs shorter than a chunk only allocate the steps they need
+        (block,) = self.synmd_model.iter_trajectory(initial_states=simple_model.initial_distribution, n_steps=4)
+        assert block.shape == (5, 4)
+        assert block.base.size == block.size
+        assert np.all((trajectory >= 0) & (trajectory < self.synmd_model.n_states))
+
+    def test_parallel_trajectory_generation(self):
+        """Test that parallel trajectory generation is reproducible regardless of the number of workers."""
+
+        initial_states = np.tile(simple_model.initial_distribution, 20)
+
+        serial = self.synmd_model.generate_trajectory_parallel(
+            initial_states=initial_states, n_steps=10, n_workers=1, seed=1234, shard_size=16
+        )
+        parallel = self.synmd_model.generate_trajectory_parallel(
+            initial_states=initial_states, n_steps=10, n_workers=3, seed=1234, shard_size=16
+        )
+
+        assert serial.shape == (initial_states.shape[0], 10)
+        assert np.all(serial[:, 0] == initial_states)
+        assert np.array_equal(serial, parallel)
+
+        # A pool is reused across calls of varying length, and matches a pool started per call
+        with self.synmd_model.parallel_pool(initial_states.shape[0], 10, n_workers=3, shard_size=16) as pool:
+            for n_steps, seed in [(10, 1234), (4, 5), (10, 6)]:
+                assert np.array_equal(
+                    pool.generate(initial_states, n_steps, seed=seed),
+                    self.synmd_model.generate_trajectory_parallel(
+                        initial_states=initial_states, n_steps=n_steps, n_workers=1, seed=seed, shard_size=16
+                    )
+                )
+
+            with self.assertRaises(ValueError):
+                pool.generate(initial_states, 11, seed=0)
+
+    def test_backmap_tables(self):
+        """Test that eager and lazy backmap tables match the original backmapper."""
+
+        self.synmd_model.add_backmapper(simple_model.backmapper, 'eager', backmap_table='eager')
+        self.synmd_model.add_backmapper(simple_model.backmapper, 'lazy', backmap_table='lazy')
+
+        indices = np.array([[2, 0], [1, 1]])
+        expected = self.synmd_model.backmap(indices)
+
+        assert np.array_equal(self.synmd_model.backmap(indices, 'eager'), expected)
+        assert np.array_equal(self.synmd_model.backmap(2, 'lazy'), simple_model.backmapper(2))
+        assert np.array_equal(self.synmd_model.backmap(indices, 'lazy'), expected)
+
+        # Modifying a single state's coordinates doesn't modify the table
+        coordinates = self.synmd_model.backmap(1, 'eager')
+        coordinates[:] = -1
+        assert np.array_equal(self.synmd_model.backmap(1, 'eager'), simple_model.backmapper(1))
+
+    def test_streaming_accumulators(self):
+        """Test that streaming accumulators match statistics computed from the stored trajectories."""
+
+        initial_states = np.array([0, 1, 2, 0, 1])
+        n_steps, chunk_steps = 53, 10
+        target_states = [2]
+
+        model_accumulators = {
+            'states': accumulators.StateCounts(3),
+            'transitions': accumulators.TransitionCounts(3),
+            'first_hits': accumulators.FirstHittingTimes(target_states, 3),
+            'histogram': accumulators.ObservableHistogram(bins=[0, 2, 4, 6], observable=lambda x: x[:, 0]),
+            'mean': accumulators.ObservableMean(),
+        }
+
+        self.synmd_model.rng = np.random.default_rng(0)
+        results = self.synmd_model.accumulate(initial_states, n_steps, model_accumulators, chunk_steps=chunk_steps)
+
+        self.synmd_model.rng = np.random.default_rng(0)
+        trajectories = np.concatenate(
+            [block.copy() for block in self.synmd_model.iter_trajectory(initial_states, n_steps, chunk_steps)], axis=1
+        )
+        coordinates = self.synmd_model.backmap(trajectories)
+
+        assert np.array_equal(results['states'], np.bincount(trajectories.ravel(), minlength=3))
+
+        expected_transitions = np.zeros((3, 3), dtype=int)
+        np.add.at(expected_transitions, (trajectories[:, :-1], trajectories[:, 1:]), 1)
+        assert np.array_equal(results['transitions'].toarray(), expected_transitions)
+
+        in_target = np.isin(trajectories, target_states)
+        first_hits = np.argmax(in_target, axis=1)[in_target.any(axis=1)]
+        assert np.array_equal(results['first_hits'], np.bincount(first_hits))
+
+        assert np.array_equal(results['histogram'], np.histogram(coordinates[..., 0], bins=[0, 2, 4, 6])[0])
+
+        assert np.allclose(results['mean'], coordinates.reshape(-1, coordinates.shape[-1]).mean(axis=0))
+        assert np.allclose(model_accumulators['mean'].variance, coordinates.reshape(-1, coordinates.shape[-1]).var(axis=0))
+
+        # Large models count transitions sparsely
+        sparse_counts = accumulators.TransitionCounts(3, dense=False)
+        self.synmd_model.rng = np.random.default_rng(0)
+        self.synmd_model.accumulate(initial_states, n_steps, {'transitions': sparse_counts}, chunk_steps=chunk_steps)
+        assert np.array_equal(sparse_counts.result().toarray(), expected_transitions)
+
+        # Blocks much smaller than the number of state pairs only count the pairs they contain, with the same result
+        rng = np.random.default_rng(0)
+        block = rng.integers(1000, size=(5, 20), dtype=np.uint16)
+        previous_states = rng.integers(1000, size=5)
+
+        dense_counts = accumulators.TransitionCounts(1000)
+        dense_counts.update(None, block, start_step=1, previous_states=previous_states)
+
+        expected = np.zeros((1000, 1000), dtype=int)
+        full_block = np.concatenate([previous_states[:, np.newaxis], block], axis=1)
+        np.add.at(expected, (full_block[:, :-1], full_block[:, 1:]), 1)
+        assert np.array_equal(dense_counts.result().toarray(), expected)
+
+        # Accumulators that were never updated have nothing to report
+        assert accumulators.FirstHittingTimes(target_states, 3).result().shape == (0,)
+
+    def test_distribution_propagation(self):
+        """Test exact propagation of distributions, and the cached stationary distribution."""
+
+        transition_matrix = simple_model.transition_matrix
+        initial_distributions = np.eye(3)[[0, 2]]
+
+        propagated = self.synmd_model.propagate_distribution(initial_distributions, n_steps=4, save_stride=2)
+        assert propagated.shape == (2, 4, 3)
+        for istep in range(4):
+            assert np.allclose(propagated[:, istep], initial_distributions @ np.linalg.matrix_power(transition_matrix, 2 * istep))
+
+        sparse_model = MarkovGenerator(transition_matrix, simple_model.backmapper, sparse_storage=True)
+        assert np.allclose(sparse_model.propagate_distribution(initial_distributions[0], n_steps=4, save_stride=2), propagated[0])
+
+        stationary = self.synmd_model.get_stationary_distribution()
+        assert np.allclose(stationary @ transition_matrix, stationary)
+        assert np.isclose(stationary.sum(), 1.0)
+
+        for method in ['auto', 'solve', 'eigs', 'power']:
+            sparse_model._stationary_distribution = None
+            assert np.allclose(sparse_model.get_stationary_distribution(method=method), stationary)
+
+        # Eigenvectors are oriented by their largest entry, and mixed signs are an error rather than silently fixed
+        eigenvalues, eigenvectors = np.linalg.eig(transition_matrix.T)
+        stationary_eigenvector = eigenvectors[:, [np.argmax(eigenvalues.real)]].real
+
+        model = MarkovGenerator(transition_matrix, simple_model.backmapper)
+        with mock.patch('numpy.linalg.eig', return_value=(np.ones(1), -stationary_eigenvector)):
+            assert np.allclose(model.get_stationary_distribution(), stationary)
+
+        model = MarkovGenerator(transition_matrix, simple_model.backmapper)
+        mixed_eigenvector = stationary_eigenvector * np.array([[1], [-1], [1]])
+        with mock.patch('numpy.linalg.eig', return_value=(np.ones(1), mixed_eigenvector)):
+            with self.assertRaises(ValueError):
+                model.get_stationary_distribution()
+        assert model._stationary_distribution is None
+
+        # The stationary distribution is saved with the model
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for format in ['binary', 'pickle']:
+                model_file = os.path.join(tmpdir, f'model.{format}')
+                self.synmd_model.save(model_file, format=format)
+                assert np.array_equal(load_model(model_file)._stationary_distribution, stationary)
+
+            # Computing it for a loaded model, and saving it back over the same file, persists it
+            model_file = os.path.join(tmpdir, 'uncomputed.synd')
+            MarkovGenerator(transition_matrix, simple_model.backmapper, backmap_table='eager').save(model_file)
+
+            loaded_model = load_model(model_file)
+            assert loaded_model._stationary_distribution is None
+            loaded_model.get_stationary_distribution()
+            loaded_model.save(model_file)
+
+            reloaded_model = load_model(model_file)
+            assert np.allclose(reloaded_model._stationary_distribution, stationary)
+            assert np.array_equal(reloaded_model.transition_matrix, transition_matrix)
+            assert np.allclose(reloaded_model.get_stationary_distribution() @ transition_matrix, stationary)
+
+    def test_hitting_problems(self):
+        """Test exact MFPTs, committors and discrepancy/variance against their defining equations."""
+
+        transition_matrix = simple_model.transition_matrix
+        source_states, target_states = [0], [2]
+
+        mfpts = self.synmd_model.mfpt(target_states)
+        assert mfpts[2] == 0
+        assert np.allclose(mfpts[:2], 1 + transition_matrix[:2] @ mfpts)
+
+        # The factorization for a target set is cached, and reused, until the cache is cleared. So is the CSR transition
+        #   matrix it was built from.
+        with mock.patch('scipy.sparse.linalg.splu', wraps=scipy.sparse.linalg.splu) as splu, \
+                mock.patch('scipy.sparse.csr_matrix', wraps=scipy.sparse.csr_matrix) as csr_matrix:
+            assert np.array_equal(self.synmd_model.mfpt(target_states), mfpts)
+            assert np.isclose(self.synmd_model.mfpt(target_states, source_states), mfpts[0])
+            assert splu.call_count == 0
+            assert csr_matrix.call_count == 0
+
+            self.synmd_model.clear_solvers()
+            assert np.array_equal(self.synmd_model.mfpt(target_states), mfpts)
+            assert splu.call_count == 1
+            assert csr_matrix.call_count == 1
+
+            self.synmd_model.mfpt([1])
+            assert splu.call_count == 2
+
+        assert np.allclose(self.synmd_model.mfpt(target_states, solver='iterative'), mfpts)
+
+        committors = self.synmd_model.committor(source_states, target_states)
+        assert np.allclose(committors[[0, 2]], [0, 1])
+        assert np.isclose(committors[1], transition_matrix[1] @ committors)
+
+        discrepancy, variance, stationary = self.synmd_model.discrepancy(target_states, source_states)
+        recycled = self.synmd_model.recycled_transition_matrix(target_states, [1, 0, 0]).toarray()
+
+        assert np.allclose(stationary @ recycled, stationary)
+        assert np.allclose(discrepancy - recycled @ discrepancy, (np.arange(3) == 2) - stationary[2])
+        assert np.isclose(stationary @ discrepancy, 0)
+        assert np.allclose(variance, recycled @ discrepancy ** 2 - (recycled @ discrepancy) ** 2)
+
+    def test_first_passage_sampling(self):
+        """Test that sampled first passage times agree with the exact MFPT."""
+
+        self.synmd_model.rng = np.random.default_rng(0)
+
+        n_walkers = 20000
+        initial_states = np.zeros(n_walkers, dtype=int)
+        initial_states[:10] = 2
+
+        first_passage_times, end_states = self.synmd_model.sample_first_passage(
+            initial_states, target_states=[2], max_steps=1000
+        )
+
+        assert np.all(first_passage_times[:10] == 0)
+        assert np.all(first_passage_times > -1)
+        assert np.all(end_states == 2)
+
+        exact_mfpt = self.synmd_model.mfpt([2])[0]
+        assert np.isclose(first_passage_times[10:].mean(), exact_mfpt, rtol=0.05)
+
+        # Walkers that don't arrive in time are reported with their last state
+        first_passage_times, end_states = self.synmd_model.sample_first_passage(
+            np.zeros(100, dtype=int), target_states=[2], max_steps=1, compaction_threshold=0
+        )
+        assert np.all(end_states[first_passage_times == -1] != 2)
+        assert np.all(end_states[first_passage_times == 1] == 2)
+
+    def test_recycled_generation(self):
+        """Test that brute-force recycling reproduces the exact steady-state flux into the target."""
+
+        self.synmd_model.rng = np.random.default_rng(0)
+
+        n_walkers, n_steps, burn_in = 2000, 1000, 100
+        trajectories, step_recycled, walker_recycled = self.synmd_model.generate_trajectory_recycled(
+            np.zeros(n_walkers, dtype=int), n_steps, target_states=[2], source_states=[0]
+        )
+
+        assert trajectories.shape == (n_walkers, n_steps)
+        assert not np.any(trajectories == 2)
+        assert step_recycled.sum() == walker_recycled.sum()
+
+        # In the exactly recycled chain, walkers spend a step in the target before being recycled, so the flux is its
+        #   stationary probability. Recycling in-engine skips that step, which rescales the flux.
+        _, _, stationary = self.synmd_model.discrepancy(target_states=[2], source_states=[0])
+        exact_flux = stationary[2] / (1 - stationary[2])
+        assert np.isclose(step_recycled[burn_in:].mean() / n_walkers, exact_flux, rtol=0.05)
+
+        final_states, _, _ = self.synmd_model.generate_trajectory_recycled(
+            np.zeros(n_walkers, dtype=int), 10, target_states=[2], source_states=[0, 1], store_trajectories=False
+        )
+        assert final_states.shape == (n_walkers,)
+        assert final_states.dtype == trajectories.dtype == self.synmd_model.trajectory_dtype
+
+    def test_compact_trajectory_dtype(self):
+        """Test that trajectories are stored in the smallest dtype that fits the model's states, unless overridden."""
+
+        assert compact_dtype(255) == np.uint8
+        assert compact_dtype(10499) == np.uint16
+        assert compact_dtype(70000) == np.uint32
+
+        initial_states = np.array([0, 1, 2])
+        assert self.synmd_model.generate_trajectory(initial_states, 10).dtype == np.uint8
+        assert self.synmd_model.generate_trajectory_parallel(initial_states, 10, n_workers=1).dtype == np.uint8
+
+        # Out-of-range initial states are rejected, rather than wrapping around in the compact dtype
+        for invalid_states in [np.array([0, -1, 2]), np.array([0, 256]), np.array([3])]:
+            with self.assertRaises(ValueError):
+                self.synmd_model.generate_trajectory(invalid_states, 10)
+            with self.assertRaises(ValueError):
+                self.synmd_model.generate_trajectory_parallel(invalid_states, 10, n_workers=1)
+            with self.assertRaises(ValueError):
+                next(self.synmd_model.iter_trajectory(invalid_states, 10))
+            with self.assertRaises(ValueError):
+                self.synmd_model.generate_trajectory_rle(invalid_states, 10)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            model_file = os.path.join(tmpdir, 'model.synd')
+            self.synmd_model.save(model_file)
+
+            outfile = os.path.join(tmpdir, 'traj.npy')
+            result = CliRunner().invoke(cli.main, ['generate', model_file, '-i', '0,3', '-n', '5', '-o', outfile])
+            assert result.exit_code != 0
+            assert '--initial-states' in result.output
+            assert not os.path.exists(outfile)
+
+        model = MarkovGenerator(simple_model.transition_matrix, simple_model.backmapper, trajectory_dtype=np.int64)
+        assert model.generate_trajectory(initial_states, 10).dtype == np.int64
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            model.save(os.path.join(tmpdir, 'model.synd'))
+            assert load_model(os.path.join(tmpdir, 'model.synd')).trajectory_dtype == np.int64
+
+    def test_run_length_trajectories(self):
+        """Test encoding, slicing, backmapping and decoding run-length encoded trajectories."""
+
+        self.synmd_model.rng = np.random.default_rng(0)
+        initial_states = np.array([0, 1, 2, 2])
+
+        trajectories = self.synmd_model.generate_trajectory(initial_states, 50)
+        encoded = RunLengthTrajectories.from_dense(trajectories)
+
+        assert encoded.shape == trajectories.shape
+        assert np.array_equal(encoded.decode(), trajectories)
+        assert np.array_equal(np.asarray(encoded), trajectories)
+
+        assert np.array_equal(encoded[1].decode(), trajectories[[1]])
+        assert np.array_equal(encoded[1:3].decode(), trajectories[1:3])
+        assert np.array_equal(encoded[[3, 0]].decode(), trajectories[[3, 0]])
+        assert np.array_equal(encoded[:, 7:31].decode(), trajectories[:, 7:31])
+        assert np.array_equal(encoded[[2, 1], 0:1].decode(), trajectories[[2, 1], 0:1])
+        assert np.array_equal(encoded[0, 45:60].decode(), trajectories[[0], 45:60])
+
+        assert np.array_equal(encoded[:, 5:20].backmap(self.synmd_model), self.synmd_model.backmap(trajectories[:, 5:20]))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            encoded.save(os.path.join(tmpdir, 'trajectories.npz'))
+            loaded = RunLengthTrajectories.load(os.path.join(tmpdir, 'trajectories.npz'))
+        assert np.array_equal(loaded.decode(), trajectories)
+
+        # Encoded straight from the engine, consecutive runs are always different states
+        sticky_model = MarkovGenerator(np.array([[0.999, 0.001], [0.002, 0.998]]), simple_model.backmapper, seed=0)
+        encoded = sticky_model.generate_trajectory_rle(np.array([0, 1] * 50), 5000)
+        decoded = encoded.decode()
+
+        assert decoded.shape == (100, 5000)
+        assert np.array_equal(decoded[:, 0], [0, 1] * 50)
+        assert encoded.nbytes * 20 < decoded.nbytes
+        assert np.array_equal(RunLengthTrajectories.from_dense(decoded).run_lengths, encoded.run_lengths)
+
+    def test_instrumentation(self):
+        """Test recording per-phase timings, and exporting them as a per-iteration table."""
+
+        from synd.westpa.instrumentation import Instrumentation
+
+        disabled = Instrumentation()
+        with disabled.phase('phase'):
+            pass
+        disabled.add_bytes('phase', 10)
+        assert disabled.records == {}
+
+        instrumentation = Instrumentation(enabled=True)
+        for _ in range(3):
+            with instrumentation.phase('write'):
+                pass
+        instrumentation.add_bytes('write', 100)
+
+        # Records from worker processes are merged into the master's
+        instrumentation.merge({'write': [1.0, 2, 50], 'generate': [2.0, 1, 0]})
+
+        records = instrumentation.pop_records()
+        assert instrumentation.records == {}
+        assert records['write'][1:] == [5, 150]
+        assert records['write'][0] >= 1.0
+
+        table = Instrumentation.to_table(records)
+        assert list(table['phase']) == [b'generate', b'write']
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_path = os.path.join(tmpdir, 'instrumentation.csv')
+            Instrumentation.append_csv(csv_path, 1, records)
+            Instrumentation.append_csv(csv_path, 2, records)
+
+            with open(csv_path) as infile:
+                lines = infile.read().splitlines()
+
+        assert lines[0] == 'n_iter,phase,wall_time,n_calls,n_bytes'
+        assert len(lines) == 5
+
     def test_command_line_interface(self):
         """Test the CLI."""
         runner = CliRunner()
-        result = runner.invoke(cli.main)
-        assert result.exit_code == 0
-        assert 'synd.cli.main' in result.output
         help_result = runner.invoke(cli.main, ['--help'])
         assert help_result.exit_code == 0
         assert '--help  Show this message and exit.' in help_result.output
+        assert 'generate' in help_result.output
+
+    def test_command_line_generate(self):
+        """Test streaming trajectories to disk with the CLI, in chunks."""
+
+        runner = CliRunner()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            model_file = os.path.join(tmpdir, 'model.synd')
+            self.synmd_model.save(model_file)
+
+            for outfile in ['traj.npy', 'traj.h5']:
+                outfile = os.path.join(tmpdir, outfile)
+                result = runner.invoke(cli.main, [
+                    'generate', model_file, '--initial-states', '0,1,2', '--n-steps', '25', '--chunk', '7',
+                    '--seed', '0', '--backmap', 'default', '--out', outfile
+                ])
+                assert result.exit_code == 0, result.output
+                assert 'steps/s' in result.output
+
+            trajectories = np.load(os.path.join(tmpdir, 'traj.npy'))
+            coordinates = np.load(os.path.join(tmpdir, 'traj_coordinates.npy'))
+
+            assert trajectories.shape == (3, 25)
+            assert np.array_equal(trajectories[:, 0], [0, 1, 2])
+            assert np.array_equal(coordinates, self.synmd_model.backmap(trajectories))
+
+            # Consecutive states must be connected by a nonzero transition probability, including across chunks
+            transition_matrix = simple_model.transition_matrix
+            assert np.all(transition_matrix[trajectories[:, :-1], trajectories[:, 1:]] > 0)
+
+            import h5py
+            with h5py.File(os.path.join(tmpdir, 'traj.h5'), 'r') as h5file:
+                assert np.array_equal(h5file['trajectories'][:], trajectories)
+                assert np.array_equal(h5file['coordinates'][:], coordinates)
+
+                # Datasets are chunked by --chunk
+                assert h5file['trajectories'].chunks == (3, 7)
+
+            # Unknown backmappers are rejected before anything is written
+            outfile = os.path.join(tmpdir, 'unknown.npy')
+            result = runner.invoke(cli.main, [
+                'generate', model_file, '-i', '0,1,2', '-n', '5', '--backmap', 'unknown', '-o', outfile
+            ])
+            assert result.exit_code == 2
+            assert '--backmap' in result.output
+            assert not os.path.exists(outfile)
+
+        # Chunks are capped well under HDF5's 4 GB limit, along steps and then walkers
+        chunks = cli.HDF5TrajectoryWriter.chunk_shape(10 ** 6, 10 ** 6, 1000, (1000, 3), np.float32)
+        assert np.prod(chunks) * 4 <= cli.MAX_HDF5_CHUNK_BYTES
+        assert chunks[1:] == (1, 1000, 3)
+
+
+try:
+    import h5py
+    import mdtraj as md
+    import westpa
+    from westpa.core.segment import Segment
+    from westpa.core.states import BasisState, InitialState
+    from synd.westpa import propagator as synd_propagator
+    from synd.westpa.instrumentation import Instrumentation
+    from synd.westpa.augmentation_driver import SynDAugmentationDriver
+except ImportError:
+    westpa = None
+
+
+@unittest.skipIf(westpa is None, "WESTPA isn't installed")
+class TestSyndWestpa(unittest.TestCase):
+    """Tests for the WESTPA propagator and plugins, with WESTPA's run-time configuration mocked out."""
+
+    def setUp(self):
+        """Set up a propagator on the simple model, and mock westpa.rc around it."""
+
+        model = MarkovGenerator(
+            transition_matrix=simple_model.transition_matrix,
+            backmapper=simple_model.backmapper,
+            seed=0
+        )
+        # Each state's full coordinates are a (2 atom, 3 dimension) array, distinct for each state
+        self.full_coordinates = lambda state: np.arange(6, dtype=np.float32).reshape(2, 3) + 10 * state
+        model.add_backmapper(self.full_coordinates, 'full_coordinates')
+
+        # Skip the constructor, which reads everything from the WESTPA configuration
+        self.propagator = synd_propagator.SynMDPropagator.__new__(synd_propagator.SynMDPropagator)
+        self.propagator.synd_model = model
+        self.propagator.state_index = synd_propagator.SegmentStateIndex()
+        self.propagator.auxref_indices = {}
+        self.propagator.instrumentation = Instrumentation()
+        self.propagator.coord_len = 5
+        self.propagator.save_stride = 1
+        self.propagator.coord_dtype = int
+        self.propagator.topology = self.make_topology(n_atoms=2)
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.h5file = h5py.File(os.path.join(self.tmpdir.name, 'west.h5'), 'w')
+
+        # Initial state i is a basis state for discrete state i
+        self.bstates = [BasisState(label=str(state), probability=1 / 3, auxref=str(state)) for state in range(3)]
+        self.istates = {
+            state: InitialState(
+                state_id=state, basis_state_id=state, iter_created=0, istate_type=InitialState.ISTATE_TYPE_BASIS
+            )
+            for state in range(3)
+        }
+
+        self.data_manager = SimpleNamespace(
+            store_h5=False,
+            we_h5file=self.h5file,
+            get_iter_group=lambda n_iter: self.h5file.require_group(f'iter_{n_iter:08d}'),
+            get_segment_initial_states=lambda segments: [
+                self.istates[-(segment.parent_id + 1)] for segment in segments
+            ],
+            flush_backing=lambda: None,
+        )
+        self.sim_manager = SimpleNamespace(
+            n_iter=1,
+            segments={},
+            current_iter_bstates=self.bstates,
+            we_driver=SimpleNamespace(next_iter_segments=[]),
+        )
+
+        self.patches = [
+            mock.patch.object(westpa.rc, 'get_data_manager', return_value=self.data_manager),
+            mock.patch.object(westpa.rc, 'get_sim_manager', return_value=self.sim_manager),
+            mock.patch.object(westpa.rc, 'get_propagator', return_value=self.propagator),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+
+        for patch in self.patches:
+            patch.stop()
+
+        self.h5file.close()
+        self.tmpdir.cleanup()
+
+    @staticmethod
+    def make_topology(n_atoms: int):
+        """
+        Build a reference structure of :code:`n_atoms` atoms in a 3 nm cubic box, each in its own residue.
+        """
+
+        topology = md.Topology()
+        chain = topology.add_chain()
+        for _ in range(n_atoms):
+            residue = topology.add_residue('ALA', chain)
+            topology.add_atom('CA', md.element.carbon, residue)
+
+        return md.Trajectory(
+            xyz=np.zeros((1, n_atoms, 3), dtype=np.float32),
+            topology=topology,
+            unitcell_lengths=np.full((1, 3), 3.0),
+            unitcell_angles=np.full((1, 3), 90.0),
+        )
+
+    def run_iteration(self, parent_ids):
+        """
+        Propagate an iteration of segments with the given parents, and register them with the mocked sim manager.
+        """
+
+        n_iter = self.sim_manager.n_iter
+        segments = [
+            Segment(n_iter=n_iter, seg_id=seg_id, parent_id=parent_id, data={})
+            for seg_id, parent_id in enumerate(parent_ids)
+        ]
+
+        if n_iter > 1:
+            for segment, parent_index in zip(segments, synd_propagator.get_segment_parent_indices(segments)):
+                segment.data['parent_final_state_index'] = int(parent_index)
+
+        self.propagator.propagate(segments)
+        self.sim_manager.segments = {segment.seg_id: segment for segment in segments}
+
+        return segments
+
+    def write_state_indices(self, segments):
+        """
+        Write an iteration's discrete trajectories to auxdata/state_indices, as WESTPA would.
+        """
+
+        iter_group = self.data_manager.get_iter_group(segments[0].n_iter)
+        iter_group.create_dataset(
+            'auxdata/state_indices', data=np.array([segment.data['state_indices'] for segment in segments])
+        )
+
+    def test_segment_state_index(self):
+        """Test that parent final states are found in memory, from ibstates, and after rebuilding from the H5 file."""
+
+        # Every segment of the first iteration starts from an initial state
+        first_segments = self.run_iteration([-1, -2, -3, -1, -3])
+        for segment in first_segments:
+            assert segment.data['state_indices'][0] == -(segment.parent_id + 1)
+
+        # The next iteration continues some segments, and recycles one into an initial state
+        parent_ids = [3, 3, 0, -2, 4, 1]
+        next_segments = [
+            Segment(n_iter=2, seg_id=seg_id, parent_id=parent_id, data={})
+            for seg_id, parent_id in enumerate(parent_ids)
+        ]
+        self.sim_manager.we_driver.next_iter_segments = next_segments
+
+        synd_propagator.copy_segment_data()
+
+        expected = [
+            first_segments[parent_id].data['state_indices'][-1] if parent_id >= 0 else -(parent_id + 1)
+            for parent_id in parent_ids
+        ]
+        assert [segment.data['parent_final_state_index'] for segment in next_segments] == expected
+
+        state_index = self.propagator.state_index
+        assert np.array_equal(
+            state_index.get(1, np.arange(5)), [segment.data['state_indices'][-1] for segment in first_segments]
+        )
+
+        # After a restart, nothing is in memory, so the previous iteration is rebuilt from the H5 file
+        self.write_state_indices(first_segments)
+        self.propagator.state_index = synd_propagator.SegmentStateIndex()
+
+        for segment in next_segments:
+            del segment.data['parent_final_state_index']
+
+        assert list(synd_propagator.get_segment_parent_indices(next_segments)) == expected
+        assert 1 in self.propagator.state_index.final_state_indices
+
+        # Only the current and previous iterations are kept
+        self.sim_manager.n_iter = 2
+        self.propagator.propagate(next_segments)
+        self.propagator.state_index.update(2, next_segments)
+        self.propagator.state_index.update(3, next_segments)
+        assert sorted(self.propagator.state_index.final_state_indices) == [2, 3]
+
+    def test_batched_backmapping(self):
+        """Test that backmapping all segments at once matches backmapping each state of each segment in turn."""
+
+        model = self.propagator.synd_model
+
+        # Repeated states, within and across segments
+        trajectories = np.array([[0, 0, 2, 2, 1], [2, 2, 2, 0, 0], [1, 1, 1, 1, 1]])
+
+        for mapper, backmapper in [('default', simple_model.backmapper), ('full_coordinates', self.full_coordinates)]:
+            batched = synd_propagator.backmap_trajectories(model, trajectories, mapper)
+            looped = np.array([[backmapper(state) for state in trajectory] for trajectory in trajectories])
+
+            assert batched.shape == looped.shape
+            assert np.array_equal(batched, looped)
+
+        # Each segment's pcoords are its own states, backmapped
+        segments = self.run_iteration([-1, -2, -3, -3, -1])
+
+        for segment in segments:
+            expected = np.array([simple_model.backmapper(state) for state in segment.data['state_indices']])
+            assert np.array_equal(segment.pcoord, expected)
+
+    def test_segment_trajectories(self):
+        """Test the full-coordinate trajectories stored for the H5 plugin."""
+
+        self.data_manager.store_h5 = True
+        self.sim_manager.n_iter = 3
+        self.propagator.save_stride = 2
+
+        segments = [
+            Segment(n_iter=3, seg_id=seg_id, parent_id=seg_id, data={'parent_final_state_index': state})
+            for seg_id, state in enumerate([0, 2, 1])
+        ]
+        self.propagator.propagate(segments)
+
+        # The first point is omitted, as for a saved MD trajectory
+        n_frames = self.propagator.coord_len - 1
+
+        for segment in segments:
+            trajectory = segment.data['iterh5/trajectory']
+
+            expected_xyz = np.array([self.full_coordinates(state) for state in segment.data['state_indices'][1:]])
+            assert trajectory.xyz.shape == (n_frames, 2, 3)
+            assert trajectory.xyz.dtype == np.float32
+            assert np.array_equal(trajectory.xyz, expected_xyz)
+
+            assert np.array_equal(trajectory.time, (np.arange(n_frames) + n_frames * 3) * 2)
+
+            assert trajectory.unitcell_lengths.shape == (n_frames, 3)
+            assert np.allclose(trajectory.unitcell_lengths, 3.0)
+            assert np.allclose(trajectory.unitcell_angles, 90.0)
+
+            # Every segment shares the reference Topology, rather than holding a copy
+            assert trajectory.topology is self.propagator.topology.topology
+
+            assert segment.status == segment.SEG_STATUS_COMPLETE
+
+    def test_coordinate_augmentation(self):
+        """Test that the augmentation plugin writes every segment's parent and final coordinates in one block."""
+
+        coord_map = {state: simple_model.state_definitions[state] for state in range(3)}
+        coord_map_path = os.path.join(self.tmpdir.name, 'coord_map.pkl')
+        with open(coord_map_path, 'wb') as outfile:
+            pickle.dump(coord_map, outfile)
+
+        self.sim_manager.work_manager = SimpleNamespace(is_master=True)
+        self.sim_manager.data_manager = self.data_manager
+        self.sim_manager.post_propagation = []
+        self.sim_manager.register_callback = lambda hook, function, priority: hook.append(function)
+
+        driver = SynDAugmentationDriver(
+            self.sim_manager, {'coord_map': coord_map_path, 'compression': 'gzip', 'compression_opts': 4}
+        )
+        assert self.sim_manager.post_propagation == [driver.augment_coordinates]
+        assert np.array_equal(driver.coord_table, simple_model.state_definitions)
+
+        first_segments = self.run_iteration([-1, -2, -3])
+        self.propagator.state_index.update(1, first_segments)
+
+        # Continue segments, and recycle one into an initial state
+        self.sim_manager.n_iter = 2
+        parent_ids = [2, -1, 0, 0, 1]
+        segments = self.run_iteration(parent_ids)
+
+        # Segments are written by seg_id, whatever order the sim manager holds them in
+        self.sim_manager.segments = {segment.seg_id: segment for segment in segments[::-1]}
+
+        driver.augment_coordinates()
+
+        dataset = self.h5file['iter_00000002/auxdata/coord']
+        assert dataset.shape == (5, 2, 4)
+        assert dataset.compression == 'gzip'
+        assert dataset.compression_opts == 4
+
+        for segment, parent_id in zip(segments, parent_ids):
+            parent_state = first_segments[parent_id].data['state_indices'][-1] if parent_id >= 0 else -(parent_id + 1)
+
+            assert np.array_equal(dataset[segment.seg_id, 0], simple_model.state_definitions[parent_state])
+            assert np.array_equal(
+                dataset[segment.seg_id, 1], simple_model.state_definitions[segment.data['state_indices'][-1]]
+            )
+
+        # Coordinate maps may be given in any order, but must cover every state
+        shuffled_map = {state: coord_map[state] for state in [2, 0, 1]}
+        assert np.array_equal(SynDAugmentationDriver.build_coord_table(shuffled_map), simple_model.state_definitions)
+
+        with self.assertRaises(KeyError):
+            SynDAugmentationDriver.build_coord_table({1: coord_map[1], 2: coord_map[2]})
+        with self.assertRaises(KeyError):
+            SynDAugmentationDriver.build_coord_table({0: coord_map[0], 2: coord_map[2]})
+
+    def test_ibstate_resolution(self):
+        """Test resolving the discrete states of a batch of initial state parents, with cached H5-defined states."""
+
+        # Initial state 3 is generated from basis state 1, and initial state 4 starts from an H5-defined state
+        self.istates[3] = InitialState(
+            state_id=3, basis_state_id=1, iter_created=0, istate_type=InitialState.ISTATE_TYPE_GENERATED
+        )
+        self.istates[4] = InitialState(
+            state_id=4, basis_state_id=0, iter_created=0, istate_type=InitialState.ISTATE_TYPE_START,
+            basis_auxref='hdf:west.h5:1:0'
+        )
+
+        segments = [
+            Segment(n_iter=1, seg_id=seg_id, parent_id=-(istate_id + 1), data={})
+            for seg_id, istate_id in enumerate([4, 0, 3, 2, 4, 1])
+        ]
+
+        get_initial_states = mock.Mock(side_effect=self.data_manager.get_segment_initial_states)
+        self.data_manager.get_segment_initial_states = get_initial_states
+
+        with mock.patch.object(
+                BasisState, 'get_h5_cached_segment_value', create=True, return_value=(2, (None, 1, 0))
+        ) as get_h5_value:
+
+            for _ in range(2):
+                indices = synd_propagator.get_segments_ibstate_discrete_indices(segments)
+                assert list(indices) == [2, 0, 1, 2, 2, 1]
+
+        # Initial states are fetched once per batch, and H5-defined states are read once
+        assert get_initial_states.call_count == 2
+        assert get_h5_value.call_count == 1
+
+        # The cache belongs to the propagator, so a new run starts without stale entries
+        assert self.propagator.auxref_indices['hdf:west.h5:1:0'] == 2
+        self.propagator.auxref_indices = {}
+
+        with mock.patch.object(
+                BasisState, 'get_h5_cached_segment_value', create=True, return_value=(0, (None, 1, 0))
+        ):
+            assert synd_propagator.get_segments_ibstate_discrete_indices(segments)[0] == 0
+
+    def make_propagator(self, **parameters):
+        """
+        Construct a propagator from a mocked WESTPA configuration, with a model that cycles through its states.
+        """
+
+        topology_path = os.path.join(self.tmpdir.name, 'topology.pdb')
+        self.make_topology(n_atoms=2).save_pdb(topology_path)
+
+        # Each step moves every walker to the next state, so the state after n steps is known exactly
+        cycle_model = MarkovGenerator(np.roll(np.eye(3), 1, axis=1), simple_model.backmapper, backmap_table='eager')
+        cycle_model.add_backmapper(self.full_coordinates, 'full_coordinates', backmap_table='eager')
+        model_path = os.path.join(self.tmpdir.name, 'cycle.synd')
+        cycle_model.save(model_path)
+
+        config = {
+            ('west', 'propagation', 'parameters'): {'topology': topology_path, 'synd_model': model_path, **parameters},
+            ('west', 'system', 'system_options', 'pcoord_len'): 5,
+        }
+        self.sim_manager.finalize_iteration = []
+        self.sim_manager.register_callback = lambda hook, function, priority: hook.append(function)
+
+        rc = SimpleNamespace(
+            config=SimpleNamespace(get=lambda key, default=None: config.get(tuple(key), default)),
+            get_sim_manager=lambda: self.sim_manager,
+        )
+
+        with mock.patch('builtins.print'):
+            return synd_propagator.SynMDPropagator(rc)
+
+    def test_save_stride(self):
+        """Test that the propagator validates save_stride, and saves every save_stride-th step."""
+
+        for save_stride in [0, -2, 1.5, '2', True]:
+            with self.assertRaises(ValueError):
+                self.make_propagator(save_stride=save_stride)
+
+        assert self.make_propagator().save_stride == 1
+
+        propagator = self.make_propagator(save_stride=np.int64(2))
+        assert type(propagator.save_stride) is int
+
+        self.data_manager.store_h5 = True
+        self.sim_manager.n_iter = 2
+
+        segments = [
+            Segment(n_iter=2, seg_id=seg_id, parent_id=seg_id, data={'parent_final_state_index': state})
+            for seg_id, state in enumerate([0, 1, 2])
+        ]
+        with mock.patch.object(westpa.rc, 'get_propagator', return_value=propagator):
+            propagator.propagate(segments)
+
+        for segment, initial_state in zip(segments, [0, 1, 2]):
+            # Two transitions are taken between each saved step
+            expected_states = (initial_state + 2 * np.arange(5)) % 3
+            assert np.array_equal(segment.data['state_indices'], expected_states)
+            assert np.array_equal(segment.pcoord, simple_model.state_definitions[expected_states])
+
+            # Frame times are in dynamics steps, so they advance by save_stride per saved frame
+            assert np.array_equal(segment.data['iterh5/trajectory'].time, (np.arange(4) + 4 * 2) * 2)